@@ -27,6 +27,7 @@ class Command:
         'session_user': None,
         'workers': os.cpu_count(),
         'batch_executor': 'thread',
+        'parsers': 0,
         'verbose': {'action': 'count', 'default': None},
         'report_to': None,
     }
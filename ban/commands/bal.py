@@ -1,25 +1,83 @@
+from itertools import islice
+
 import peewee
 
 from ban.commands import command, reporter
 from ban.core.models import HouseNumber, Group, Position
 from ban.utils import compute_cia
 
-from . import helpers
+from . import checkpoints, helpers, lookups
 
 __namespace__ = 'import'
+CHUNKSIZE = 1000
 
 
 @command
 @helpers.nodiff
-def bal(path, limit=0, **kwargs):
+def bal(path, limit=0, resume=False, **kwargs):
     """Import from BAL files (AITF 1.1 format)
     cf https://github.com/etalab/ban/issues/75
+
+    resume  Skip the chunks committed by a previous interrupted run.
     """
+    helpers.imported(process_file(path, limit=limit, resume=resume))
+
+
+def process_file(path, limit=0, resume=False, progress=True):
+    """Import the rows of path, and return their INSEE codes."""
     # We need to support BOM.
-    rows = list(helpers.load_csv(path, encoding='utf-8-sig'))
+    reader = helpers.load_csv(path, encoding='utf-8-sig')
+    journal = None
+    if reader.size is not None:
+        # Only files on disk can be resumed.
+        journal = checkpoints.Journal(path, CHUNKSIZE)
     if limit:
-        rows = rows[:limit]
-    helpers.batch(process_row, rows, total=len(rows))
+        keys = helpers.batch(process_row, islice(reader, limit), total=limit,
+                             chunksize=CHUNKSIZE, progress=progress,
+                             preload=preload, journal=journal, resume=resume,
+                             partition=partition)
+    else:
+        # Rows are streamed, progress is based on bytes read.
+        keys = helpers.batch(process_row, reader, total=reader.size,
+                             done=lambda: reader.done, chunksize=CHUNKSIZE,
+                             progress=progress, preload=preload,
+                             journal=journal, resume=resume,
+                             partition=partition)
+    return keys
+
+
+def partition(row):
+    """INSEE code of the row, for rows of a municipality to be processed in
+    order."""
+    return (row.get('cle_interop') or '').split('_')[0]
+
+
+def preload(rows):
+    """Load at once the resources the rows of a chunk will look up."""
+    cache = lookups.get()
+    ids = []
+    group_ids = []
+    cias = []
+    for row in rows:
+        id = (row.get('uid_adresse') or '').strip()
+        if id:
+            ids.append(id)
+        insee, group_id, *_ = (row.get('cle_interop') or '_').split('_')
+        if len(group_id) == 4:
+            if insee not in cache.loaded:
+                cache.load_groups(insee)
+            number = row.get('numero')
+            if number == '99999':
+                number = None
+            cias.append(compute_cia(insee, group_id, number,
+                                    row.get('suffixe') or None))
+        elif group_id:
+            group_ids.append(group_id)
+    cache.load(Group, 'id', ids + group_ids)
+    cache.load(HouseNumber, 'id', ids)
+    cache.load(HouseNumber, 'cia', cias)
+    cache.load_positions({instance for instance in cache.instances.values()
+                          if isinstance(instance, HouseNumber)})
 
 
 @helpers.session
@@ -39,19 +97,17 @@ def process_row(row):
 
 
 def process_group(row, id, name, insee, group_id, fantoir):
-    municipality = 'insee:{}'.format(insee)
+    cache = lookups.get()
+    municipality = cache.municipality(insee) or 'insee:{}'.format(insee)
     data = dict(name=name, fantoir=fantoir, municipality=municipality)
     instance = None  # Means creation.
     if id:
-        try:
-            instance = Group.get(Group.id == id)
-        except Group.DoesNotExist:
+        instance = cache.find(Group, 'id', id)
+        if not instance:
             return reporter.error('Group id not found', id)
     elif data['fantoir']:
-        try:
-            instance = Group.get(Group.fantoir == data['fantoir'])
-        except Group.DoesNotExist:
-            pass  # Let's create it.
+        # None means we will create it.
+        instance = cache.find(Group, 'fantoir', data['fantoir'])
     if instance:
         data['kind'] = instance.kind
         # Well… the BAL can't give us a BAN reference version, be kind for now.
@@ -65,6 +121,7 @@ def process_group(row, id, name, insee, group_id, fantoir):
         reporter.error('Invalid data', validator.errors)
     else:
         street = validator.save()
+        cache.add(street)
         msg = 'Created group' if not instance else 'Updated group'
         reporter.notice(msg, street.id)
         if row.get('lat') and row.get('long'):
@@ -80,11 +137,12 @@ def process_housenumber(row, id, name, insee, group_id, fantoir):
     lat = row.get('lat')
     lon = row.get('long')
     kind = row.get('position')
+    cache = lookups.get()
     cia = None
     instance = None
     data = dict(number=number, ordinal=ordinal)
     if id:
-        instance = HouseNumber.where(HouseNumber.id == id).first()
+        instance = cache.find(HouseNumber, 'id', id)
         if not instance:
             return reporter.error('HouseNumber id not found', id)
         parent = instance.parent
@@ -92,7 +150,7 @@ def process_housenumber(row, id, name, insee, group_id, fantoir):
         parent = 'fantoir:{}'.format(fantoir)
         cia = compute_cia(insee, fantoir[5:], number, ordinal)
     elif group_id:
-        parent = Group.where(Group.id == group_id).first()
+        parent = cache.find(Group, 'id', group_id)
         if not parent:
             return reporter.error('Group id not found', group_id)
         if parent.fantoir:
@@ -101,7 +159,7 @@ def process_housenumber(row, id, name, insee, group_id, fantoir):
     else:
         return reporter.error('Missing group id and fantoir', id)
     if cia:
-        instance = HouseNumber.where(HouseNumber.cia == cia).first()
+        instance = cache.find(HouseNumber, 'cia', cia)
     if instance:
         # Well… the BAL can't give us a BAN reference version, be kind for now.
         # See https://github.com/etalab/ban/issues/91#issuecomment-198432574
@@ -119,6 +177,7 @@ def process_housenumber(row, id, name, insee, group_id, fantoir):
         except peewee.IntegrityError:
             return reporter.error('Duplicate housenumber',
                                   (number, ordinal, parent))
+        cache.add(housenumber)
         if lon and lat:
             process_position(housenumber, (lon, lat), kind)
         msg = 'HouseNumber Updated' if instance else 'HouseNumber created'
@@ -139,8 +198,9 @@ KIND_MAPPING = {
 
 def process_position(housenumber, center, kind):
     kind = KIND_MAPPING.get(kind, kind)
-    instance = Position.where(Position.housenumber == housenumber,
-                              Position.kind == kind).first()
+    cache = lookups.get()
+    instance = next((position for position in cache.positions(housenumber)
+                     if position.kind == kind), None)
     version = instance.version + 1 if instance else 1
     validator = Position.validator(housenumber=housenumber, center=center,
                                    source='BAL',  # Use siren from filename?
@@ -151,5 +211,6 @@ def process_position(housenumber, center, kind):
         reporter.error('Position error', validator.errors)
     else:
         position = validator.save()
+        cache.add(position)
         msg = 'Position updated' if instance else 'Position created'
         reporter.notice(msg, position.id)
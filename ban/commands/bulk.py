@@ -0,0 +1,466 @@
+"""Bulk path of import:init, for a first national load.
+
+Each file is COPYed into a temporary staging table, private to the run,
+then rows are checked with SQL statements mirroring the resource
+validators, and resources are inserted with their first version in
+set-based statements.
+
+Only creations are supported: rows matching existing resources are
+reported and skipped, the row by row import must be used to update them.
+"""
+import json
+from collections import OrderedDict
+from itertools import islice
+from pathlib import Path
+
+import peewee
+
+from ban import db
+from ban.commands import reporter
+from ban.core.models import (Group, HouseNumber, Municipality, Position,
+                             PostCode)
+from ban.core.versioning import Version
+from ban.utils import normalize, utcnow
+
+from . import helpers
+
+STAGING = 'import_staging'
+ROWS = 'import_rows'
+# Creation order, so that rows can reference resources created before.
+ORDER = ['municipality', 'postcode', 'group', 'housenumber', 'position']
+PAGE_SIZE = 10000
+
+
+def quote(name):
+    return '"{}"'.format(name)
+
+
+def table(model):
+    return quote(model._meta.db_table)
+
+
+def column(model, name):
+    return quote(model._meta.fields[name].db_column)
+
+
+def lookup(model, condition):
+    """SQL subquery returning the pk of the active model instance matching
+    condition."""
+    return '(SELECT pk FROM {} AS t WHERE {} AND t.deleted_at IS NULL)'.format(
+        table(model), condition)
+
+
+def choice(field, value, default='NULL'):
+    choices = ', '.join("'{}'".format(key) for key, label in field.choices)
+    return 'CASE WHEN {value} IN ({choices}) THEN {value} ELSE {default} END'\
+        .format(value=value, choices=choices, default=default)
+
+
+def text(key):
+    return "NULLIF(d->>'{}', '')".format(key)
+
+
+def source_attributes():
+    return "hstore('source', d->>'source')"
+
+
+def municipality_by_insee(expression):
+    return lookup(Municipality, 't.insee = {}'.format(expression))
+
+
+# Per resource, the model fields computed from the staged JSON row `d`, as
+# done by the import:init row processors.
+COLUMNS = {
+    'municipality': lambda: OrderedDict([
+        ('insee', text('insee')),
+        ('name', text('name')),
+        ('attributes', source_attributes()),
+    ]),
+    'postcode': lambda: OrderedDict([
+        ('code', text('postcode')),
+        ('name', text('name')),
+        ('municipality', municipality_by_insee("d->>'municipality:insee'")),
+        ('attributes', source_attributes()),
+    ]),
+    'group': lambda: OrderedDict([
+        ('name', text('name')),
+        ('kind', text('group')),
+        # Same as FantoirField.coerce.
+        ('fantoir', "CASE WHEN length({value}) = 10 THEN left({value}, 9) "
+                    "ELSE {value} END".format(value=text('fantoir'))),
+        ('laposte', text('laposte')),
+        ('ign', text('ign')),
+        ('municipality', municipality_by_insee("d->>'municipality:insee'")),
+        ('addressing', choice(Group.addressing, "d->>'addressing'")),
+        ('attributes', "COALESCE((SELECT hstore(array_agg(key), "
+                       "array_agg(value)) FROM jsonb_each_text("
+                       "d->'attributes')), ''::hstore) || {}".format(
+                           source_attributes())),
+    ]),
+    'housenumber': lambda: OrderedDict([
+        ('number', text('numero')),
+        ('ordinal', text('ordinal')),
+        ('ign', text('ign')),
+        ('laposte', text('laposte')),
+        ('parent', "CASE WHEN d ? 'group:fantoir' THEN {} "
+                   "WHEN d ? 'group:ign' THEN {} "
+                   "WHEN d ? 'group:laposte' THEN {} END".format(
+                       lookup(Group, "t.fantoir = left(d->>'group:fantoir', "
+                                     "9)"),
+                       lookup(Group, "t.ign = d->>'group:ign'"),
+                       lookup(Group, "t.laposte = d->>'group:laposte'"))),
+        ('postcode', '(SELECT p.pk FROM {postcode} AS p JOIN {municipality} '
+                     'AS m ON m.pk = p.{fk} WHERE p.code = '
+                     "d->>'postcode:code' AND m.insee = COALESCE("
+                     "d->>'municipality:insee', "
+                     "left(d->>'group:fantoir', 5)) "
+                     'AND p.deleted_at IS NULL)'.format(
+                         postcode=table(PostCode),
+                         municipality=table(Municipality),
+                         fk=column(PostCode, 'municipality'))),
+        # Computed once parents are known, see `prepare_housenumbers`.
+        ('cia', 'NULL::text'),
+        ('attributes', source_attributes()),
+    ]),
+    'position': lambda: OrderedDict([
+        ('housenumber', "CASE WHEN d ? 'housenumber:cia' THEN {} "
+                        "WHEN d ? 'housenumber:ign' THEN {} END".format(
+                            lookup(HouseNumber, "t.cia = upper("
+                                                "d->>'housenumber:cia')"),
+                            lookup(HouseNumber,
+                                   "t.ign = d->>'housenumber:ign'"))),
+        ('kind', choice(Position.kind, "d->>'kind'", "'unknown'")),
+        ('positioning', choice(Position.positioning, "d->>'positionning'",
+                               "'other'")),
+        ('source', text('source')),
+        ('ign', text('ign')),
+        ('name', text('name')),
+        ('center', "CASE WHEN d ? 'geometry' THEN ST_SetSRID(ST_MakePoint("
+                   "(d#>>'{geometry,coordinates,0}')::float8, "
+                   "(d#>>'{geometry,coordinates,1}')::float8), 4326) END"),
+    ]),
+}
+
+MODELS = {model.__name__.lower(): model for model in
+          [Municipality, PostCode, Group, HouseNumber, Position]}
+
+
+class Lines:
+    """File like object over non blank lines, for COPY."""
+
+    def __init__(self, lines):
+        self.lines = (line for line in lines if line.strip())
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def execute(sql, params=None):
+    return Version._meta.database.execute_sql(sql, params or ())
+
+
+def stage(path, limit=0):
+    """COPY the JSON lines of path in the staging table."""
+    database = Version._meta.database
+    with database.atomic(), Path(path).open(encoding='utf-8') as f:
+        # Temporary, not to mix the rows of concurrent runs.
+        execute('CREATE TEMP TABLE IF NOT EXISTS {} (line serial, '
+                'data jsonb)'.format(STAGING))
+        execute('TRUNCATE {} RESTART IDENTITY'.format(STAGING))
+        lines = islice(f, limit) if limit else f
+        cursor = database.get_cursor()
+        # Neither quote nor delimiter can be found in the lines: each one is
+        # loaded as is, without text format escapes processing.
+        cursor.copy_expert("COPY {} (data) FROM STDIN WITH (FORMAT csv, "
+                           "QUOTE E'\\x01', DELIMITER E'\\x02')".format(
+                               STAGING), Lines(lines))
+
+
+def checks(model, columns):
+    """(SQL condition on rows `r`, field, message) of the validator checks
+    of columns."""
+    for name in columns:
+        field = model._meta.fields[name]
+        col = 'r.{}'.format(quote(name))
+        if not field.null:
+            yield '{} IS NULL'.format(col), name, 'Value should not be null'
+        if isinstance(field, db.PostCodeField):
+            yield ("{} !~ '^[0-9]{{5}}$'".format(col), name,
+                   'Invalid postcode')
+        elif isinstance(field, db.FantoirField):
+            yield ("length({}) != 9".format(col), name,
+                   'FANTOIR must be municipality INSEE + 4 first chars of '
+                   'FANTOIR')
+        if getattr(field, 'min_length', None):
+            yield ('length({}) < {}'.format(col, field.min_length), name,
+                   'Should be minimum {} characters'.format(field.min_length))
+        if isinstance(field, db.CharField) and field.max_length:
+            yield ('length({}) > {}'.format(col, field.max_length), name,
+                   'Should be maximum {} characters'.format(field.max_length))
+        if field.choices:
+            choices = ', '.join("'{}'".format(k) for k, v in field.choices)
+            yield ('{} NOT IN ({})'.format(col, choices), name,
+                   'Should be one of the following choices: {}'.format(
+                       choices))
+    # Model specific validation.
+    if model is Position and 'center' in columns:
+        message = 'A position must have either a center or a name.'
+        yield 'r.center IS NULL AND r.name IS NULL', 'center', message
+
+
+def uniques(model, columns):
+    """Groups of columns that must be unique together."""
+    for name in columns:
+        if model._meta.fields[name].unique:
+            yield (name, )
+    for names, unique in model._meta.indexes:
+        if unique and all(name in columns for name in names):
+            yield names
+
+
+def reject(condition, field, message, params=()):
+    execute('UPDATE {rows} AS r SET error = %s WHERE r.error IS NULL AND '
+            '({condition})'.format(rows=ROWS, condition=condition),
+            ['{}: {}'.format(field, message)] + list(params))
+
+
+def validate(model, columns):
+    # Existing resources first: those rows are meant to update them.
+    for names in uniques(model, columns):
+        same = ['t.{} = r.{}'.format(column(model, names[0]),
+                                     quote(names[0]))]
+        same.extend('t.{} IS NOT DISTINCT FROM r.{}'.format(
+            column(model, name), quote(name)) for name in names[1:])
+        reject('r.{} IS NOT NULL AND EXISTS (SELECT 1 FROM {} AS t WHERE '
+               '{})'.format(quote(names[0]), table(model), ' AND '.join(same)),
+               ', '.join(names), '{} already exists'.format(model.__name__))
+    for condition, field, message in checks(model, columns):
+        reject(condition, field, message)
+    for names in uniques(model, columns):
+        first = quote(names[0])
+        partition = ', '.join(quote(name) for name in names)
+        execute('UPDATE {rows} AS r SET error = %s FROM (SELECT line, '
+                'row_number() OVER (PARTITION BY {partition} ORDER BY line) '
+                'AS n FROM {rows} WHERE error IS NULL AND {first} IS NOT '
+                'NULL) AS d WHERE d.line = r.line AND d.n > 1'.format(
+                    rows=ROWS, partition=partition, first=first),
+                ['{}: Duplicate in file'.format(', '.join(names))])
+
+
+def pages(sql, params=()):
+    """Yield rows of a query on rows, paginated by line (first column)."""
+    last = 0
+    while True:
+        results = execute('{} AND r.line > %s ORDER BY r.line LIMIT {}'
+                          .format(sql, PAGE_SIZE),
+                          list(params) + [last]).fetchall()
+        if not results:
+            return
+        yield results
+        last = results[-1][0]
+
+
+def update_rows(name, values):
+    """Set the column name of rows from (line, value) pairs."""
+    if not values:
+        return
+    execute('UPDATE {rows} AS r SET {name} = v.value FROM (VALUES {values}) '
+            'AS v(line, value) WHERE r.line = v.line'.format(
+                rows=ROWS, name=quote(name),
+                values=', '.join(['(%s, %s)'] * len(values))),
+            [value for pair in values for value in pair])
+
+
+def prepare_named():
+    """Compute the search field, the way NamedModel.save does."""
+    execute('ALTER TABLE {} ADD COLUMN normalized text'.format(ROWS))
+    for page in pages('SELECT r.line, r.name FROM {} AS r WHERE '
+                      'r.error IS NULL'.format(ROWS)):
+        update_rows('normalized', [(line, normalize(name))
+                                   for line, name in page])
+
+
+def prepare_housenumbers():
+    """Compute the cia, the way HouseNumber.save does. Groups without
+    FANTOIR need their temporary one, computed in python."""
+    sql = ('SELECT r.line, g.name FROM {rows} AS r JOIN {group} AS g '
+           'ON g.pk = r.parent WHERE r.error IS NULL AND g.fantoir IS NULL'
+           .format(rows=ROWS, group=table(Group)))
+    execute('ALTER TABLE {} ADD COLUMN fantoir text'.format(ROWS))
+    for page in pages(sql):
+        update_rows('fantoir', [(line, Group(name=name).tmp_fantoir)
+                                for line, name in page])
+    execute("UPDATE {rows} AS r SET cia = m.insee || '_' || "
+            "COALESCE(r.fantoir, substr(g.fantoir, 6)) || '_' || "
+            "upper(COALESCE(r.number, '')) || '_' || "
+            "upper(COALESCE(r.ordinal, '')) "
+            "FROM {group} AS g, {municipality} AS m "
+            "WHERE g.pk = r.parent AND m.pk = g.{fk}".format(
+                rows=ROWS, group=table(Group),
+                municipality=table(Municipality),
+                fk=column(Group, 'municipality')))
+
+
+def version_data(model, session, now):
+    """SQL expression of `as_version` of the just created instance `t`,
+    with its params."""
+    items = []
+    params = []
+    for name in model.versioned_fields:
+        field = getattr(model, name)
+        if name == 'status':
+            expression = "'active'"
+        elif name in ('created_by', 'modified_by'):
+            expression = '%s::json'
+            params.append(json.dumps(session.serialize()))
+        elif name in ('created_at', 'modified_at'):
+            expression = 'to_json(%s::text)'
+            params.append(now.isoformat())
+        elif isinstance(field, (db.ManyToManyField,
+                                peewee.ReverseRelationDescriptor)):
+            # Created resources have none yet.
+            expression = "'[]'::json"
+        elif isinstance(field, db.ForeignKeyField):
+            expression = '(SELECT to_json(id) FROM {} WHERE pk = t.{})'.format(
+                table(field.rel_model), column(model, name))
+        elif isinstance(field, db.PointField):
+            expression = ("CASE WHEN t.{col} IS NOT NULL THEN "
+                          "json_build_object('type', 'Point', 'coordinates', "
+                          "json_build_array(ST_X(t.{col}), ST_Y(t.{col}))) "
+                          "END".format(col=column(model, name)))
+        elif isinstance(field, db.HStoreField):
+            expression = 'hstore_to_json(t.{})'.format(column(model, name))
+        else:
+            expression = 'to_json(t.{})'.format(column(model, name))
+        items.append("'{}', {}".format(name, expression))
+    return 'json_build_object({})::jsonb'.format(', '.join(items)), params
+
+
+def create(resource, session, now, insees=None):
+    """Insert valid rows of resource and their first version.
+
+    insees: optional set to add the INSEE codes of the created rows to."""
+    model = MODELS[resource]
+    columns = list(COLUMNS[resource]().items())
+    names = [name for name, expression in columns]
+    execute('CREATE TEMP TABLE {rows} ON COMMIT DROP AS SELECT s.line, '
+            'NULL::text AS error, NULL::integer AS target, '
+            "%s || md5(random()::text || s.line::text || "
+            'clock_timestamp()::text) AS id, {select} '
+            'FROM {staging} AS s, LATERAL (SELECT s.data AS d) AS x '
+            "WHERE d->>'type' = %s".format(
+                rows=ROWS, staging=STAGING,
+                select=', '.join('{} AS {}'.format(expression, quote(name))
+                                 for name, expression in columns)),
+            ['ban-{}-'.format(resource), resource])
+    execute('CREATE UNIQUE INDEX ON {} (line)'.format(ROWS))
+    if resource == 'housenumber':
+        prepare_housenumbers()
+    validate(model, names)
+    if 'normalized' in model._meta.fields:
+        prepare_named()
+        names.append('normalized')
+    for page in pages('SELECT r.line, r.error, s.data FROM {rows} AS r '
+                      'JOIN {staging} AS s USING (line) WHERE r.error IS '
+                      'NOT NULL'.format(rows=ROWS, staging=STAGING)):
+        for line, error, data in page:
+            reporter.error('{} errors'.format(model.__name__), (error, data))
+    execute('INSERT INTO {table} (id, version, {meta}, {columns}) '
+            'SELECT r.id, 1, %s, %s, %s, %s, {values} '
+            'FROM {rows} AS r WHERE r.error IS NULL ORDER BY r.line'.format(
+                table=table(model),
+                meta=', '.join(column(model, name) for name in (
+                    'created_at', 'created_by', 'modified_at',
+                    'modified_by')),
+                columns=', '.join(column(model, name) for name in names),
+                values=', '.join('r.{}'.format(quote(name))
+                                 for name in names),
+                rows=ROWS),
+            [now, session.pk, now, session.pk])
+    execute('UPDATE {rows} AS r SET target = t.pk FROM {table} AS t WHERE '
+            't.id = r.id AND r.error IS NULL'.format(rows=ROWS,
+                                                     table=table(model)))
+    data, params = version_data(model, session, now)
+    execute('INSERT INTO {version} (model_name, model_pk, sequential, data, '
+            "period) SELECT %s, t.pk, 1, {data}, tstzrange(t.{modified_at}, "
+            "NULL, '[)') FROM {rows} AS r JOIN {table} AS t ON "
+            't.pk = r.target'.format(
+                version=quote(Version._meta.db_table), data=data,
+                modified_at=column(model, 'modified_at'), rows=ROWS,
+                table=table(model)),
+            [resource] + params)
+    if model is Position:
+        execute('UPDATE {housenumber} AS h SET center = p.center FROM ('
+                'SELECT DISTINCT ON (p.{fk}) p.{fk} AS housenumber, p.center '
+                'FROM {position} AS p WHERE p.deleted_at IS NULL AND '
+                'p.center IS NOT NULL AND p.{fk} IN (SELECT housenumber FROM '
+                '{rows} WHERE target IS NOT NULL) ORDER BY p.{fk}, p.pk) AS p '
+                'WHERE h.pk = p.housenumber'.format(
+                    housenumber=table(HouseNumber), position=table(Position),
+                    fk=column(Position, 'housenumber'), rows=ROWS))
+    count = execute('SELECT count(*) FROM {} WHERE target IS NOT NULL'
+                    .format(ROWS)).fetchone()[0]
+    if count:
+        reporter.notice('Imported {}'.format(model.__name__), count)
+        if insees is not None:
+            insees.update(touched(resource))
+    return count
+
+
+def touched(resource):
+    """INSEE codes of the municipalities of the rows created by `create`."""
+    municipality = {
+        'municipality': 'r.target',
+        'postcode': 'r."municipality"',
+        'group': 'r."municipality"',
+        'housenumber': '(SELECT g.{fk} FROM {group} AS g WHERE g.pk = '
+                       'r."parent")',
+        'position': '(SELECT g.{fk} FROM {housenumber} AS h JOIN {group} '
+                    'AS g ON g.pk = h.{parent} WHERE h.pk = '
+                    'r."housenumber")',
+    }[resource].format(fk=column(Group, 'municipality'), group=table(Group),
+                       housenumber=table(HouseNumber),
+                       parent=column(HouseNumber, 'parent'))
+    rows = execute('SELECT DISTINCT m.insee FROM {municipality} AS m WHERE '
+                   'm.pk IN (SELECT {pk} FROM {rows} AS r WHERE r.target IS '
+                   'NOT NULL)'.format(municipality=table(Municipality),
+                                      pk=municipality, rows=ROWS))
+    return {insee for insee, in rows}
+
+
+def load(path, limit=0):
+    """Import the JSON lines of path, as import:init does row by row."""
+    session = helpers.get_session()
+    database = Version._meta.database
+    try:
+        stage(path, limit)
+        kinds = {kind for kind, in execute(
+            "SELECT DISTINCT data->>'type' FROM {}".format(STAGING))}
+        if kinds - set(ORDER):
+            unknown = execute("SELECT data FROM {} WHERE data->>'type' IS "
+                              "NULL OR NOT data->>'type' = ANY(%s)".format(
+                                  STAGING), [ORDER])
+            for data, in unknown:
+                reporter.error('Missing "type" key', data)
+        total = 0
+        insees = set()
+        for resource in ORDER:
+            if resource not in kinds:
+                continue
+            # Same timestamp for all instances, as they are created together.
+            now = utcnow()
+            with database.atomic():
+                total += create(resource, session, now, insees)
+    finally:
+        execute('DROP TABLE IF EXISTS {}'.format(STAGING))
+    helpers.imported(insees)
+    return total
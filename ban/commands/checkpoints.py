@@ -0,0 +1,94 @@
+"""Journal of the chunks committed by batch imports, for an interrupted
+import to be resumed where it stopped.
+
+Chunks are identified by their index in the input, and by the partitions
+of their items when the batch is partitioned (see `helpers.batch`): a run
+can only be resumed with the same file and the same chunk size, which are
+part of the journal fingerprint.
+"""
+import hashlib
+from pathlib import Path
+
+from ban import db
+from ban.utils import utcnow
+
+# Bytes read at each end of the file to fingerprint it.
+SAMPLE_SIZE = 1024 * 1024
+
+
+class Checkpoint(db.Model):
+    path = db.TextField()
+    fingerprint = db.CharField(max_length=40)
+    chunk = db.IntegerField()
+    part = db.IntegerField(default=0)
+    size = db.IntegerField()
+    created_at = db.DateTimeField(default=utcnow)
+
+    class Meta:
+        indexes = (
+            (('path', 'fingerprint', 'chunk', 'part'), True),
+        )
+
+
+def fingerprint(path, *extra):
+    """Hash of the file size, head and tail, and of extra values: cheap
+    enough for huge files, while telling apart a file that changed."""
+    path = Path(path)
+    size = path.stat().st_size
+    sha1 = hashlib.sha1(str([size] + list(extra)).encode())
+    with path.open('rb') as f:
+        sha1.update(f.read(SAMPLE_SIZE))
+        if size > SAMPLE_SIZE:
+            f.seek(max(SAMPLE_SIZE, size - SAMPLE_SIZE))
+            sha1.update(f.read())
+    return sha1.hexdigest()
+
+
+def forget(path):
+    """Forget about the committed chunks of path, whatever their
+    fingerprint, eg. once the file is removed."""
+    Checkpoint.delete().where(
+        Checkpoint.path == str(Path(path).resolve())).execute()
+
+
+class Journal:
+    """Committed chunks of an import of path, by chunksize items."""
+
+    def __init__(self, path, chunksize):
+        self.path = str(Path(path).resolve())
+        self.fingerprint = fingerprint(path, chunksize)
+
+    def where(self, query):
+        return query.where(Checkpoint.path == self.path,
+                           Checkpoint.fingerprint == self.fingerprint)
+
+    def start(self, resume=False):
+        """Return the (chunk index, part) to skip: the ones committed by
+        previous runs when resuming, none otherwise."""
+        if not resume:
+            self.clear()
+            return set()
+        # Left by runs over another version of the file, or by chunks.
+        Checkpoint.delete().where(
+            Checkpoint.path == self.path,
+            Checkpoint.fingerprint != self.fingerprint).execute()
+        query = self.where(Checkpoint.select(Checkpoint.chunk,
+                                             Checkpoint.part))
+        return set(query.order_by().tuples())
+
+    def commit(self, index, parts):
+        """Record the parts of chunk as committed, to be called within its
+        transaction.
+
+        parts: {part: number of items}"""
+        now = utcnow()
+        Checkpoint.insert_many([
+            dict(path=self.path, fingerprint=self.fingerprint, chunk=index,
+                 part=part, size=size, created_at=now)
+            for part, size in parts.items()
+        ]).execute()
+
+    def clear(self):
+        """Forget about committed chunks of path, whatever their
+        fingerprint, eg. once the import is done."""
+        Checkpoint.delete().where(Checkpoint.path == self.path).execute()
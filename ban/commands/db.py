@@ -1,15 +1,18 @@
 from ban.auth import models as amodels
 from ban.commands import command, reporter
 from ban.core import models as cmodels
-from ban.core.versioning import Diff, Version, Redirect, Flag
+from ban.core.stats import Statistic, rebuild
+from ban.core.versioning import Diff, Version, Redirect, Refresh, Flag
 
 from . import helpers
+from .checkpoints import Checkpoint
+from .jobs import Job
 
 models = [Version, Diff, Redirect, amodels.User, amodels.Client,
           amodels.Grant, amodels.Session, amodels.Token, cmodels.Municipality,
           cmodels.PostCode, cmodels.Group, cmodels.HouseNumber,
           cmodels.HouseNumber.ancestors.get_through_model(),
-          cmodels.Position, Flag]
+          cmodels.Position, Flag, Statistic, Checkpoint, Job, Refresh]
 
 
 @command
@@ -45,3 +48,38 @@ def truncate(*names, force=False, **kwargs):
             continue
         model.delete().execute()
         reporter.notice('Truncated', name)
+
+
+@command
+def reindex(**kwargs):
+    """Add missing search fields, cached centers and their indexes to an
+    existing database, and compute them for existing resources."""
+    for model in [cmodels.Municipality, cmodels.PostCode, cmodels.Group]:
+        if model.add_column(model.normalized):
+            reporter.notice('Added column',
+                            '{}.normalized'.format(model.__name__))
+        model.create_indexes()
+        qs = model.raw_select().where(model.normalized.is_null())
+        for instance in qs.iterator():
+            # Do not create a new version for this.
+            model.update(normalized=instance.compute_normalized()).where(
+                model.pk == instance.pk).execute()
+        reporter.notice('Reindexed', model.__name__)
+    if cmodels.HouseNumber.add_column(cmodels.HouseNumber.center):
+        reporter.notice('Added column', 'HouseNumber.center')
+    cmodels.HouseNumber.create_indexes()
+    cmodels.Position.create_indexes()
+    # Replaced by the partial index on active positions.
+    cmodels.Position._meta.database.execute_sql(
+        'DROP INDEX IF EXISTS {}_center'.format(
+            cmodels.Position._meta.db_table))
+    cmodels.HouseNumber.update_centers()
+    reporter.notice('Reindexed', 'HouseNumber centers')
+
+
+@command
+def stats(**kwargs):
+    """Recompute resources statistics from scratch (eg. after a bulk import
+    or on an existing database)."""
+    rebuild()
+    reporter.notice('Rebuilt', 'statistics')
@@ -19,3 +19,27 @@ def resources(path, **kwargs):
             for data in resource.select().serialize({'*': {}}):
                 f.write(dumps(data) + '\n')
                 reporter.notice(resource.__name__, data)
+
+
+@command
+def openapi(path=None, **kwargs):
+    """Build the OpenAPI schema artifact loaded by the API at first call.
+
+    path    path of file where to write the schema (defaults to OPENAPI_PATH)
+    """
+    from ban.http.api import app
+    path = app._schema.dump(path)
+    reporter.notice('Written OpenAPI schema', str(path))
+
+
+@command
+def autocomplete(path, **kwargs):
+    """Write a snapshot of the autocomplete index, for faster API startup
+    (see AUTOCOMPLETE_SNAPSHOT).
+
+    path    path of file where to write the snapshot
+    """
+    from ban.core.autocomplete import index
+    index.build()
+    index.dump(path)
+    reporter.notice('Written autocomplete snapshot', path)
@@ -1,21 +1,31 @@
+import codecs
 import csv
 from datetime import timedelta
 import getpass
-from itertools import repeat
+from itertools import chain
 import os
 import pkgutil
 import sys
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import (ALL_COMPLETED, FIRST_COMPLETED, Future,
+                                ProcessPoolExecutor, ThreadPoolExecutor, wait)
 from importlib import import_module
+from multiprocessing.util import Finalize
 from pathlib import Path
+from queue import Full, Queue
 
 import decorator
+import peewee
 from progressist import ProgressBar
 
 from ban.auth.models import Session, User
-from ban.commands.reporter import Reporter
-from ban.core import context, config
-from ban.core.versioning import Diff
+from ban.commands import lookups
+from ban.commands.reporter import ERROR, NOTICE, Reporter
+from ban.core import context, config, stats
+from ban.core.models import HouseNumber, Municipality
+from ban.core.versioning import Diff, Refresh
 
 
 def load_commands():
@@ -28,21 +38,66 @@ def load_commands():
         import_module(modname, package=commands.__name__)
 
 
+class LineReader:
+    """Stream lines of a file, keeping track of how much has been read.
+
+    `size` (when known) and `done` are in bytes for paths, in characters
+    for already opened text files."""
+
+    def __init__(self, path_or_file, encoding='utf-8'):
+        self.size = None
+        self.done = 0
+        if isinstance(path_or_file, (str, Path)):
+            path = Path(path_or_file)
+            if not path.exists():
+                abort('Path does not exist: {}'.format(path))
+            self.size = path.stat().st_size
+            path_or_file = path.open('rb')
+        self.file = path_or_file
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+
+    def lines(self):
+        for line in self.file:
+            self.done += len(line)
+            if isinstance(line, bytes):
+                line = self.decoder.decode(line)
+            yield line
+
+    def __iter__(self):
+        try:
+            yield from self.lines()
+        finally:
+            self.file.close()
+
+
+class CSVReader(LineReader):
+    """Stream rows of a CSV file as dicts, sniffing the dialect from the
+    first block only."""
+
+    SNIFF_SIZE = 4096
+
+    def __iter__(self):
+        lines = self.lines()
+        extract = []
+        for line in lines:
+            extract.append(line)
+            if sum(len(l) for l in extract) >= self.SNIFF_SIZE:
+                break
+        if extract:
+            # Text files may have been opened without utf-8-sig.
+            extract[0] = extract[0].lstrip('\ufeff')
+        try:
+            dialect = csv.Sniffer().sniff(''.join(extract))
+        except csv.Error:
+            dialect = csv.unix_dialect()
+        try:
+            yield from csv.DictReader(chain(extract, lines), dialect=dialect)
+        finally:
+            self.file.close()
+
+
 def load_csv(path_or_file, encoding='utf-8'):
-    if isinstance(path_or_file, (str, Path)):
-        path = Path(path_or_file)
-        if not path.exists():
-            abort('Path does not exist: {}'.format(path))
-        path_or_file = path.open(encoding=encoding)
-    extract = path_or_file.read(4096)
-    try:
-        dialect = csv.Sniffer().sniff(extract)
-    except csv.Error:
-        dialect = csv.unix_dialect()
-    path_or_file.seek(0)
-    content = path_or_file.read()
-    path_or_file.close()
-    return csv.DictReader(content.splitlines(), dialect=dialect)
+    return CSVReader(path_or_file, encoding=encoding)
 
 
 def iter_file(path, formatter=lambda x: x):
@@ -64,47 +119,331 @@ class Bar(ProgressBar):
                 '| ETA: {eta} | {elapsed}')
 
 
-def collect_report(func, *args, **kwargs):
+def chunks(iterable, size):
+    """Group non empty items of iterable in lists of size items."""
+    chunk = []
+    for item in iterable:
+        if not item:
+            continue
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Worker:
+    """State of a batch worker (thread or process), set up before its first
+    chunk: a database connection of its own, one import session and warm
+    lookups."""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.database = Diff._meta.database
+        self.connection = None
+
+    @classmethod
+    def current(cls, threads=None):
+        """Worker of the current thread or process, set up if needed.
+
+        threads: list to register thread workers into, for the caller to
+        tear them down; None for process workers, which tear down on
+        exit."""
+        worker = context.get('worker')
+        if worker is None or worker.pid != os.getpid():
+            worker = cls()
+            worker.setup(threads)
+            context.set('worker', worker)
+        return worker
+
+    def setup(self, threads=None):
+        local = self.database._local
+        if threads is None:
+            if not local.closed:
+                # Forked along with the parent process: closing it would
+                # also close it for the parent, so only forget about it.
+                INHERITED.append(local.conn)
+                local.conn = None
+                local.closed = True
+                local.transactions = []
+                local.context_stack = []
+            Finalize(self, self.teardown, exitpriority=10)
+        else:
+            threads.append(self)
+        self.connection = self.database.get_conn()
+        context.set('session', None)
+        get_session()
+        self.lookups = lookups.Lookups()
+        self.lookups.warm()
+        context.set('lookups', self.lookups)
+
+    def teardown(self):
+        self.lookups = None
+        if self.connection and not self.connection.closed:
+            self.connection.close()
+
+
+# Connections inherited by forked workers, kept alive until they exit.
+INHERITED = []
+# Partitions of batch items, spread over the workers: their number does
+# not depend on the workers, for journals to be resumed with others.
+PARTITIONS = 64
+
+
+def process_chunk(func, chunk, verbosity=None, threads=None, preload=None,
+                  checkpoint=None, nodiff=False):
+    """Run func on each item of chunk within one transaction, with one
+    savepoint per item, and return the reports of the chunk.
+
+    preload: optional callable given the chunk, to fill the worker lookups
+    before processing it.
+    checkpoint: optional (journal, index, parts) to record the chunk as
+    committed along with its transaction.
+    nodiff: whether the caller runs within `nodiff`."""
+    worker = Worker.current(threads)
+    context.set('nodiff', nodiff)
+    worker.lookups.clear()
     # This is a process reporter instance.
     reporter = context.get('reporter')
     if not reporter:
         # In thread mode, reporter is not shared with subthreads.
-        reporter = Reporter(config.get('VERBOSE'))
+        reporter = Reporter(verbosity)
         context.set('reporter', reporter)
-    func(*args, **kwargs)
+    database = Diff._meta.database
+    # Housenumber centers are updated once for the chunk.
+    with database.atomic(), HouseNumber.defer_centers():
+        if preload:
+            preload(chunk)
+        for item in chunk:
+            try:
+                with database.atomic():
+                    func(item)
+            except peewee.DatabaseError as e:
+                # Only this item has been rolled back, go on with the chunk.
+                reporter('Database error', (str(e), item), ERROR)
+                # Cached instances may not match the database anymore.
+                worker.lookups.clear()
+        if checkpoint:
+            journal, index, parts = checkpoint
+            journal.commit(index, parts)
     reports = reporter._reports.copy()
     reporter.clear()
     return reports
 
 
-def batch(func, iterable, chunksize=1000, total=None, progress=True):
+def parse_chunk(parse, chunk):
+    """Parse the raw items of chunk, skipping empty ones."""
+    return [item for item in map(parse, chunk) if item]
+
+
+def pipeline(iterable, chunksize, depth, parse=None, done=None, skip=(),
+             parsers=0):
+    """Yield (index, chunk, progress) for the chunks of iterable, read and
+    parsed ahead of the caller by at most depth chunks per stage.
+
+    Chunks are read, and parsed with parse unless parsers processes are
+    asked for, by a thread. Chunks whose index is in skip are yielded
+    unparsed. progress is the value of done once the chunk has been
+    read."""
+    queue = Queue(depth)
+    inline = parse if not parsers else None
+    # Set once the caller is gone, for the reader to stop.
+    stop = threading.Event()
+
+    def put(item):
+        # Do not block forever on a full queue nobody reads anymore.
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def read():
+        try:
+            for index, chunk in enumerate(chunks(iterable, chunksize)):
+                if inline and index not in skip:
+                    chunk = parse_chunk(inline, chunk)
+                if not put((index, chunk, done() if done else None)):
+                    return
+        except BaseException as e:
+            put(e)
+        put(None)
+
+    def received():
+        for item in iter(queue.get, None):
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def resolve(item):
+        index, chunk, progress = item
+        if isinstance(chunk, Future):
+            chunk = chunk.result()
+        return index, chunk, progress
+
+    threading.Thread(target=read, daemon=True).start()
+    try:
+        if inline or not parse:
+            yield from received()
+            return
+        with ProcessPoolExecutor(max_workers=parsers) as executor:
+            ahead = deque()
+            for index, chunk, progress in received():
+                if index not in skip:
+                    chunk = executor.submit(parse_chunk, parse, chunk)
+                ahead.append((index, chunk, progress))
+                if len(ahead) > depth:
+                    yield resolve(ahead.popleft())
+            while ahead:
+                yield resolve(ahead.popleft())
+    finally:
+        # Eg. the caller failed or stopped before the end.
+        stop.set()
+
+
+def partition_of(key):
+    """Stable partition of a key (eg. an INSEE code), None included."""
+    return zlib.crc32((key or '').encode()) % PARTITIONS
+
+
+def split(index, chunk, partition, lanes, skip=(), keys=None):
+    """Split chunk items by lane of their partition, keeping their order
+    and leaving out the (index, partition) in skip.
+
+    keys: optional set to add the keys of the items to, skipped ones
+    included.
+
+    Return {lane: ({partition: number of items}, items)}."""
+    result = {}
+    for item in chunk:
+        key = partition(item)
+        if keys is not None:
+            keys.add(key)
+        part = partition_of(key)
+        if (index, part) in skip:
+            continue
+        parts, items = result.setdefault(part % lanes, ({}, []))
+        parts[part] = parts.get(part, 0) + 1
+        items.append(item)
+    return result
+
+
+def batch(func, iterable, chunksize=1000, total=None, progress=True,
+          done=None, preload=None, journal=None, resume=False, parse=None,
+          partition=None, workers=None):
+    # progress: whether to show a progress bar, or a callable taking the
+    # same step and done arguments as the bar, eg. to save it elsewhere.
+    # done: optional callable returning the progress in the same unit as
+    # total (eg. bytes read), instead of counting items.
+    # preload: optional callable to fill lookups for a chunk, see
+    # process_chunk.
+    # journal: optional checkpoints.Journal recording committed chunks;
+    # with resume, the chunks committed by a previous run are skipped.
+    # parse: optional callable turning raw items (eg. lines) into the ones
+    # given to func, run in PARSERS processes if set, see pipeline.
+    # partition: optional callable returning the key of an item (eg. its
+    # INSEE code). Items of the same key are then processed in order, by
+    # one worker at a time, while other keys run in parallel.
+    # workers: number of workers, WORKERS setting by default.
+    # Return the keys of the items when partitioned, eg. the INSEE codes of
+    # the municipalities an import touched.
     # This is the main reporter instance.
     reporter = context.get('reporter')
+    nodiff = bool(context.get('nodiff'))
     pool = (ProcessPoolExecutor if config.get('BATCH_EXECUTOR') == 'process'
             else ThreadPoolExecutor)
-    bar = Bar(total=total, throttle=timedelta(seconds=1))
-    workers = int(config.get('WORKERS', os.cpu_count()))
-    chunk = []
-    count = 0
+    if callable(progress):
+        bar = progress
+    else:
+        bar = Bar(total=total, throttle=timedelta(seconds=1))
+    workers = workers or int(config.get('WORKERS', os.cpu_count()))
+    parsers = int(config.get('PARSERS') or 0)
+    # future: (lane, size, progress) of its chunk.
+    pending = {}
+    # lane: chunks waiting for the previous one of the lane to complete.
+    waiting = {}
+    # Chunks complete out of order, only show the furthest progress.
+    furthest = [0]
+    # Thread workers, to be torn down once done.
+    threads = [] if pool is ThreadPoolExecutor else None
+    skip = journal.start(resume) if journal else set()
+    keys = set() if partition else None
+    if skip:
+        reporter('Resuming, skipped committed chunks', len(skip), NOTICE)
 
-    def loop():
-        for reports in executor.map(collect_report, repeat(func), chunk):
-            reporter.merge(reports)
-            if progress:
-                bar()
+    def advance(size, position):
+        if progress:
+            if done:
+                furthest[0] = max(furthest[0], position)
+                bar(step=0, done=furthest[0])
+            else:
+                bar(step=size)
 
-    with pool(max_workers=workers) as executor:
+    def submit(lane, index, parts, chunk, position):
+        checkpoint = (journal, index, parts) if journal else None
+        future = executor.submit(process_chunk, func, chunk,
+                                 reporter.verbosity, threads, preload,
+                                 checkpoint, nodiff)
+        pending[future] = (lane, len(chunk), position)
 
-        for item in iterable:
-            if not item:
-                continue
-            chunk.append(item)
-            count += 1
-            if count % 10000 == 0:
-                loop()
-                chunk = []
-        if chunk:
-            loop()
+    def schedule(lane):
+        running = any(l == lane for l, _, _ in pending.values())
+        if not running and waiting.get(lane):
+            submit(lane, *waiting[lane].popleft())
+
+    def collect(return_when):
+        finished, _ = wait(pending, return_when=return_when)
+        for future in finished:
+            lane, size, position = pending.pop(future)
+            reporter.merge(future.result())
+            advance(size, position)
+            if lane is not None:
+                schedule(lane)
+
+    def queued():
+        return len(pending) + sum(len(chunks) for chunks in waiting.values())
+
+    # Partitioned chunks are only known to be committed once parsed.
+    unparsed = () if partition else {index for index, part in skip}
+    feed = pipeline(iterable, chunksize, workers * 2, parse=parse, done=done,
+                    skip=unparsed, parsers=parsers)
+    try:
+        with pool(max_workers=workers) as executor:
+            for index, chunk, position in feed:
+                if not partition:
+                    if (index, 0) in skip:
+                        advance(len(chunk), position)
+                    else:
+                        submit(None, index, {0: len(chunk)}, chunk, position)
+                else:
+                    lanes = split(index, chunk, partition, workers, skip,
+                                  keys)
+                    left = sum(len(items) for _, items in lanes.values())
+                    if left < len(chunk):
+                        advance(len(chunk) - left, position)
+                    for lane, (parts, items) in lanes.items():
+                        waiting.setdefault(lane, deque()).append(
+                            (index, parts, items, position))
+                        schedule(lane)
+                # Keep workers busy, without reading the whole input ahead.
+                while queued() >= workers * 2:
+                    collect(FIRST_COMPLETED)
+            while pending:
+                # Completed chunks may schedule waiting ones.
+                collect(ALL_COMPLETED)
+    finally:
+        # Stop reading ahead, and release the worker connections, even when
+        # a chunk failed or a job was cancelled.
+        feed.close()
+        for worker in threads or []:
+            worker.teardown()
+    if journal:
+        # All chunks are committed, nothing left to resume.
+        journal.clear()
+    return keys
 
 
 def prompt(text, default=..., confirmation=False, coerce=None, hidden=False):
@@ -172,8 +511,7 @@ def confirm(text, default=None):
             return default
 
 
-@decorator.decorator
-def session(func, *args, **kwargs):
+def get_session():
     session = context.get('session')
     if not session:
         qs = User.select().where(User.is_staff == True)
@@ -186,15 +524,42 @@ def session(func, *args, **kwargs):
             abort('Admin user not found {}'.format(username or ''))
         session = Session.create(user=user)
         context.set('session', session)
+    return session
+
+
+@decorator.decorator
+def session(func, *args, **kwargs):
+    get_session()
     return func(*args, **kwargs)
 
 
 @decorator.decorator
 def nodiff(func, *args, **kwargs):
-    Diff.ACTIVE = False
-    res = func(*args, **kwargs)
-    Diff.ACTIVE = True
-    return res
+    # Within the current thread only, not to skip the diffs of eg. the other
+    # requests of the server; batch hands it down to its workers.
+    previous = context.get('nodiff')
+    context.set('nodiff', True)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        context.set('nodiff', previous)
+
+
+def imported(insees):
+    """Refresh what an import skipping diffs changed in the municipalities
+    of insees, falsy ones meaning unknown municipalities: their statistics,
+    and the caches of the API processes (see `versioning.Refresh`)."""
+    insees = set(insees or ())
+    if not insees:
+        return
+    municipalities = None
+    if all(insees):
+        municipalities = [pk for pk, in (
+            Municipality.raw_select(Municipality.pk)
+                        .where(Municipality.insee << list(insees))
+                        .tuples())]
+    stats.rebuild(municipalities)
+    Refresh.record(insees)
 
 
 def file_len(f):
@@ -1,40 +1,234 @@
 import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
 
 import peewee
 
 from ban.commands import command, reporter
+from ban.commands.reporter import Reporter
+from ban.core import config, context
 from ban.core.models import (Group, HouseNumber, Municipality, Position,
                              PostCode)
 from ban.utils import compute_cia
 
-from . import helpers
+from . import checkpoints, helpers, lookups
+from .bulk import ORDER, load as bulk_load
 
 __namespace__ = 'import'
+CHUNKSIZE = 100
+# Types whose resources rows of a type reference.
+DEPENDENCIES = {
+    'municipality': [],
+    'postcode': ['municipality'],
+    'group': ['municipality'],
+    'housenumber': ['group', 'postcode'],
+    'position': ['housenumber'],
+}
 
 
 @command
 @helpers.nodiff
-def init(*paths, limit=0, **kwargs):
+def init(*paths, limit=0, bulk=False, resume=False, **kwargs):
     """Initial import for real™.
 
-    paths   Paths to json files."""
-    for path in paths:
+    Files are imported once the files providing the types their rows need
+    are done (eg. positions after housenumbers), independent files
+    concurrently.
+
+    paths   Paths to json files, to directories of json files or to
+            manifests (.manifest files listing one path per line).
+    bulk    Load files with COPY and set-based SQL (creations only).
+    resume  Skip the chunks committed by a previous interrupted run."""
+    if bulk and resume:
+        helpers.abort('Bulk imports cannot be resumed, they are all or '
+                      'nothing per resource')
+    files = plan(expand(paths))
+    if bulk:
+        for path, _ in files:
+            print('Processing', path)
+            bulk_load(path, limit=limit)
+        return
+    insees = set()
+    if len(files) == 1:
+        path, _ = files[0]
         print('Processing', path)
-        rows = helpers.iter_file(path, formatter=json.loads)
-        if limit:
-            print('Running with limit', limit)
-            extract = []
-            for i, row in enumerate(rows):
-                if i >= limit:
-                    break
-                extract.append(row)
-            rows = extract
-            total = limit
+        insees |= process_file(path, limit=limit, resume=resume)
+    else:
+        main = context.get('reporter')
+        futures = OrderedDict()
+        # Concurrent files share the batch workers. Files are started in
+        # submission order, so the ones they wait for are already running.
+        total = int(config.get('WORKERS', os.cpu_count()))
+        concurrent = min(len(files), total)
+        workers = max(total // concurrent, 1)
+        with ThreadPoolExecutor(max_workers=concurrent) as executor:
+            for path, needs in files:
+                futures[path] = executor.submit(
+                    process_after, [futures[p] for p in needs], path, limit,
+                    resume, main.verbosity, workers,
+                    bool(context.get('nodiff')))
+        for future in futures.values():
+            reports, keys = future.result()
+            main.merge(reports)
+            insees |= keys
+    helpers.imported(insees)
+
+
+def expand(paths):
+    """Files of paths, directories and manifests being expanded. Manifest
+    paths are relative to the manifest."""
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from sorted(p for p in path.iterdir()
+                              if p.is_file() and not p.name.startswith('.'))
+        elif path.suffix == '.manifest':
+            with path.open() as f:
+                lines = [l.strip() for l in f]
+            yield from expand(path.parent / l for l in lines
+                              if l and not l.startswith('#'))
         else:
-            print('Computing file size')
-            total = sum(1 for line in helpers.iter_file(path))
-            print('Done computing file size')
-        helpers.batch(process_row, rows, chunksize=100, total=total)
+            yield path
+
+
+def file_types(path, sample=100):
+    """Types of the first rows of a file."""
+    path = Path(path)
+    if not path.exists():
+        helpers.abort('Path does not exist: {}'.format(path))
+    types = set()
+    with path.open() as f:
+        for line in islice(f, sample):
+            try:
+                row = parse_line(line)
+            except ValueError:
+                continue
+            if row and row.get('type') in ORDER:
+                types.add(row['type'])
+    return types
+
+
+def requirements(types):
+    """Types that must be imported before rows of types, recursively."""
+    needed = set()
+    for kind in types:
+        for dependency in DEPENDENCIES[kind]:
+            needed |= {dependency} | requirements([dependency])
+    return needed - set(types)
+
+
+def plan(paths):
+    """Sort paths by dependency, and return (path, paths it needs).
+
+    A file only needs files whose first type comes before its own, which
+    keeps files mixing types out of cycles."""
+    files = []
+    for path in paths:
+        types = file_types(path)
+        level = min((ORDER.index(kind) for kind in types), default=0)
+        files.append((level, path, types))
+    files.sort(key=lambda file: file[0])
+    result = []
+    for level, path, types in files:
+        needed = requirements(types)
+        result.append((path, [other for before, other, provided in files
+                              if before < level and provided & needed]))
+    return result
+
+
+def process_after(needs, path, limit, resume, verbosity, workers=None,
+                  nodiff=False):
+    """Import path, in a thread of its own, once the needed futures are
+    done. Return its reports and the INSEE codes of its rows.
+
+    nodiff: whether the caller runs within `helpers.nodiff`."""
+    for future in needs:
+        # Raise the error of the file we depend on, if any.
+        future.result()
+    reporter = Reporter(verbosity)
+    context.set('reporter', reporter)
+    context.set('nodiff', nodiff)
+    print('Processing', path)
+    # Bars of concurrent files would overwrite each other.
+    insees = process_file(path, limit=limit, resume=resume, progress=False,
+                          workers=workers)
+    print('Processed', path)
+    return reporter._reports, insees
+
+
+def process_file(path, limit=0, resume=False, progress=True, workers=None):
+    """Import the rows of path, and return their INSEE codes."""
+    reader = helpers.LineReader(path)
+    journal = checkpoints.Journal(path, CHUNKSIZE)
+    if limit:
+        print('Running with limit', limit)
+        return helpers.batch(process_row, islice(reader, limit), total=limit,
+                             chunksize=CHUNKSIZE, progress=progress,
+                             preload=preload, journal=journal, resume=resume,
+                             parse=parse_line, partition=partition,
+                             workers=workers)
+    # Lines are streamed, progress is based on bytes read.
+    return helpers.batch(process_row, reader, total=reader.size,
+                         done=lambda: reader.done, chunksize=CHUNKSIZE,
+                         progress=progress, preload=preload, journal=journal,
+                         resume=resume, parse=parse_line, partition=partition,
+                         workers=workers)
+
+
+def parse_line(line):
+    """Row of a line, None for blank ones."""
+    return json.loads(line) if line.strip() else None
+
+
+def partition(row):
+    """INSEE code of the municipality of the row, if any, for rows of a
+    municipality to be processed in order."""
+    insee = row.get('municipality:insee') or row.get('insee')
+    if insee:
+        return insee
+    for key in ('group:fantoir', 'fantoir', 'housenumber:cia', 'cia'):
+        if row.get(key):
+            return row[key][:5]
+
+
+def preload(rows):
+    """Load at once the resources the rows of a chunk will look up."""
+    cache = lookups.get()
+    values = {}
+    housenumbers = []
+    for row in rows:
+        kind = row.get('type')
+        if kind == 'group':
+            for key in ('fantoir', 'ign', 'laposte'):
+                values.setdefault((Group, key), []).append(row.get(key))
+        elif kind == 'housenumber':
+            for key in ('cia', 'ign', 'laposte'):
+                values.setdefault((HouseNumber, key), []).append(row.get(key))
+            fantoir = row.get('group:fantoir')
+            insee = row.get('municipality:insee') or (fantoir or '')[:5]
+            if insee and insee not in cache.loaded:
+                cache.load_groups(insee)
+            housenumbers.append(row)
+        elif kind == 'position':
+            values.setdefault((HouseNumber, 'cia'), []).append(
+                (row.get('housenumber:cia') or '').upper())
+            values.setdefault((HouseNumber, 'ign'), []).append(
+                row.get('housenumber:ign'))
+            values.setdefault((Position, 'ign'), []).append(row.get('ign'))
+    for (model, identifier), items in values.items():
+        cache.load(model, identifier, items)
+    # Their housenumbers, to tell duplicates.
+    groups = []
+    for row in housenumbers:
+        for identifier in ('fantoir', 'ign', 'laposte'):
+            value = row.get('group:{}'.format(identifier))
+            key = cache.key(Group, identifier, value)
+            if key in cache.instances:
+                groups.append(cache.instances[key])
+                break
+    cache.load_housenumbers(groups)
 
 
 @helpers.session
@@ -59,7 +253,7 @@ def process_municipality(row):
     validator = Municipality.validator(**row)
     if validator.errors:
         return reporter.error('Municipality errors', validator.errors)
-    validator.save()
+    lookups.get().add_municipality(validator.save())
     reporter.notice('Imported Municipality', row['insee'])
 
 
@@ -80,7 +274,8 @@ def process_group(row):
     populate(keys, row, data)
     insee = row.get('municipality:insee')
     if insee:
-        data['municipality'] = 'insee:{}'.format(insee)
+        data['municipality'] = (lookups.get().municipality(insee) or
+                                'insee:{}'.format(insee))
     source = row.get('source')
     attributes = row.get('attributes', {})
     attributes['source'] = source
@@ -92,12 +287,13 @@ def process_group(row):
     ign = data.get('ign')
     fantoir = data.get('fantoir')
     laposte = data.get('laposte')
+    cache = lookups.get()
     if fantoir:
-        instance = Group.first(Group.fantoir == fantoir)
+        instance = cache.find(Group, 'fantoir', fantoir)
     elif ign:
-        instance = Group.first(Group.ign == ign)
+        instance = cache.find(Group, 'ign', ign)
     elif laposte:
-        instance = Group.first(Group.laposte == laposte)
+        instance = cache.find(Group, 'laposte', laposte)
     else:
         reporter.error('Missing group unique id', row)
         return
@@ -117,35 +313,37 @@ def process_group(row):
         reporter.error('Invalid group data', (validator.errors, row))
     else:
         try:
-            validator.save()
+            group = validator.save()
         except peewee.IntegrityError:
             reporter.error('Integrity Error', fantoir)
         else:
+            cache.add(group)
             msg = 'Group updated' if instance else 'Group created'
             reporter.notice(msg, fantoir)
 
 
 def process_postcode(row):
     insee = row['municipality:insee']
-    municipality = 'insee:{}'.format(insee)
+    municipality = (lookups.get().municipality(insee) or
+                    'insee:{}'.format(insee))
     attributes = {'source': row.pop('source')}
     name = row.get('name')
     code = row.get('postcode')
     data = dict(name=name, code=code, municipality=municipality,
                 version=1, attributes=attributes)
-    instance = PostCode.select().join(Municipality).where(
-        PostCode.code == code, Municipality.insee == insee).first()
+    instance = lookups.get().postcode(code, insee)
     if instance:
         return reporter.notice('PostCode already exists', code)
     validator = PostCode.validator(**data)
     if validator.errors:
         return reporter.error('PostCode errors', (validator.errors,
                                                   code, insee))
-    validator.save()
+    lookups.get().add_postcode(validator.save(), insee)
     reporter.notice('Imported PostCode', code)
 
 
 def process_housenumber(row):
+    cache = lookups.get()
     data = dict(version=1)
     keys = [('numero', 'number'), 'ordinal', 'ign', 'laposte', 'cia']
     populate(keys, row, data)
@@ -166,9 +364,7 @@ def process_housenumber(row):
     # Only override if key is present (even if value is null).
     if 'postcode:code' in row:
         code = row.get('postcode:code')
-        postcode = PostCode.select().join(Municipality).where(
-            PostCode.code == code,
-            Municipality.insee == insee).first()
+        postcode = cache.postcode(code, insee)
         if not postcode:
             reporter.error('HouseNumber postcode not found', (cia, code))
         else:
@@ -178,16 +374,17 @@ def process_housenumber(row):
     group_laposte = row.get('group:laposte')
     parent = None
     if fantoir:
-        parent = 'fantoir:{}'.format(fantoir)
+        parent = ('fantoir', fantoir)
     elif group_ign:
-        parent = 'ign:{}'.format(group_ign)
+        parent = ('ign', group_ign)
     elif group_laposte:
-        parent = 'laposte:{}'.format(group_laposte)
+        parent = ('laposte', group_laposte)
     if parent:
         try:
-            parent = Group.coerce(parent)
+            parent = cache.group(*parent, insee=insee)
         except Group.DoesNotExist:
-            reporter.error('Parent given but not found', parent)
+            reporter.error('Parent given but not found',
+                           '{}:{}'.format(*parent))
             parent = None
         else:
             data['parent'] = parent
@@ -197,27 +394,25 @@ def process_housenumber(row):
     ign = data.get('ign')
     laposte = data.get('laposte')
     if cia:
-        instance = HouseNumber.first(HouseNumber.cia == cia)
+        instance = cache.find(HouseNumber, 'cia', cia)
         if instance and compute_cia:
             if cia != computed_cia:
                 # Means new values are changing one of the four values of the
                 # cia (insee, fantoir, number, ordinal). Make sure we are not
                 # creating a duplicate.
-                duplicate = HouseNumber.first(HouseNumber.cia == computed_cia)
+                duplicate = cache.find(HouseNumber, 'cia', computed_cia)
                 if duplicate:
                     msg = 'Duplicate CIA'
                     reporter.error(msg, (cia, computed_cia))
                     return
     elif ign:
-        instance = HouseNumber.first(HouseNumber.ign == ign)
+        instance = cache.find(HouseNumber, 'ign', ign)
     elif laposte:
-        instance = HouseNumber.first(HouseNumber.laposte == laposte)
+        instance = cache.find(HouseNumber, 'laposte', laposte)
     if parent and not instance:
         # Data is not coerced yet, we want None for empty strings.
         ordinal = data.get('ordinal') or None
-        instance = HouseNumber.first(HouseNumber.parent == parent,
-                                     HouseNumber.number == data['number'],
-                                     HouseNumber.ordinal == ordinal)
+        instance = cache.housenumber(parent, data['number'], ordinal)
     if instance:
         attributes = getattr(instance, 'attributes') or {}
         if attributes.get('source') == source:
@@ -238,15 +433,17 @@ def process_housenumber(row):
         return
     with HouseNumber._meta.database.atomic():
         try:
-            validator.save()
+            housenumber = validator.save()
         except peewee.IntegrityError as e:
             reporter.warning('HouseNumber DB error', (data, str(e)))
         else:
+            cache.add(housenumber)
             msg = 'HouseNumber Updated' if instance else 'HouseNumber created'
             reporter.notice(msg, data)
 
 
 def process_position(row):
+    cache = lookups.get()
     positioning = row.get('positionning')  # two "n" in the data.
     if not positioning or not hasattr(Position, positioning.upper()):
         positioning = Position.OTHER
@@ -256,9 +453,9 @@ def process_position(row):
     housenumber = None
     if cia:
         cia = cia.upper()
-        housenumber = HouseNumber.first(HouseNumber.cia == cia)
+        housenumber = cache.find(HouseNumber, 'cia', cia)
     elif housenumber_ign:
-        housenumber = HouseNumber.first(HouseNumber.ign == housenumber_ign)
+        housenumber = cache.find(HouseNumber, 'ign', housenumber_ign)
     if not housenumber:
         reporter.error('Unable to find parent housenumber', row)
         return
@@ -266,7 +463,7 @@ def process_position(row):
     if 'ign' in row:
         # The only situation where we want to avoid creating new position is
         # when we have the ign identifier.
-        instance = Position.first(Position.ign == row['ign'])
+        instance = cache.find(Position, 'ign', row['ign'])
     version = instance.version + 1 if instance else 1
     data = dict(source=source, housenumber=housenumber,
                 positioning=positioning, version=version)
@@ -289,5 +486,6 @@ def process_position(row):
         except peewee.IntegrityError as e:
             reporter.error('Integrity error', (str(e), data))
         else:
+            cache.add(position)
             msg = 'Position updated' if instance else 'Position created'
             reporter.notice(msg, position.id)
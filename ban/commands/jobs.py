@@ -0,0 +1,183 @@
+"""Import jobs, run by a pool of background threads of the HTTP server
+instead of within the request, eg. for BAL files posted to /import/bal.
+
+Jobs are run by the process they were queued in: a job left queued or
+running by a process that stopped will not be resumed.
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from ban import db
+from ban.auth.models import Session
+from ban.core import config, context
+from ban.core.encoder import dumps
+from ban.utils import utcnow
+
+from . import bal, checkpoints, helpers
+from .reporter import Reporter
+
+
+def import_bal(path, progress):
+    helpers.imported(bal.process_file(path, progress=progress))
+
+
+# kind: callable importing a path, given a helpers.batch progress callable.
+KINDS = {
+    'bal': import_bal,
+}
+
+
+class Cancelled(Exception):
+    """Raised within a running job once it has been cancelled."""
+
+
+class Job(db.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    FINISHED = (DONE, FAILED, CANCELLED)
+
+    kind = db.CharField(max_length=16)
+    path = db.TextField()
+    status = db.CharField(max_length=16, default=QUEUED)
+    # Asked by the user, the job stops at its next progress update.
+    cancelled = db.BooleanField(default=False)
+    # In bytes.
+    size = db.IntegerField(null=True)
+    done = db.IntegerField(default=0)
+    report = db.BinaryJSONField(null=True)
+    error = db.TextField(null=True)
+    session = db.ForeignKeyField(Session, null=True)
+    created_at = db.DateTimeField(default=utcnow)
+    started_at = db.DateTimeField(null=True)
+    finished_at = db.DateTimeField(null=True)
+
+    def serialize(self):
+        progress = None
+        if self.size:
+            progress = round(min(self.done / self.size, 1) * 100, 1)
+        return {
+            'id': self.pk,
+            'kind': self.kind,
+            'status': self.status,
+            'size': self.size,
+            'done': self.done,
+            'progress': progress,
+            'counts': counts(self.report),
+            'report': self.report,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+    def cancel(self):
+        """Cancel a queued job right away, ask a running one to stop."""
+        Job.update(cancelled=True).where(Job.pk == self.pk).execute()
+        Job.update(status=Job.CANCELLED, finished_at=utcnow()).where(
+            Job.pk == self.pk, Job.status == Job.QUEUED).execute()
+
+
+def counts(report):
+    """Number of reported items by level, from a reporter JSON."""
+    return {level: sum(item['total'] for item in items)
+            for level, items in (report or {}).items()}
+
+
+def serialize_report(reporter):
+    return json.loads(dumps(reporter))
+
+
+class Progress:
+    """helpers.batch progress callable saving the progress and report of a
+    job, at most every interval seconds, and stopping it once cancelled."""
+
+    def __init__(self, pk, reporter, interval=1):
+        self.pk = pk
+        self.reporter = reporter
+        self.interval = interval
+        self.done = 0
+        self.last = None
+
+    def __call__(self, step=0, done=None):
+        self.done = self.done + step if done is None else done
+        now = time.monotonic()
+        if self.last is not None and now - self.last < self.interval:
+            return
+        self.last = now
+        Job.update(done=self.done,
+                   report=serialize_report(self.reporter)).where(
+            Job.pk == self.pk).execute()
+        cancelled = (Job.select(Job.cancelled).where(Job.pk == self.pk)
+                        .scalar())
+        if cancelled:
+            raise Cancelled
+
+
+def run(pk):
+    """Run the job of pk, unless it has been cancelled meanwhile."""
+    database = Job._meta.database
+    job = Job.get(Job.pk == pk)
+    try:
+        started = Job.update(status=Job.RUNNING, started_at=utcnow()).where(
+            Job.pk == pk, Job.status == Job.QUEUED).execute()
+        if not started:
+            return
+        reporter = Reporter(config.get('VERBOSE'))
+        context.set('reporter', reporter)
+        context.set('session', job.session)
+        progress = Progress(pk, reporter)
+        status, error, done = Job.DONE, None, job.size or progress.done
+        try:
+            helpers.nodiff(KINDS[job.kind])(job.path, progress)
+        except Cancelled:
+            status, done = Job.CANCELLED, progress.done
+        except (Exception, SystemExit) as e:
+            # helpers.abort exits.
+            status, done = Job.FAILED, progress.done
+            error = str(e) or e.__class__.__name__
+        Job.update(status=status, error=error, done=done,
+                   report=serialize_report(reporter),
+                   finished_at=utcnow()).where(Job.pk == pk).execute()
+    finally:
+        context.set('reporter', None)
+        context.set('session', None)
+        if os.path.exists(job.path):
+            # Failed and cancelled jobs cannot be resumed without it.
+            checkpoints.forget(job.path)
+            os.remove(job.path)
+        database.close()
+
+
+class Runner:
+    """Run jobs in JOB_WORKERS background threads (1 by default)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._futures = []
+
+    @property
+    def size(self):
+        return int(config.get('JOB_WORKERS', 1))
+
+    def submit(self, job):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.size)
+            self._futures = [f for f in self._futures if not f.done()]
+            self._futures.append(self._executor.submit(run, job.pk))
+
+    def join(self):
+        """Wait for the submitted jobs to finish."""
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+
+
+runner = Runner()
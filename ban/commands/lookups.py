@@ -0,0 +1,230 @@
+"""Import scoped caches of the resources row processors look up by their
+identifiers.
+
+Each batch worker has its own `Lookups`, see `helpers.Worker`. Out of a
+worker, `get` returns an empty one, so nothing is cached between calls.
+"""
+import threading
+
+import peewee
+
+from ban.core import context
+from ban.core.models import (Group, HouseNumber, Municipality, Position,
+                             PostCode)
+
+# Tables loaded by `Lookups.warm`, shared by the workers of the process:
+# (state, municipalities, postcodes).
+_warm = None
+_warm_lock = threading.Lock()
+
+
+def get():
+    """Lookups of the current worker, or a new empty one."""
+    return context.get('lookups') or Lookups()
+
+
+def state(model):
+    """Changes whenever rows of model are added, changed or deleted."""
+    return (model.raw_select(peewee.fn.COUNT(model.pk),
+                             peewee.fn.MAX(model.modified_at))
+                 .order_by().scalar(as_tuple=True))
+
+
+class Lookups:
+    """Model instances by identifier.
+
+    Municipalities and postcodes are kept for the whole import. Other
+    resources are cleared before each chunk, which preloads the ones it
+    needs with `load`, and added as rows create them."""
+
+    def __init__(self):
+        # insee: instance
+        self.municipalities = {}
+        # (code, insee): instance
+        self.postcodes = {}
+        self.clear()
+
+    def clear(self):
+        # (model, identifier, value): instance
+        self.instances = {}
+        # Keys preloaded with `load`: missing ones do not exist.
+        self.known = set()
+        # insee of the municipalities whose groups are loaded.
+        self.loaded = set()
+        # housenumber pk: [position, …]
+        self._positions = {}
+        # pk of the groups whose housenumbers are loaded.
+        self.numbered = set()
+        # (group pk, number, ordinal): housenumber
+        self._numbers = {}
+
+    def warm(self):
+        """Preload municipalities and postcodes, which are small tables,
+        loaded again by the process only when they changed."""
+        global _warm
+        with _warm_lock:
+            current = (state(Municipality), state(PostCode))
+            if _warm is None or _warm[0] != current:
+                municipalities = {m.insee: m for m
+                                  in Municipality.select().iterator()}
+                postcodes = {}
+                rows = (PostCode.select(PostCode, Municipality)
+                                .join(Municipality).iterator())
+                for postcode in rows:
+                    key = (postcode.code, postcode.municipality.insee)
+                    postcodes[key] = postcode
+                _warm = current, municipalities, postcodes
+            _, municipalities, postcodes = _warm
+        # Rows add their own.
+        self.municipalities = dict(municipalities)
+        self.postcodes = dict(postcodes)
+
+    def municipality(self, insee):
+        if insee not in self.municipalities:
+            instance = Municipality.first(Municipality.insee == insee)
+            if not instance:
+                return None
+            self.municipalities[insee] = instance
+        return self.municipalities[insee]
+
+    def add_municipality(self, municipality):
+        self.municipalities[municipality.insee] = municipality
+
+    def postcode(self, code, insee):
+        key = (code, insee)
+        if key not in self.postcodes:
+            instance = (PostCode.select().join(Municipality)
+                                .where(PostCode.code == code,
+                                       Municipality.insee == insee).first())
+            if not instance:
+                return None
+            self.postcodes[key] = instance
+        return self.postcodes[key]
+
+    def add_postcode(self, postcode, insee):
+        self.postcodes[(postcode.code, insee)] = postcode
+
+    # Resources by identifier.
+
+    def key(self, model, identifier, value):
+        """Cache key of identifier value, normalized the way the database
+        stores it, or None if the value is invalid."""
+        if not value:
+            return None
+        try:
+            value = getattr(model, identifier).coerce(value)
+        except ValueError:
+            return None
+        return model, identifier, value
+
+    def add(self, instance):
+        """Cache instance under all of its identifiers."""
+        model = type(instance)
+        for identifier in model.identifiers + ['id']:
+            value = getattr(instance, identifier)
+            if value:
+                self.instances[(model, identifier, value)] = instance
+        if model is HouseNumber:
+            key = (instance._data['parent'], instance.number,
+                   instance.ordinal)
+            self._numbers[key] = instance
+        if model is Position:
+            positions = self._positions.get(instance._data['housenumber'])
+            if positions is not None and instance not in positions:
+                positions.append(instance)
+
+    def load(self, model, identifier, values):
+        """Cache the instances of model matching values, with one query."""
+        keys = {}
+        for value in values:
+            key = self.key(model, identifier, value)
+            if key and key not in self.instances and key not in self.known:
+                keys[key[2]] = key
+        if not keys:
+            return
+        field = getattr(model, identifier)
+        for instance in model.select().where(field << list(keys)).iterator():
+            self.add(instance)
+        self.known.update(keys.values())
+
+    def find(self, model, identifier, value):
+        """Same as `model.first(identifier == value)`."""
+        key = self.key(model, identifier, value)
+        if key in self.instances:
+            return self.instances[key]
+        if key in self.known:
+            return None
+        instance = model.first(getattr(model, identifier) == value)
+        if instance and key:
+            self.add(instance)
+        return instance
+
+    def load_groups(self, insee):
+        """Cache all groups of a municipality, with one query."""
+        self.loaded.add(insee)
+        groups = (Group.select().join(Municipality)
+                       .where(Municipality.insee == insee).iterator())
+        for group in groups:
+            self.add(group)
+
+    def group(self, identifier, value, insee=None):
+        """Same as `Group.coerce('identifier:value')`, raising
+        Group.DoesNotExist when not found.
+
+        insee: municipality of the group, if known, to load its groups at
+        once. FANTOIR values always tell it."""
+        key = self.key(Group, identifier, value)
+        if identifier == 'fantoir' and key:
+            insee = key[2][:5]
+        if key in self.instances:
+            return self.instances[key]
+        if insee and insee not in self.loaded:
+            self.load_groups(insee)
+            if key in self.instances:
+                return self.instances[key]
+        group = Group.coerce('{}:{}'.format(identifier, value))
+        self.add(group)
+        return group
+
+    def load_housenumbers(self, groups):
+        """Cache the housenumbers of groups, with one query."""
+        pks = {g.pk for g in groups} - self.numbered
+        if not pks:
+            return
+        self.numbered.update(pks)
+        housenumbers = (HouseNumber.select()
+                                   .where(HouseNumber.parent << list(pks))
+                                   .iterator())
+        for housenumber in housenumbers:
+            self.add(housenumber)
+
+    def housenumber(self, parent, number, ordinal=None):
+        """Same as `HouseNumber.first(parent, number, ordinal)`."""
+        if parent.pk not in self.numbered:
+            self.load_housenumbers([parent])
+        key = (parent.pk, number, ordinal)
+        instance = self._numbers.get(key)
+        # Its number may have changed since it was cached.
+        if instance and (instance._data['parent'], instance.number,
+                         instance.ordinal) == key:
+            return instance
+        return None
+
+    def load_positions(self, housenumbers):
+        """Cache the positions of housenumbers, with one query."""
+        pks = [h.pk for h in housenumbers if h.pk not in self._positions]
+        if not pks:
+            return
+        for pk in pks:
+            self._positions[pk] = []
+        positions = (Position.select()
+                             .where(Position.housenumber << pks)
+                             .order_by(Position.pk).iterator())
+        for position in positions:
+            self.add(position)
+
+    def positions(self, housenumber):
+        """Positions of housenumber, as `housenumber.positions`."""
+        if housenumber.pk not in self._positions:
+            self.load_positions([housenumber])
+        return self._positions[housenumber.pk]
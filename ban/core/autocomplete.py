@@ -0,0 +1,366 @@
+"""In-process prefix index of group names and housenumbers, for
+autocompletion.
+
+Built from the database or from a snapshot file, then kept fresh by
+consuming the Diff feed, and by reloading the municipalities changed by
+imports skipping diffs.
+"""
+import json
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+
+from ban.core import config
+from ban.utils import normalize
+
+from . import models, versioning
+from .search import parse
+
+MIN_WORD_LENGTH = 3
+# Above this count of municipalities to reload, the index is built again.
+MAX_RELOADS = 100
+
+
+def make_keys(name):
+    """Full normalized name, plus one key per following significant word, so
+    that "lilas" matches "rue des lilas"."""
+    words = normalize(name).split()
+    keys = [' '.join(words)] if words else []
+    for index, word in enumerate(words[1:], 1):
+        if len(word) >= MIN_WORD_LENGTH:
+            keys.append(' '.join(words[index:]))
+    return keys
+
+
+def number_key(number):
+    try:
+        return int(number), number
+    except (TypeError, ValueError):
+        return 0, number or ''
+
+
+class Keys:
+    """Sorted array of normalized keys, with a parallel array of ids."""
+
+    def __init__(self):
+        self.keys = []
+        self.ids = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, id):
+        index = bisect_left(self.keys, key)
+        self.keys.insert(index, key)
+        self.ids.insert(index, id)
+
+    def remove(self, key, id):
+        index = bisect_left(self.keys, key)
+        while index < len(self.keys) and self.keys[index] == key:
+            if self.ids[index] == id:
+                del self.keys[index]
+                del self.ids[index]
+                return
+            index += 1
+
+    def extend(self, items):
+        """Bulk load (key, id) items, faster than many `add`."""
+        items = sorted(list(zip(self.keys, self.ids)) + list(items))
+        self.keys = [k for k, i in items]
+        self.ids = [i for k, i in items]
+
+    def startswith(self, prefix):
+        """Yield ids of keys starting with prefix, in key order."""
+        index = bisect_left(self.keys, prefix)
+        while index < len(self.keys) and self.keys[index].startswith(prefix):
+            yield self.ids[index]
+            index += 1
+
+
+class AutocompleteIndex:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        # municipality id: insee
+        self.municipalities = {}
+        # group id: (name, insee)
+        self.groups = {}
+        # group id: {housenumber id: (number, ordinal)}
+        self.housenumbers = {}
+        # housenumber id: group id
+        self.parents = {}
+        self.keys = Keys()
+        self.by_insee = {}
+        self._diffs = None
+        self._refreshes = None
+        self._last_check = 0
+
+    @property
+    def loaded(self):
+        return self._diffs is not None
+
+    @property
+    def last_diff(self):
+        return self._diffs.last if self.loaded else None
+
+    @property
+    def refresh_interval(self):
+        return float(config.get('AUTOCOMPLETE_REFRESH_INTERVAL', 1))
+
+    # Building.
+
+    def index_group(self, id, name, insee):
+        self.groups[id] = (name, insee)
+        for key in make_keys(name):
+            self.keys.add(key, id)
+            self.by_insee.setdefault(insee, Keys()).add(key, id)
+
+    def unindex_group(self, id):
+        name, insee = self.groups.pop(id)
+        for key in make_keys(name):
+            self.keys.remove(key, id)
+            self.by_insee[insee].remove(key, id)
+
+    def load(self, municipalities, groups, housenumbers, diffs, refreshes):
+        """Bulk load rows, as given by `dump` or by the database, the feeds
+        starting where the rows were taken."""
+        with self._lock:
+            self.clear()
+            self.municipalities = dict(municipalities)
+            items = []
+            by_insee = {}
+            for id, name, insee in groups:
+                self.groups[id] = (name, insee)
+                for key in make_keys(name):
+                    items.append((key, id))
+                    by_insee.setdefault(insee, []).append((key, id))
+            self.keys.extend(items)
+            for insee, items in by_insee.items():
+                self.by_insee.setdefault(insee, Keys()).extend(items)
+            for id, group, number, ordinal in housenumbers:
+                self.housenumbers.setdefault(group, {})[id] = (number, ordinal)
+                self.parents[id] = group
+            self._diffs = diffs
+            self._refreshes = refreshes
+
+    def build(self):
+        """Load the index from the database."""
+        Municipality, Group = models.Municipality, models.Group
+        HouseNumber = models.HouseNumber
+        # Started before reading, so changes made meanwhile are applied again.
+        diffs = versioning.Feed(versioning.Diff)
+        diffs.start()
+        refreshes = versioning.Feed(versioning.Refresh)
+        refreshes.start()
+        municipalities = (Municipality.select(Municipality.id,
+                                              Municipality.insee)
+                                      .order_by().tuples().iterator())
+        groups = (Group.select(Group.id, Group.name, Municipality.insee)
+                       .join(Municipality)
+                       .order_by().tuples().iterator())
+        housenumbers = (HouseNumber.select(HouseNumber.id, Group.id,
+                                           HouseNumber.number,
+                                           HouseNumber.ordinal)
+                                   .join(Group)
+                                   .order_by().tuples().iterator())
+        self.load(municipalities, groups, housenumbers, diffs, refreshes)
+
+    def reload(self, insee):
+        """Load the groups and housenumbers of the municipality of insee
+        again from the database."""
+        Municipality, Group = models.Municipality, models.Group
+        HouseNumber = models.HouseNumber
+        with self._lock:
+            for id, (name, group_insee) in list(self.groups.items()):
+                if group_insee == insee:
+                    self.unindex_group(id)
+                    for housenumber in self.housenumbers.pop(id, {}):
+                        self.parents.pop(housenumber, None)
+            municipalities = (Municipality.select(Municipality.id)
+                                          .where(Municipality.insee == insee)
+                                          .tuples())
+            for id, in municipalities:
+                self.municipalities[id] = insee
+            groups = (Group.select(Group.id, Group.name)
+                           .join(Municipality)
+                           .where(Municipality.insee == insee)
+                           .order_by().tuples())
+            for id, name in groups:
+                self.index_group(id, name, insee)
+            housenumbers = (HouseNumber.select(HouseNumber.id, Group.id,
+                                               HouseNumber.number,
+                                               HouseNumber.ordinal)
+                                       .join(Group)
+                                       .join(Municipality)
+                                       .where(Municipality.insee == insee)
+                                       .order_by().tuples())
+            for id, group, number, ordinal in housenumbers:
+                self.housenumbers.setdefault(group, {})[id] = (number, ordinal)
+                self.parents[id] = group
+
+    def dump(self, path):
+        """Write a snapshot of the index, to be loaded by `load_snapshot`."""
+        with self._lock, Path(path).open('w', encoding='utf-8') as f:
+            json.dump({
+                'last_diff': self._diffs.last,
+                'seen_diffs': sorted(self._diffs.seen),
+                'last_refresh': self._refreshes.last,
+                'seen_refreshes': sorted(self._refreshes.seen),
+                'municipalities': list(self.municipalities.items()),
+                'groups': [(id, name, insee)
+                           for id, (name, insee) in self.groups.items()],
+                'housenumbers': [
+                    (id, group, number, ordinal)
+                    for group, items in self.housenumbers.items()
+                    for id, (number, ordinal) in items.items()],
+            }, f)
+
+    def load_snapshot(self, path):
+        with Path(path).open(encoding='utf-8') as f:
+            data = json.load(f)
+        diffs = versioning.Feed(versioning.Diff, data['last_diff'])
+        diffs.seen = set(data.get('seen_diffs', []))
+        # Older snapshots: refreshes are followed from first call.
+        refreshes = versioning.Feed(versioning.Refresh,
+                                    data.get('last_refresh'))
+        refreshes.seen = set(data.get('seen_refreshes', []))
+        self.load(data['municipalities'], data['groups'],
+                  data['housenumbers'], diffs, refreshes)
+
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+        with self._lock:
+            if self.loaded:
+                return
+            path = config.get('AUTOCOMPLETE_SNAPSHOT')
+            if path and Path(path).exists():
+                self.load_snapshot(path)
+            else:
+                self.build()
+        # Snapshot may be late.
+        self.refresh(force=True)
+
+    # Diff feed.
+
+    def refresh(self, force=False):
+        """Apply diffs created since last call, and reload municipalities
+        changed by imports skipping diffs."""
+        now = time.monotonic()
+        if not force and now - self._last_check < self.refresh_interval:
+            return
+        self._last_check = now
+        Diff, Version = versioning.Diff, versioning.Version
+        Refresh = versioning.Refresh
+        # Feeds are not thread safe.
+        with self._lock:
+            diffs = self._diffs.poll()
+            if diffs:
+                rows = (Version.select(Version.model_name, Version.data)
+                               .join(Diff, on=(Diff.new == Version.pk))
+                               .where(Diff.pk << diffs,
+                                      Version.model_name << [
+                                          'municipality', 'group',
+                                          'housenumber'])
+                               .order_by(Diff.pk)
+                               .tuples())
+                for model_name, data in rows:
+                    getattr(self, 'apply_{}'.format(model_name))(data)
+            refreshes = self._refreshes.poll()
+            if not refreshes:
+                return
+            insees = {insee for insee, in (Refresh.select(Refresh.insee)
+                                                  .where(Refresh.pk
+                                                         << refreshes)
+                                                  .tuples())}
+            if None in insees or len(insees) > MAX_RELOADS:
+                self.build()
+                return
+            for insee in insees:
+                self.reload(insee)
+
+    def apply_municipality(self, data):
+        # Municipality renaming is not reflected on its groups, but insee
+        # changes are.
+        old = self.municipalities.get(data['id'])
+        self.municipalities[data['id']] = data['insee']
+        if old and old != data['insee']:
+            for id, (name, insee) in list(self.groups.items()):
+                if insee == old:
+                    self.unindex_group(id)
+                    self.index_group(id, name, data['insee'])
+
+    def apply_group(self, data):
+        id = data['id']
+        if id in self.groups:
+            self.unindex_group(id)
+        if data.get('status') == 'deleted':
+            for housenumber in self.housenumbers.pop(id, {}):
+                self.parents.pop(housenumber, None)
+            return
+        insee = self.municipalities.get(data['municipality'])
+        self.index_group(id, data['name'], insee)
+
+    def apply_housenumber(self, data):
+        id = data['id']
+        parent = self.parents.pop(id, None)
+        if parent:
+            self.housenumbers.get(parent, {}).pop(id, None)
+        if data.get('status') != 'deleted':
+            self.housenumbers.setdefault(data['parent'], {})[id] = (
+                data.get('number'), data.get('ordinal'))
+            self.parents[id] = data['parent']
+
+    # Querying.
+
+    def search(self, q, insee=None, limit=10):
+        number, ordinal, text = parse(q)
+        if not text:
+            return []
+        # Diffs are applied in place by `refresh`, in another thread.
+        with self._lock:
+            return self._search(text, number, ordinal, insee, limit)
+
+    def _search(self, text, number, ordinal, insee, limit):
+        keys = self.by_insee.get(insee, Keys()) if insee else self.keys
+        results = []
+        seen = set()
+        for id in keys.startswith(text):
+            if len(results) >= limit:
+                break
+            if id in seen:
+                continue
+            seen.add(id)
+            name, group_insee = self.groups[id]
+            if not number:
+                results.append({'type': 'group', 'id': id, 'label': name,
+                                'insee': group_insee})
+                continue
+            for hn_id, hn_number, hn_ordinal in self.expand(id, number,
+                                                            ordinal):
+                label = ' '.join(filter(None, [hn_number, hn_ordinal, name]))
+                results.append({'type': 'housenumber', 'id': hn_id,
+                                'label': label, 'group': id,
+                                'insee': group_insee})
+        return results[:limit]
+
+    def expand(self, group, number, ordinal=None):
+        """Housenumbers of group matching number (and ordinal) prefixes."""
+        matches = []
+        with self._lock:
+            housenumbers = list(self.housenumbers.get(group, {}).items())
+        for id, (hn_number, hn_ordinal) in housenumbers:
+            if not (hn_number or '').startswith(number):
+                continue
+            if ordinal and not (hn_ordinal or '').lower().startswith(ordinal):
+                continue
+            matches.append((id, hn_number, hn_ordinal))
+        matches.sort(key=lambda m: (number_key(m[1]), m[2] or ''))
+        return matches
+
+
+index = AutocompleteIndex()
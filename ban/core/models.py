@@ -1,10 +1,12 @@
 import re
+from contextlib import contextmanager
 
 import peewee
 from unidecode import unidecode
 
 from ban import db
-from ban.utils import compute_cia
+from ban.utils import compute_cia, normalize
+from . import context
 from .versioning import Versioned, BaseVersioned
 from .resource import ResourceModel, BaseResource
 from .validators import VersionedResourceValidator
@@ -38,10 +40,19 @@ class Model(ResourceModel, Versioned, metaclass=BaseModel):
 class NamedModel(Model):
     name = db.CharField(max_length=200)
     alias = db.ArrayField(db.CharField, null=True)
+    # Not a resource field: computed from name and alias, for search.
+    normalized = db.SearchField()
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.normalized = self.compute_normalized()
+        return super().save(*args, **kwargs)
+
+    def compute_normalized(self):
+        return normalize(' '.join([self.name or ''] + (self.alias or [])))
+
 
 class Municipality(NamedModel):
     identifiers = ['siren', 'insee']
@@ -129,6 +140,9 @@ class HouseNumber(Model):
     ign = db.CharField(max_length=24, null=True, unique=True)
     ancestors = db.ManyToManyField(Group, related_name='_housenumbers')
     postcode = db.ForeignKeyField(PostCode, null=True)
+    # Center of one of its positions, cached for bbox scans; not a resource
+    # field.
+    center = db.PointField(null=True, index_where='deleted_at IS NULL')
 
     class Meta:
         indexes = (
@@ -140,9 +154,58 @@ class HouseNumber(Model):
 
     def save(self, *args, **kwargs):
         self.cia = self.compute_cia()
+        # A new housenumber has no position yet.
+        created = not self._get_pk_value()
         super().save(*args, **kwargs)
+        if not created:
+            # Do not trust the center we may have loaded before positions
+            # were changed.
+            HouseNumber.refresh_centers(self.pk)
         self._clean_called = False
 
+    @classmethod
+    def refresh_centers(cls, *pks):
+        """Update the centers of the given housenumbers, now or at the end
+        of the enclosing `defer_centers`."""
+        pending = context.get('centers')
+        if pending is None:
+            cls.update_centers(*pks)
+        else:
+            pending.update(pk for pk in pks if pk)
+
+    @classmethod
+    @contextmanager
+    def defer_centers(cls):
+        """Update the centers refreshed within once, on exit, eg. for a
+        chunk of imported rows instead of every save."""
+        previous = context.get('centers')
+        pending = set()
+        context.set('centers', pending)
+        try:
+            yield
+        finally:
+            context.set('centers', previous)
+        if pending:
+            cls.update_centers(*pending)
+
+    @classmethod
+    def update_centers(cls, *pks):
+        """Cache the center of the first active position of the given
+        housenumbers (all of them if none is given)."""
+        sql = ('UPDATE {table} SET center = ('
+               'SELECT p.center FROM {position} AS p '
+               'WHERE p.{column} = {table}.pk AND p.deleted_at IS NULL '
+               'AND p.center IS NOT NULL ORDER BY p.pk LIMIT 1)').format(
+                   table=cls._meta.db_table,
+                   position=Position._meta.db_table,
+                   column=Position.housenumber.db_column)
+        if pks:
+            pks = [pk for pk in pks if pk]
+            if not pks:
+                return
+            sql += ' WHERE pk IN ({})'.format(', '.join(['%s'] * len(pks)))
+        cls._meta.database.execute_sql(sql, pks)
+
     def compute_cia(self):
         return compute_cia(str(self.parent.municipality.insee),
                            self.parent.get_fantoir(),
@@ -194,7 +257,9 @@ class Position(Model):
                        'parent', 'positioning', 'name', 'ign', 'laposte']
 
     name = db.CharField(max_length=200, null=True)
-    center = db.PointField(verbose_name=_("center"), null=True, index=True)
+    # All position queries filter out deleted ones.
+    center = db.PointField(verbose_name=_("center"), null=True,
+                           index_where='deleted_at IS NULL')
     housenumber = db.ForeignKeyField(HouseNumber, related_name='positions')
     parent = db.ForeignKeyField('self', related_name='children', null=True)
     source = db.CharField(max_length=64, null=True)
@@ -209,6 +274,79 @@ class Position(Model):
             (('housenumber', 'source'), True),
         )
 
+    def save(self, *args, **kwargs):
+        housenumbers = {self._data.get('housenumber')}
+        if self.pk and 'housenumber' in self._dirty:
+            # Moved to another housenumber, which center must change too.
+            previous = (Position.raw_select(Position.housenumber)
+                                .where(Position.pk == self.pk).tuples())
+            housenumbers.update(pk for pk, in previous)
+        super().save(*args, **kwargs)
+        HouseNumber.refresh_centers(*housenumbers)
+
+    def delete_instance(self, *args, **kwargs):
+        deleted = super().delete_instance(*args, **kwargs)
+        HouseNumber.refresh_centers(self._data.get('housenumber'))
+        return deleted
+
+    @classmethod
+    def nearest(cls, lon, lat, limit=1, kinds=None):
+        """Positions nearest to lon/lat, with their housenumber, group and
+        municipality loaded, and a `distance` attribute in meters."""
+        qs = (cls.select(cls, HouseNumber, Group, Municipality,
+                         cls.center.distance(lon, lat).alias('distance'))
+                 .join(HouseNumber)
+                 .join(Group)
+                 .join(Municipality)
+                 .where(cls.center.is_null(False),
+                        HouseNumber.deleted_at.is_null()))
+        if kinds:
+            qs = qs.where(cls.kind << kinds)
+        return qs.order_by(cls.center.knn(lon, lat)).limit(limit)
+
+    @classmethod
+    def nearest_many(cls, points):
+        """For each (lon, lat, limit, kinds) of points, the list of
+        (position, distance in meters) nearest to lon/lat, found with one
+        set-based query instead of one per point."""
+        if not points:
+            return []
+        lons, lats, limits, kinds = zip(*points)
+        sql = ('SELECT q.idx, n.pk, n.distance FROM unnest('
+               '%s::float8[], %s::float8[], %s::int[], %s::text[]) '
+               'WITH ORDINALITY AS q(lon, lat, lim, kinds, idx) '
+               'CROSS JOIN LATERAL (SELECT ST_SetSRID('
+               'ST_MakePoint(q.lon, q.lat), {srid}) AS pt) AS g '
+               'CROSS JOIN LATERAL (SELECT p.pk, p.center <-> g.pt AS knn, '
+               'ST_DistanceSphere(p.center, g.pt) AS distance '
+               'FROM {position} AS p JOIN {housenumber} AS h '
+               'ON h.pk = p.{column} '
+               'WHERE p.center IS NOT NULL AND p.deleted_at IS NULL '
+               'AND h.deleted_at IS NULL AND (q.kinds IS NULL OR '
+               "p.kind = ANY(string_to_array(q.kinds, ','))) "
+               'ORDER BY p.center <-> g.pt LIMIT q.lim) AS n '
+               'ORDER BY q.idx, n.knn').format(
+                   srid=cls.center.srid,
+                   position=cls._meta.db_table,
+                   housenumber=HouseNumber._meta.db_table,
+                   column=cls.housenumber.db_column)
+        kinds = [','.join(k) if k else None for k in kinds]
+        rows = cls._meta.database.execute_sql(
+            sql, [list(lons), list(lats), list(limits), kinds]).fetchall()
+        positions = (cls.select(cls, HouseNumber, Group, Municipality)
+                        .join(HouseNumber)
+                        .join(Group)
+                        .join(Municipality)
+                        .where(cls.pk << list({pk for _, pk, _ in rows})))
+        positions = {position.pk: position for position in positions}
+        results = [[] for _ in points]
+        for idx, pk, distance in rows:
+            position = positions.get(pk)
+            # Deleted, or its housenumber was, since the first query.
+            if position is not None:
+                results[idx - 1].append((position, distance))
+        return results
+
     @classmethod
     def validate(cls, validator, document, instance):
         errors = {}
@@ -155,22 +155,28 @@ class ResourceModel(db.Model, metaclass=BaseResource):
                 raise ResourceLinkedError(
                     'Resource still linked by `{}`'.format(name))
 
+    @classmethod
+    def parse_identifier(cls, id):
+        """Split an "identifier:value" string into (identifier, value)."""
+        identifier = 'id'  # BAN id by default.
+        if isinstance(id, str):
+            *extra, id = id.split(':')
+            if extra:
+                identifier = extra[0]
+            if identifier not in cls.identifiers + ['id', 'pk']:
+                raise cls.DoesNotExist("Invalid identifier {}".format(
+                                                                identifier))
+        elif isinstance(id, int):
+            identifier = 'pk'
+        return identifier, id
+
     @classmethod
     def coerce(cls, id, identifier=None):
         if isinstance(id, db.Model):
             instance = id
         else:
             if not identifier:
-                identifier = 'id'  # BAN id by default.
-                if isinstance(id, str):
-                    *extra, id = id.split(':')
-                    if extra:
-                        identifier = extra[0]
-                    if identifier not in cls.identifiers + ['id', 'pk']:
-                        raise cls.DoesNotExist("Invalid identifier {}".format(
-                                                                identifier))
-                elif isinstance(id, int):
-                    identifier = 'pk'
+                identifier, id = cls.parse_identifier(id)
             try:
                 instance = cls.raw_select().where(
                     getattr(cls, identifier) == id).get()
@@ -186,3 +192,61 @@ class ResourceModel(db.Model, metaclass=BaseResource):
         if instance.deleted_at:
             raise IsDeletedError(instance)
         return instance
+
+    @classmethod
+    def coerce_many(cls, ids):
+        """Resolve a list of identifiers, of possibly mixed kinds, the same
+        way `coerce` does, including redirects.
+
+        Queries are made per identifier kind, not per identifier.
+        Return a list of (instance, error) tuples in input order. Deleted
+        instances are returned as is, the caller decides what to do.
+        """
+        from .versioning import Redirect
+        results = [None] * len(ids)
+        # {identifier: {value: [index, …]}}
+        kinds = {}
+        for index, id in enumerate(ids):
+            try:
+                identifier, value = cls.parse_identifier(id)
+                value = str(getattr(cls, identifier).db_value(value))
+            except (cls.DoesNotExist, ValueError) as e:
+                results[index] = (None, e)
+                continue
+            values = kinds.setdefault(identifier, {})
+            values.setdefault(value, []).append(index)
+        # {target id: [index, …]}
+        redirected = {}
+        for identifier, values in kinds.items():
+            field = getattr(cls, identifier)
+            for instance in cls.raw_select().where(field << list(values)):
+                value = str(field.db_value(getattr(instance, identifier)))
+                for index in values.pop(value, []):
+                    results[index] = (instance, None)
+            if not values:
+                continue
+            # Are they old identifiers?
+            redirects = Redirect.follow_many(cls.__name__, identifier, values)
+            for value, indexes in values.items():
+                targets = redirects.get(value)
+                if targets and len(targets) == 1:
+                    redirected.setdefault(targets[0], []).extend(indexes)
+                    continue
+                if targets:
+                    error = MultipleRedirectsError(identifier, value, targets)
+                else:
+                    error = cls.DoesNotExist(
+                        'No {} with {} `{}`'.format(cls.__name__, identifier,
+                                                    value))
+                for index in indexes:
+                    results[index] = (None, error)
+        if redirected:
+            for instance in cls.raw_select().where(cls.id << list(redirected)):
+                for index in redirected.pop(instance.id):
+                    results[index] = (instance, None)
+            for id, indexes in redirected.items():
+                error = cls.DoesNotExist('Redirect target `{}` not found'
+                                         .format(id))
+                for index in indexes:
+                    results[index] = (None, error)
+        return results
@@ -0,0 +1,106 @@
+"""Fuzzy address search, on pg_trgm indexed normalized names."""
+import re
+
+import peewee
+
+from ban.utils import normalize
+
+from . import models
+
+NUMBER = re.compile(r'^(?P<number>\d+)\s*'
+                    r'(?:(?P<ordinal>bis|ter|quater|quinquies|[a-z])\b)?\s*'
+                    r'(?P<text>.*)$')
+
+MUNICIPALITY_MASK = {'id': {}, 'name': {}, 'insee': {}}
+GROUP_MASK = {'id': {}, 'name': {}, 'kind': {}, 'fantoir': {},
+              'municipality': MUNICIPALITY_MASK}
+HOUSENUMBER_MASK = {'id': {}, 'number': {}, 'ordinal': {}, 'cia': {},
+                    'parent': GROUP_MASK}
+POSITION_MASK = {'id': {}, 'center': {}, 'kind': {}, 'positioning': {}}
+
+
+def parse(q):
+    """Split a query in (number, ordinal, text)."""
+    q = normalize(q)
+    match = NUMBER.match(q)
+    if match:
+        return (match.group('number'), match.group('ordinal'),
+                match.group('text'))
+    return None, None, q
+
+
+def search_municipalities(text, limit):
+    Municipality = models.Municipality
+    score = Municipality.normalized.similarity(text)
+    return (Municipality.select(Municipality, score.alias('score'))
+                        .where(Municipality.normalized.similar(text))
+                        .order_by(score.desc())
+                        .limit(limit))
+
+
+def search_groups(text, limit, insee=None):
+    Group, Municipality = models.Group, models.Municipality
+    score = Group.normalized.similarity(text)
+    qs = (Group.select(Group, Municipality, score.alias('score'))
+               .join(Municipality)
+               .where(Group.normalized.similar(text)))
+    if insee:
+        qs = qs.where(Municipality.insee == insee)
+    return qs.order_by(score.desc()).limit(limit)
+
+
+def search_housenumbers(groups, number, ordinal=None):
+    HouseNumber, Group = models.HouseNumber, models.Group
+    Municipality = models.Municipality
+    if not groups:
+        return []
+    qs = (HouseNumber.select(HouseNumber, Group, Municipality)
+                     .join(Group)
+                     .join(Municipality)
+                     .where(HouseNumber.parent << [g.pk for g in groups],
+                            HouseNumber.number == number))
+    if ordinal:
+        qs = qs.where(peewee.fn.lower(HouseNumber.ordinal) == ordinal)
+    return list(qs)
+
+
+def load_positions(housenumbers):
+    """Return positions by housenumber pk, in one query."""
+    positions = {}
+    if housenumbers:
+        Position = models.Position
+        qs = Position.select().where(
+            Position.housenumber << [h.pk for h in housenumbers])
+        for position in qs:
+            positions.setdefault(position._data['housenumber'], []).append(
+                position.serialize(POSITION_MASK))
+    return positions
+
+
+def search(q, limit=10, insee=None):
+    """Return a list of ranked results, housenumbers first when the query
+    starts with a number."""
+    number, ordinal, text = parse(q)
+    if not text:
+        return []
+    results = []
+    groups = list(search_groups(text, limit, insee))
+    if number:
+        scores = {g.pk: g.score for g in groups}
+        housenumbers = search_housenumbers(groups, number, ordinal)
+        positions = load_positions(housenumbers)
+        for housenumber in housenumbers:
+            result = housenumber.serialize(HOUSENUMBER_MASK)
+            result['positions'] = positions.get(housenumber.pk, [])
+            results.append({'type': 'housenumber',
+                            'score': scores[housenumber._data['parent']],
+                            'resource': result})
+        results.sort(key=lambda r: r['score'], reverse=True)
+    others = [{'type': 'group', 'score': g.score,
+               'resource': g.serialize(GROUP_MASK)} for g in groups]
+    if not insee:
+        others.extend({'type': 'municipality', 'score': m.score,
+                       'resource': m.serialize(MUNICIPALITY_MASK)}
+                      for m in search_municipalities(text, limit))
+    others.sort(key=lambda r: r['score'], reverse=True)
+    return (results + others)[:limit]
@@ -0,0 +1,248 @@
+"""Counts of active groups, housenumbers and positions, per municipality and
+per group, maintained incrementally when resources are saved.
+
+Position counts are also broken down by kind and positioning, with names
+like "positions:kind:entrance".
+"""
+from collections import Counter
+from contextlib import contextmanager
+
+import peewee
+
+from ban import db
+
+from . import context
+
+MUNICIPALITY = 'municipality'
+GROUP = 'group'
+TRACKED = ('group', 'housenumber', 'position')
+
+
+class Statistic(db.Model):
+    scope = db.CharField(max_length=16)
+    scope_pk = db.IntegerField()
+    name = db.CharField(max_length=64)
+    count = db.IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('scope', 'scope_pk', 'name'), True),
+        )
+
+
+def position_names(kind, positioning):
+    return ['positions', 'positions:kind:{}'.format(kind),
+            'positions:positioning:{}'.format(positioning)]
+
+
+def locate(resource, pk):
+    """Return (municipality pk, group pk, names) the resource is counted
+    as, or None if it is not active."""
+    from . import models
+    Group, HouseNumber = models.Group, models.HouseNumber
+    Position = models.Position
+    if resource == 'group':
+        row = (Group.raw_select(Group.municipality)
+                    .where(Group.pk == pk, Group.deleted_at.is_null())
+                    .limit(1).tuples().first())
+        return row and (row[0], None, ['groups'])
+    if resource == 'housenumber':
+        row = (HouseNumber.raw_select(Group.municipality, Group.pk)
+                          .join(Group)
+                          .where(HouseNumber.pk == pk,
+                                 HouseNumber.deleted_at.is_null())
+                          .limit(1).tuples().first())
+        return row and (row[0], row[1], ['housenumbers'])
+    row = (Position.raw_select(Group.municipality, Group.pk, Position.kind,
+                               Position.positioning)
+                   .join(HouseNumber)
+                   .join(Group)
+                   .where(Position.pk == pk, Position.deleted_at.is_null())
+                   .limit(1).tuples().first())
+    return row and (row[0], row[1], position_names(row[2], row[3]))
+
+
+def descendants(resource, pk):
+    """Counter of names of the active resources below this one."""
+    from . import models
+    HouseNumber, Position = models.HouseNumber, models.Position
+    counter = Counter()
+    if resource == 'position':
+        return counter
+    positions = (Position.select(Position.kind, Position.positioning,
+                                 peewee.fn.COUNT(Position.pk))
+                         .join(HouseNumber)
+                         .group_by(Position.kind, Position.positioning)
+                         .order_by()
+                         .tuples())
+    if resource == 'group':
+        counter['housenumbers'] = (HouseNumber.select()
+                                              .where(HouseNumber.parent == pk)
+                                              .order_by().count())
+        positions = positions.where(HouseNumber.parent == pk)
+    else:
+        positions = positions.where(HouseNumber.pk == pk)
+    for kind, positioning, count in positions:
+        for name in position_names(kind, positioning):
+            counter[name] += count
+    return counter
+
+
+def contributions(location, extra=None):
+    """Counter of (scope, scope_pk, name) for a located resource, and the
+    extra names of its descendants."""
+    municipality, group, names = location
+    counter = Counter()
+    for name in names:
+        counter[(MUNICIPALITY, municipality, name)] += 1
+        if group:
+            counter[(GROUP, group, name)] += 1
+    for name, count in (extra or {}).items():
+        counter[(MUNICIPALITY, municipality, name)] += count
+        if group:
+            counter[(GROUP, group, name)] += count
+    return counter
+
+
+def apply(delta, chunksize=1000):
+    """Add the delta counts to the statistics, with upserts of chunksize
+    rows."""
+    rows = [(scope, pk, name, count)
+            for (scope, pk, name), count in delta.items() if count]
+    table = Statistic._meta.db_table
+    for index in range(0, len(rows), chunksize):
+        chunk = rows[index:index + chunksize]
+        values = ', '.join(['(%s, %s, %s, %s)'] * len(chunk))
+        sql = ('INSERT INTO {table} (scope, scope_pk, name, count) '
+               'VALUES {values} ON CONFLICT (scope, scope_pk, name) '
+               'DO UPDATE SET count = {table}.count + EXCLUDED.count').format(
+                   table=table, values=values)
+        params = [value for row in chunk for value in row]
+        Statistic._meta.database.execute_sql(sql, params)
+
+
+@contextmanager
+def track(instance):
+    """Update statistics with the changes made to instance within the
+    block."""
+    resource = getattr(instance, 'resource', None)
+    # Imports skipping diffs (see `commands.helpers.nodiff`) rebuild the
+    # statistics of the municipalities they touched once done instead.
+    if context.get('nodiff') or resource not in TRACKED:
+        yield
+        return
+    before = locate(resource, instance.pk) if instance.pk else None
+    yield
+    after = locate(resource, instance.pk) if instance.pk else None
+    if before == after:
+        return
+    extra = None
+    if before and after and before[:2] != after[:2]:
+        # Moved: what is below moves too. Created or deleted resources
+        # cannot have any descendant.
+        extra = descendants(resource, instance.pk)
+    delta = Counter()
+    if before:
+        delta.subtract(contributions(before, extra))
+    if after:
+        delta.update(contributions(after, extra))
+    apply(delta)
+
+
+def count(name, scope=None, pk=None):
+    """Return the count for scope and pk, or for the whole country if no
+    scope is given."""
+    qs = Statistic.select(peewee.fn.COALESCE(peewee.fn.SUM(Statistic.count),
+                                             0))
+    if scope:
+        qs = qs.where(Statistic.scope == scope, Statistic.scope_pk == pk)
+    else:
+        qs = qs.where(Statistic.scope == MUNICIPALITY)
+    return int(qs.where(Statistic.name == name).order_by().scalar())
+
+
+def summary(scope=None, pk=None):
+    """All counts of scope and pk (or country wide), as a nested dict."""
+    qs = Statistic.select(Statistic.name,
+                          peewee.fn.SUM(Statistic.count))
+    if scope:
+        qs = qs.where(Statistic.scope == scope, Statistic.scope_pk == pk)
+    else:
+        qs = qs.where(Statistic.scope == MUNICIPALITY)
+    data = {'groups': 0, 'housenumbers': 0,
+            'positions': {'total': 0, 'kind': {}, 'positioning': {}}}
+    if scope == GROUP:
+        del data['groups']
+    for name, total in (qs.group_by(Statistic.name).order_by().tuples()):
+        total = int(total)
+        if not total:
+            continue
+        if name == 'positions':
+            data['positions']['total'] = total
+        elif name.startswith('positions:'):
+            _, key, value = name.split(':', 2)
+            data['positions'][key][value] = total
+        else:
+            data[name] = total
+    return data
+
+
+def rebuild(municipalities=None):
+    """Recompute the statistics of the given municipality pks (all of them
+    if None) from scratch, eg. after an import skipping diffs."""
+    from . import models
+    Group, HouseNumber = models.Group, models.HouseNumber
+    Position = models.Position
+    if municipalities is not None:
+        municipalities = list(municipalities)
+        if not municipalities:
+            return
+    database = Statistic._meta.database
+    with database.atomic():
+        # Concurrent `track` updates wait for the new counts to be
+        # committed, and are then applied on top of them: counts are taken
+        # once the lock is held, so they are either counted or applied,
+        # never both or none.
+        database.execute_sql('LOCK TABLE {} IN EXCLUSIVE MODE'.format(
+            Statistic._meta.db_table))
+        counter = Counter()
+        groups = (Group.select(Group.municipality, peewee.fn.COUNT(Group.pk))
+                       .group_by(Group.municipality).order_by())
+        housenumbers = (HouseNumber.select(Group.municipality, Group.pk,
+                                           peewee.fn.COUNT(HouseNumber.pk))
+                                   .join(Group)
+                                   .group_by(Group.municipality, Group.pk)
+                                   .order_by())
+        positions = (Position.select(Group.municipality, Group.pk,
+                                     Position.kind, Position.positioning,
+                                     peewee.fn.COUNT(Position.pk))
+                             .join(HouseNumber)
+                             .join(Group)
+                             .group_by(Group.municipality, Group.pk,
+                                       Position.kind, Position.positioning)
+                             .order_by())
+        stale = Statistic.delete()
+        if municipalities is not None:
+            groups = groups.where(Group.municipality << municipalities)
+            housenumbers = housenumbers.where(
+                Group.municipality << municipalities)
+            positions = positions.where(Group.municipality << municipalities)
+            children = (Group.raw_select(Group.pk)
+                             .where(Group.municipality << municipalities))
+            stale = stale.where(
+                ((Statistic.scope == MUNICIPALITY) &
+                 (Statistic.scope_pk << municipalities)) |
+                ((Statistic.scope == GROUP) &
+                 (Statistic.scope_pk << children)))
+        for municipality, total in groups.tuples():
+            counter[(MUNICIPALITY, municipality, 'groups')] += total
+        for municipality, group, total in housenumbers.tuples():
+            counter.update(contributions((municipality, group, []),
+                                         {'housenumbers': total}))
+        for municipality, group, kind, positioning, total in (
+                positions.tuples()):
+            names = position_names(kind, positioning)
+            counter.update(contributions((municipality, group, []),
+                                         {name: total for name in names}))
+        stale.execute()
+        apply(counter)
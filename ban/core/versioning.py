@@ -7,7 +7,7 @@ from ban import db
 from ban.auth.models import Client, Session
 from ban.utils import make_diff, utcnow
 
-from . import context
+from . import context, stats
 
 
 @decorator.decorator
@@ -75,7 +75,9 @@ class Versioned(db.Model, metaclass=BaseVersioned):
         if self.version > 1:
             old = self.load_version(self.version - 1)
             old.close_period(new.period.lower)
-        if Diff.ACTIVE:
+        # Diffs can be skipped at very first data import, by the current
+        # thread only (see `commands.helpers.nodiff`).
+        if not context.get('nodiff'):
             Diff.create(old=old, new=new, created_at=self.modified_at)
 
     @property
@@ -132,7 +134,7 @@ class Versioned(db.Model, metaclass=BaseVersioned):
         self.modified_at = now
 
     def save(self, *args, **kwargs):
-        with self._meta.database.atomic():
+        with self._meta.database.atomic(), stats.track(self):
             self.check_version()
             self.update_meta()
             super().save(*args, **kwargs)
@@ -140,7 +142,7 @@ class Versioned(db.Model, metaclass=BaseVersioned):
             self.lock_version()
 
     def delete_instance(self, *args, **kwargs):
-        with self._meta.database.atomic():
+        with self._meta.database.atomic(), stats.track(self):
             Redirect.clear(self)
             return super().delete_instance(*args, **kwargs)
 
@@ -235,9 +237,6 @@ class Diff(db.Model):
                 description: detail of changed properties
             """
 
-    # Allow to skip diff at very first data import.
-    ACTIVE = True
-
     # old is empty at creation.
     old = db.ForeignKeyField(Version, null=True)
     # new is empty after delete.
@@ -270,6 +269,72 @@ class Diff(db.Model):
         }
 
 
+class Refresh(db.Model):
+    """Changes made without diffs, eg. by imports within
+    `commands.helpers.nodiff`, for the caches following the diffs to catch
+    up with them."""
+
+    # Municipality the changes were made in, any of them if null.
+    insee = db.CharField(max_length=5, null=True)
+    created_at = db.DateTimeField(default=utcnow)
+
+    class Meta:
+        order_by = ('pk', )
+
+    @classmethod
+    def record(cls, insees):
+        """Record changes in the municipalities of insees, falsy ones meaning
+        unknown municipalities."""
+        insees = set(insees)
+        if not all(insees):
+            insees = {None}
+        if insees:
+            cls.insert_many([{'insee': insee} for insee in insees]).execute()
+
+
+class Feed:
+    """Pks of the rows of model (eg. Diff) created since last call, for a
+    cache to follow the changes.
+
+    Pks are taken from a sequence before the row is committed, so a row can
+    show up after a higher one: the WINDOW pks below the highest one seen
+    are scanned again, leaving out the ones already returned."""
+
+    WINDOW = 1000
+
+    def __init__(self, model, last=None):
+        self.model = model
+        self.last = last
+        self.seen = set()
+
+    def scan(self):
+        model = self.model
+        return [pk for pk, in model.select(model.pk)
+                                   .where(model.pk > self.last - self.WINDOW)
+                                   .order_by(model.pk).tuples()]
+
+    def start(self):
+        """Leave out the rows created so far."""
+        model = self.model
+        self.last = model.select(
+            peewee.fn.COALESCE(peewee.fn.MAX(model.pk), 0)
+        ).order_by().scalar()
+        self.seen = set(self.scan())
+
+    def poll(self):
+        """Return the pks of the rows created since last call, the first
+        call starting the feed."""
+        if self.last is None:
+            self.start()
+            return []
+        pks = [pk for pk in self.scan() if pk not in self.seen]
+        if pks:
+            self.last = max(self.last, pks[-1])
+        self.seen = {pk for pk in self.seen.union(pks)
+                     if pk > self.last - self.WINDOW}
+        return pks
+
+
 class Redirect(db.Model):
 
     model_name = db.CharField(max_length=64)
@@ -334,6 +399,18 @@ class Redirect(db.Model):
             cls.value == str(value))
         return [row.model_id for row in rows]
 
+    @classmethod
+    def follow_many(cls, model_name, identifier, values):
+        """Return a {value: [model_id, …]} dict for all redirected values."""
+        rows = cls.select(cls.value, cls.model_id).where(
+            cls.model_name == model_name.lower(),
+            cls.identifier == identifier,
+            cls.value << [str(v) for v in values])
+        redirects = {}
+        for row in rows:
+            redirects.setdefault(row.value, []).append(row.model_id)
+        return redirects
+
     @classmethod
     def propagate(cls, model_name, identifier, value, model_id):
         """An identifier was a target and it becomes itself a redirect."""
@@ -1,3 +1,5 @@
+import time
+
 from playhouse.postgres_ext import PostgresqlExtDatabase
 from ban.core import config
 import postgis
@@ -10,6 +12,8 @@ class DB(PostgresqlExtDatabase):
 
     def __init__(self):
         super().__init__(self.prefix + config.DB_NAME, autorollback=True)
+        # Callables receiving the duration of each executed statement.
+        self.listeners = []
 
     def connect(self):
         # Deal with connection kwargs at connect time only, because we want
@@ -25,6 +29,15 @@ class DB(PostgresqlExtDatabase):
         )
         super().connect()
 
+    def execute_sql(self, sql, params=None, require_commit=True):
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, require_commit)
+        finally:
+            duration = time.perf_counter() - start
+            for listener in self.listeners:
+                listener(duration)
+
     def initialize_connection(self, conn):
         if not self.postgis_registered:
             postgis.register(conn.cursor())
@@ -14,7 +14,8 @@ from ban.core.exceptions import ValidationError
 __all__ = ['PointField', 'ForeignKeyField', 'CharField', 'IntegerField',
            'HStoreField', 'UUIDField', 'ArrayField', 'DateTimeField',
            'BooleanField', 'BinaryJSONField', 'PostCodeField', 'FantoirField',
-           'ManyToManyField', 'PasswordField', 'DateRangeField', 'TextField']
+           'ManyToManyField', 'PasswordField', 'DateRangeField', 'TextField',
+           'SearchField']
 
 
 lonlat_pattern = re.compile('^[\[\(]{1}(?P<lon>-?\d{,3}(:?\.\d*)?), ?(?P<lat>-?\d{,3}(\.\d*)?)[\]\)]{1}$')  # noqa
@@ -24,11 +25,16 @@ peewee.OP.update(
     BBOX2D='&&',
     BBOXCONTAINS='~',
     BBOXCONTAINED='@',
+    KNN='<->',
+    # pg_trgm similarity; escaped for psycopg2 params interpolation.
+    TRGM='%%',
 )
 postgres_ext.PostgresqlExtDatabase.register_ops({
     peewee.OP.BBOX2D: peewee.OP.BBOX2D,
     peewee.OP.BBOXCONTAINS: peewee.OP.BBOXCONTAINS,
     peewee.OP.BBOXCONTAINED: peewee.OP.BBOXCONTAINED,
+    peewee.OP.KNN: peewee.OP.KNN,
+    peewee.OP.TRGM: peewee.OP.TRGM,
 })
 
 
@@ -43,6 +49,16 @@ class PointField(peewee.Field, postgres_ext.IndexedFieldMixin):
     srid = 4326
     index_type = 'GiST'
 
+    def __init__(self, *args, index_where=None, **kwargs):
+        # Partial GiST index, eg. on active rows only.
+        if index_where:
+            self.index_sql = ('CREATE INDEX IF NOT EXISTS {table}_{column}_'
+                              'partial ON {table} USING gist ({column}) '
+                              'WHERE ' + index_where)
+            # Instead of the full index peewee would create.
+            kwargs['index'] = False
+        super().__init__(*args, **kwargs)
+
     def db_value(self, value):
         return self.coerce(value)
 
@@ -75,6 +91,17 @@ class PointField(peewee.Field, postgres_ext.IndexedFieldMixin):
                                    Point(east, north, srid=self.srid)),
             )
 
+    def knn(self, lon, lat):
+        """Distance operator to be used in order_by, so that the GiST index
+        is used to find the nearest neighbours."""
+        return peewee.Expression(self, peewee.OP.KNN,
+                                 Point(lon, lat, srid=self.srid))
+
+    def distance(self, lon, lat):
+        """Distance in meters."""
+        return peewee.fn.ST_DistanceSphere(self,
+                                           Point(lon, lat, srid=self.srid))
+
 
 postgres_ext.PostgresqlExtDatabase.register_fields({'point':
                                                     'geometry(Point)'})
@@ -153,6 +180,24 @@ class TextField(peewee.TextField):
         return super().coerce(value)
 
 
+class SearchField(TextField):
+    """Normalized text for fuzzy search, indexed with trigrams.
+
+    Needs the pg_trgm extension."""
+    index_sql = ('CREATE INDEX IF NOT EXISTS {table}_{column}_trgm '
+                 'ON {table} USING gin ({column} gin_trgm_ops)')
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('null', True)
+        super().__init__(*args, **kwargs)
+
+    def similar(self, text):
+        return peewee.Expression(self, peewee.OP.TRGM, text)
+
+    def similarity(self, text):
+        return peewee.fn.similarity(self, text)
+
+
 class IntegerField(peewee.IntegerField):
     __data_type__ = int
     __schema_type__ = 'integer'
@@ -1,4 +1,5 @@
 import peewee
+from playhouse.migrate import PostgresqlMigrator, migrate
 
 from .connections import default
 
@@ -62,6 +63,34 @@ class Model(peewee.Model):
             query = query.order_by(*cls._meta.order_by)
         return query
 
+    @classmethod
+    def create_table(cls, fail_silently=False):
+        super().create_table(fail_silently=fail_silently)
+        cls.create_indexes()
+
+    @classmethod
+    def create_indexes(cls):
+        """Create the indexes peewee does not know how to create, unless
+        they exist."""
+        for field in cls._meta.fields.values():
+            sql = getattr(field, 'index_sql', None)
+            if sql:
+                cls._meta.database.execute_sql(sql.format(
+                    table=cls._meta.db_table, column=field.db_column))
+
+    @classmethod
+    def add_column(cls, field):
+        """Add the column of field to an existing table, unless it exists.
+        Return whether it was added."""
+        database = cls._meta.database
+        table = cls._meta.db_table
+        columns = [c.name for c in database.get_columns(table)]
+        if field.db_column in columns:
+            return False
+        migrate(PostgresqlMigrator(database).add_column(
+            table, field.db_column, field))
+        return True
+
     @classmethod
     def where(cls, *expressions):
         """Shortcut for select().where()"""
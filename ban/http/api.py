@@ -1,19 +1,23 @@
-from io import StringIO
+import os
+from tempfile import NamedTemporaryFile
 from urllib.parse import urlencode
 
 import peewee
-from flask import request, url_for
+from flask import Response, request, url_for
 
 from ban.auth import models as amodels
-from ban.commands.bal import bal
-from ban.core import context, models, versioning
-from ban.core.encoder import dumps
+from ban.commands import jobs
+from ban.core import (autocomplete, config, context, models, stats,
+                      versioning)
 from ban.core.exceptions import (IsDeletedError, MultipleRedirectsError,
                                  RedirectError, ResourceLinkedError)
+from ban.core.search import search
 from ban.http.auth import auth
+from ban.http.compression import compress_response
 from ban.http.wsgi import app
 from ban.utils import parse_mask
 
+from . import bundle, limits, metrics, tiles
 from .utils import abort, get_bbox, link
 
 
@@ -22,10 +26,22 @@ class CollectionEndpoint:
     filters = []
     DEFAULT_LIMIT = 20
     MAX_LIMIT = 1000
+    # Pages bigger than this go through the expensive requests cap.
+    EXPENSIVE_LIMIT = 100
+    GRID_CELLS = 32
+    MAX_GRID_CELLS = 256
 
     def get_limit(self):
-        return min(int(request.args.get('limit', self.DEFAULT_LIMIT)),
-                   self.MAX_LIMIT)
+        return self.parse_limit(request.args.get('limit', self.DEFAULT_LIMIT))
+
+    def parse_limit(self, value):
+        try:
+            limit = int(value)
+        except (ValueError, TypeError):
+            abort(400, error='Invalid limit: {}'.format(value))
+        if limit < 1:
+            abort(400, error='Invalid limit: {}'.format(value))
+        return min(limit, self.MAX_LIMIT)
 
     def get_offset(self):
         try:
@@ -33,15 +49,16 @@ class CollectionEndpoint:
         except (ValueError, TypeError):
             return 0
 
-    def collection(self, queryset):
+    def collection(self, queryset, total=None):
         limit = self.get_limit()
         offset = self.get_offset()
         end = offset + limit
-        count = len(queryset)
-        data = {
-            'collection': list(queryset[offset:end]),
-            'total': count,
-        }
+        with limits.admission.slot(limit > self.EXPENSIVE_LIMIT):
+            count = len(queryset) if total is None else total
+            data = {
+                'collection': list(queryset[offset:end]),
+                'total': count,
+            }
         headers = {}
         url = request.base_url
         if count > end:
@@ -58,10 +75,42 @@ class CollectionEndpoint:
             link(headers, uri, 'previous')
         return data, 200, headers
 
+    def aggregate(self, qs, center, count=None):
+        """Bucket qs rows in a grid sized from the bbox, and return the count
+        and centroid of each cell."""
+        bbox = get_bbox(request.args)
+        if not bbox:
+            abort(400, error='Aggregate mode needs north, south, east and '
+                             'west parameters')
+        try:
+            cells = int(request.args.get('cells', self.GRID_CELLS))
+        except ValueError:
+            abort(400, error='Invalid value for cells')
+        cells = max(1, min(cells, self.MAX_GRID_CELLS))
+        size = get_grid_size(bbox, cells)
+        if count is None:
+            count = peewee.fn.COUNT(peewee.SQL('*'))
+        collection = []
+        total = 0
+        if qs is not None:
+            centroid = peewee.fn.ST_Centroid(peewee.fn.ST_Collect(center))
+            qs = (qs.select(count.alias('count'), centroid.alias('center'))
+                    .group_by(peewee.fn.ST_SnapToGrid(center, size))
+                    .order_by()
+                    .tuples())
+            for cell_count, cell_center in qs:
+                collection.append({'count': cell_count, 'center': cell_center})
+                total += cell_count
+        return {'collection': collection, 'total': total, 'grid': size}
+
 
 class ModelEndpoint(CollectionEndpoint):
     endpoints = {}
     order_by = None
+    # Statistic counting the collection, and the filters it is kept for,
+    # with their scope.
+    stats_name = None
+    stats_filters = {}
 
     def get_object(self, identifier):
         endpoint = '{}-get-resource'.format(self.__class__.__name__.lower())
@@ -98,6 +147,32 @@ class ModelEndpoint(CollectionEndpoint):
             abort(409, error=str(e))
         return instance
 
+    def resolve(self, identifiers):
+        if len(identifiers) > self.MAX_LIMIT:
+            abort(400, error='Too many identifiers (max {})'.format(
+                                                            self.MAX_LIMIT))
+        mask = self.get_mask()
+        collection = []
+        errors = {}
+        results = self.model.coerce_many(identifiers)
+        for identifier, (instance, error) in zip(identifiers, results):
+            if error:
+                errors[str(identifier)] = str(error)
+                collection.append(None)
+                continue
+            if instance.deleted_at:
+                errors[str(identifier)] = 'Resource is deleted'
+                collection.append(None)
+                continue
+            try:
+                collection.append(instance.serialize(mask))
+            except ValueError as e:
+                abort(400, error=str(e))
+        data = {'collection': collection, 'total': len(collection)}
+        if errors:
+            data['errors'] = errors
+        return data
+
     def get_queryset(self):
         qs = self.model.select()
         for key in self.filters:
@@ -118,6 +193,26 @@ class ModelEndpoint(CollectionEndpoint):
                 qs = qs.where(field << values)
         return qs
 
+    def get_stats_total(self):
+        """Read the collection total from the statistics, instead of a
+        COUNT query, when the request only uses known filters."""
+        if not self.stats_name:
+            return None
+        args = {key: values for key, values in request.args.lists()
+                if key not in ('limit', 'offset', 'fields')}
+        if not args:
+            return stats.count(self.stats_name)
+        if len(args) > 1:
+            return None
+        key, values = args.popitem()
+        if key not in self.stats_filters or len(values) > 1:
+            return None
+        try:
+            pk = getattr(self.model, key).coerce(values[0])
+        except (ValueError, peewee.DoesNotExist):
+            return None
+        return stats.count(self.stats_name, self.stats_filters[key], pk)
+
     def get_mask(self):
         fields = request.args.get('fields', '*')
         return parse_mask(fields)
@@ -134,6 +229,16 @@ class ModelEndpoint(CollectionEndpoint):
     def get_collection(self):
         """Get {resource} collection.
 
+        parameters:
+            - name: id
+              in: query
+              type: array
+              items:
+                type: string
+              collectionFormat: multi
+              required: false
+              description: only return the resources matching those
+                           identifiers, in the same order.
         responses:
             200:
                 description: Get {resource} collection.
@@ -150,15 +255,19 @@ class ModelEndpoint(CollectionEndpoint):
                         type: integer
                         description: total resources available
         """
+        identifiers = request.args.getlist('id')
+        if identifiers:
+            return self.resolve(identifiers)
+        if request.args.get('aggregate') and hasattr(self, 'get_aggregate'):
+            return self.get_aggregate()
         qs = self.get_queryset()
         if qs is None:
             return self.collection([])
-        if not isinstance(qs, list):
-            order_by = (self.order_by if self.order_by is not None
-                        else [self.model.pk])
-            qs = qs.order_by(*order_by).serialize(self.get_collection_mask())
+        order_by = (self.order_by if self.order_by is not None
+                    else [self.model.pk])
+        qs = qs.order_by(*order_by).serialize(self.get_collection_mask())
         try:
-            return self.collection(qs)
+            return self.collection(qs, total=self.get_stats_total())
         except ValueError as e:
             abort(400, error=str(e))
 
@@ -187,6 +296,42 @@ class ModelEndpoint(CollectionEndpoint):
         except ValueError as e:
             abort(400, error=str(e))
 
+    @auth.require_oauth()
+    @app.jsonify
+    @app.endpoint('/resolve', methods=['POST'])
+    def post_resolve(self):
+        """Get many {resource} from a list of identifiers.
+
+        responses:
+            200:
+                description: Resources in the order of the given identifiers,
+                             null when not found.
+                schema:
+                    type: object
+                    properties:
+                      collection:
+                        name: collection
+                        type: array
+                        items:
+                          $ref: '#/definitions/{resource}'
+                      total:
+                        name: total
+                        type: integer
+                        description: number of identifiers given
+                      errors:
+                        name: errors
+                        type: object
+                        description: error message by unresolved identifier
+            400:
+                description: Invalid payload.
+                schema:
+                    $ref: '#/definitions/Error'
+        """
+        identifiers = request.json
+        if not isinstance(identifiers, list):
+            abort(400, error='Body should be a list of identifiers')
+        return self.resolve(identifiers)
+
     @auth.require_oauth()
     @app.jsonify
     @app.endpoint('/<identifier>', methods=['POST'])
@@ -343,6 +488,7 @@ class ModelEndpoint(CollectionEndpoint):
 
 class VersionedModelEnpoint(ModelEndpoint):
     @auth.require_oauth()
+    @limits.expensive
     @app.jsonify
     @app.endpoint('/<identifier>/versions', methods=['GET'])
     def get_versions(self, identifier):
@@ -472,6 +618,43 @@ class Municipality(VersionedModelEnpoint):
     model = models.Municipality
     order_by = [model.insee]
 
+    @auth.require_oauth()
+    @app.endpoint('/<identifier>/bundle', methods=['GET'])
+    def get_bundle(self, identifier):
+        """Get {resource} with all its postcodes, groups, housenumbers and
+        positions.
+
+        parameters:
+            - $ref: '#/parameters/identifier'
+            - name: format
+              in: query
+              type: string
+              enum: [json, ndjson]
+              required: false
+              description: one document with a list per resource kind, or
+                           one resource per line (municipality first, then
+                           postcodes, groups, housenumbers and positions).
+        responses:
+            200:
+                description: The whole {resource} content.
+            410:
+                description: Resource is deleted.
+                schema:
+                    $ref: '#/definitions/Error'
+        """
+        instance = self.get_object(identifier)
+        if instance.deleted_at:
+            abort(410, error='Resource is deleted')
+        format = request.args.get('format', 'json')
+        if format not in ('json', 'ndjson'):
+            abort(400, error='Invalid format {}'.format(format))
+        body = bundle.cache.get(instance).encoded(format)
+        mimetype = ('application/x-ndjson' if format == 'ndjson'
+                    else 'application/json')
+        response = Response(body.data, mimetype=mimetype)
+        response.compressed_body = body
+        return response
+
 
 @app.resource
 class PostCode(VersionedModelEnpoint):
@@ -486,6 +669,8 @@ class Group(VersionedModelEnpoint):
     endpoint = '/group'
     model = models.Group
     filters = ['municipality']
+    stats_name = 'groups'
+    stats_filters = {'municipality': stats.MUNICIPALITY}
 
 
 @app.resource
@@ -493,8 +678,12 @@ class HouseNumber(VersionedModelEnpoint):
     endpoint = '/housenumber'
     model = models.HouseNumber
     filters = ['parent', 'postcode', 'ancestors', 'group']
+    stats_name = 'housenumbers'
+    stats_filters = {'parent': stats.GROUP}
+    # Ends with pk, so pages are stable.
     order_by = [peewee.SQL('number ASC NULLS FIRST'),
-                peewee.SQL('ordinal ASC NULLS FIRST')]
+                peewee.SQL('ordinal ASC NULLS FIRST'),
+                models.HouseNumber.pk]
 
     def filter_ancestors_and_group(self, qs):
         # ancestors is a m2m so we cannot use the basic filtering
@@ -503,20 +692,16 @@ class HouseNumber(VersionedModelEnpoint):
         group = request.args.getlist('group')  # Means parent + ancestors.
         values = group or ancestors
         values = list(map(self.model.ancestors.coerce, values))
-        parent_qs = qs.where(self.model.parent << values) if group else None
         if values:
+            # A subquery instead of a UNION, so the result is still a
+            # SelectQuery: count, ordering and pagination run in SQL.
             m2m = self.model.ancestors.get_through_model()
-            qs = (qs.join(m2m, on=(m2m.housenumber == self.model.pk))
-                    .where(m2m.group << values))
-            if parent_qs:
-                qs = (parent_qs | qs)
-            # We evaluate the qs ourselves here, because it's a CompoundSelect
-            # that does not know about our SelectQuery custom methods (like
-            # `serialize`), and CompoundSelect is hardcoded in peewee
-            # SelectQuery, and we'd need to copy-paste code to be able to use
-            # a custom CompoundQuery class instead.
-            mask = self.get_collection_mask()
-            qs = [h.serialize(mask) for h in qs.order_by(*self.order_by)]
+            subquery = (m2m.select(m2m.housenumber)
+                           .where(m2m.group << values))
+            where = self.model.pk << subquery
+            if group:
+                where |= self.model.parent << values
+            qs = qs.where(where)
         return qs
 
     filter_ancestors = filter_group = filter_ancestors_and_group
@@ -524,27 +709,43 @@ class HouseNumber(VersionedModelEnpoint):
     def get_queryset(self):
         qs = super().get_queryset()
         bbox = get_bbox(request.args)
-        if bbox:
-            qs = (qs.join(models.Position)
-                    .where(models.Position.center.in_bbox(**bbox))
-                    .group_by(models.HouseNumber.pk)
-                    .order_by(models.HouseNumber.pk))
+        if bbox and qs is not None:
+            # Semi-join: no duplicates, no aggregate, and the collection
+            # order_by still applies.
+            Position = models.Position
+            positions = (Position.select(peewee.SQL('1'))
+                                 .where(Position.housenumber ==
+                                        models.HouseNumber.pk,
+                                        Position.center.in_bbox(**bbox)))
+            qs = qs.where(peewee.fn.EXISTS(positions))
         return qs
 
+    def get_aggregate(self):
+        # Each housenumber is counted once, at its cached center.
+        qs = super().get_queryset()
+        bbox = get_bbox(request.args)
+        if qs is not None and bbox:
+            qs = qs.where(models.HouseNumber.center.in_bbox(**bbox))
+        return self.aggregate(qs, models.HouseNumber.center)
+
 
 @app.resource
 class Position(VersionedModelEnpoint):
     endpoint = '/position'
     model = models.Position
     filters = ['kind', 'housenumber']
+    stats_name = 'positions'
 
     def get_queryset(self):
         qs = super().get_queryset()
         bbox = get_bbox(request.args)
-        if bbox:
+        if bbox and qs is not None:
             qs = qs.where(models.Position.center.in_bbox(**bbox))
         return qs
 
+    def get_aggregate(self):
+        return self.aggregate(self.get_queryset(), models.Position.center)
+
 
 @app.resource
 class User(ModelEndpoint):
@@ -552,14 +753,340 @@ class User(ModelEndpoint):
     model = amodels.User
 
 
+@app.resource
+class Stats:
+    endpoint = '/stats'
+
+    @auth.require_oauth()
+    @app.jsonify
+    @app.endpoint('', methods=['GET'])
+    def get(self):
+        """Get counts of active groups, housenumbers and positions (by kind
+        and positioning), for the whole country, a municipality or a group.
+
+        parameters:
+            - name: municipality
+              in: query
+              type: string
+              required: false
+              description: municipality identifier.
+            - name: group
+              in: query
+              type: string
+              required: false
+              description: group identifier (counts housenumbers having it
+                           as parent).
+        responses:
+            200:
+                description: Resources counts.
+            404:
+                description: Municipality or group not found.
+                schema:
+                    $ref: '#/definitions/Error'
+        """
+        for name, scope, model in (('municipality', stats.MUNICIPALITY,
+                                    models.Municipality),
+                                   ('group', stats.GROUP, models.Group)):
+            identifier = request.args.get(name)
+            if identifier:
+                try:
+                    instance = model.coerce(identifier)
+                except (ValueError, model.DoesNotExist):
+                    abort(404, error='{} not found'.format(identifier))
+                return stats.summary(scope, instance.pk)
+        return stats.summary()
+
+
+@app.resource
+class Reverse(CollectionEndpoint):
+    endpoint = '/reverse'
+    DEFAULT_LIMIT = 1
+    MAX_LIMIT = 100
+    MAX_POINTS = 1000
+    DEFAULT_MASK = ('id,center,kind,positioning,housenumber.id,'
+                    'housenumber.number,housenumber.ordinal,housenumber.cia,'
+                    'housenumber.parent.id,housenumber.parent.name,'
+                    'housenumber.parent.municipality.id,'
+                    'housenumber.parent.municipality.name,'
+                    'housenumber.parent.municipality.insee')
+
+    def get_mask(self):
+        return parse_mask(request.args.get('fields', self.DEFAULT_MASK))
+
+    def get_point(self, data):
+        point = []
+        for param in ('lon', 'lat'):
+            try:
+                point.append(float(data.get(param)))
+            except (ValueError, TypeError):
+                abort(400, error='Invalid value for {}: {}'.format(
+                    param, data.get(param)))
+        return point
+
+    def get_kinds(self, data):
+        kinds = data.get('kind')
+        if kinds and not isinstance(kinds, list):
+            kinds = [kinds]
+        return kinds or None
+
+    def serialize(self, position, distance, mask):
+        try:
+            result = position.serialize(mask)
+        except ValueError as e:
+            abort(400, error=str(e))
+        result['distance'] = distance
+        return result
+
+    def nearest(self, data, limit):
+        lon, lat = self.get_point(data)
+        mask = self.get_mask()
+        qs = models.Position.nearest(lon, lat, limit=limit,
+                                     kinds=self.get_kinds(data))
+        return [self.serialize(position, position.distance, mask)
+                for position in qs]
+
+    @auth.require_oauth()
+    @app.jsonify
+    @app.endpoint('', methods=['GET'])
+    def get(self):
+        """Get the positions nearest to a point.
+
+        parameters:
+            - name: lon
+              in: query
+              type: number
+              required: true
+            - name: lat
+              in: query
+              type: number
+              required: true
+            - name: limit
+              in: query
+              type: integer
+              required: false
+            - name: kind
+              in: query
+              type: array
+              items:
+                type: string
+              collectionFormat: multi
+              required: false
+              description: only consider positions of those kinds.
+        responses:
+            200:
+                description: Nearest positions, with their housenumber, group
+                             and municipality, and distance in meters.
+            400:
+                description: Invalid parameters.
+                schema:
+                    $ref: '#/definitions/Error'
+        """
+        data = {'lon': request.args.get('lon'),
+                'lat': request.args.get('lat'),
+                'kind': request.args.getlist('kind')}
+        collection = self.nearest(data, self.get_limit())
+        return {'collection': collection, 'total': len(collection)}
+
+    @auth.require_oauth()
+    @app.jsonify
+    @app.endpoint('', methods=['POST'])
+    def post(self):
+        """Get the positions nearest to each point of a list.
+
+        responses:
+            200:
+                description: For each point given as {{lon, lat, limit, kind}}
+                             object, in the same order, the list of nearest
+                             positions.
+            400:
+                description: Invalid payload.
+                schema:
+                    $ref: '#/definitions/Error'
+        """
+        points = request.json
+        if not isinstance(points, list):
+            abort(400, error='Body should be a list of {lon, lat} objects')
+        if len(points) > self.MAX_POINTS:
+            abort(400, error='Too many points (max {})'.format(
+                                                            self.MAX_POINTS))
+        queries = []
+        for point in points:
+            if not isinstance(point, dict):
+                abort(400, error='Invalid point: {}'.format(point))
+            lon, lat = self.get_point(point)
+            limit = self.parse_limit(point.get('limit', self.DEFAULT_LIMIT))
+            queries.append((lon, lat, limit, self.get_kinds(point)))
+        mask = self.get_mask()
+        collection = [[self.serialize(position, distance, mask)
+                       for position, distance in nearest]
+                      for nearest in models.Position.nearest_many(queries)]
+        return {'collection': collection, 'total': len(collection)}
+
+
+@app.resource
+class Search(CollectionEndpoint):
+    endpoint = '/search'
+    DEFAULT_LIMIT = 10
+    MAX_LIMIT = 100
+
+    @auth.require_oauth()
+    @app.jsonify
+    @app.endpoint('', methods=['GET'])
+    def get(self):
+        """Search municipalities, groups and housenumbers.
+
+        parameters:
+            - name: q
+              in: query
+              type: string
+              required: true
+              description: free text, eg. "12 bis rue des lilas".
+            - name: insee
+              in: query
+              type: string
+              required: false
+              description: restrict search to this municipality.
+            - name: limit
+              in: query
+              type: integer
+              required: false
+        responses:
+            200:
+                description: Ranked results, with their type and score;
+                             housenumbers come with their positions.
+            400:
+                description: Missing query.
+                schema:
+                    $ref: '#/definitions/Error'
+        """
+        q = request.args.get('q')
+        if not q:
+            abort(400, error='Missing q parameter')
+        collection = search(q, limit=self.get_limit(),
+                            insee=request.args.get('insee'))
+        return {'collection': collection, 'total': len(collection)}
+
+
+@app.resource
+class Autocomplete(CollectionEndpoint):
+    endpoint = '/autocomplete'
+    DEFAULT_LIMIT = 10
+    MAX_LIMIT = 50
+
+    @auth.require_oauth()
+    @app.jsonify
+    @app.endpoint('', methods=['GET'])
+    def get(self):
+        """Autocomplete group names and housenumbers.
+
+        parameters:
+            - name: q
+              in: query
+              type: string
+              required: true
+              description: beginning of an address, eg. "12 rue des li".
+            - name: insee
+              in: query
+              type: string
+              required: false
+              description: restrict to this municipality.
+            - name: limit
+              in: query
+              type: integer
+              required: false
+        responses:
+            200:
+                description: Matching groups or housenumbers, with a label.
+            501:
+                description: Autocomplete index is not enabled.
+                schema:
+                    $ref: '#/definitions/Error'
+        """
+        if not config.get('AUTOCOMPLETE'):
+            abort(501, error='Autocomplete is not enabled')
+        q = request.args.get('q')
+        if not q:
+            abort(400, error='Missing q parameter')
+        autocomplete.index.ensure_loaded()
+        autocomplete.index.refresh()
+        collection = autocomplete.index.search(
+            q, insee=request.args.get('insee'), limit=self.get_limit())
+        return {'collection': collection, 'total': len(collection)}
+
+
+@app.before_first_request
+def load_autocomplete():
+    if config.get('AUTOCOMPLETE'):
+        autocomplete.index.ensure_loaded()
+
+
 @app.route('/import/bal', methods=['POST'])
 @auth.require_oauth()
+@limits.expensive
+@app.jsonify
 def bal_post():
-    """Import file at BAL format."""
+    """Queue the import of a file at BAL format, and return the job to poll
+    for its progress and report."""
     data = request.files['data']
-    bal(StringIO(data.read().decode('utf-8-sig')))
-    reporter = context.get('reporter')
-    return dumps({'report': reporter})
+    # Spool to disk, so the file is streamed instead of loaded in memory.
+    # The job removes it once done.
+    with NamedTemporaryFile(suffix='.csv', delete=False) as f:
+        data.save(f)
+    job = jobs.Job.create(kind='bal', path=f.name,
+                          size=os.path.getsize(f.name),
+                          session=context.get('session'))
+    jobs.runner.submit(job)
+    url = url_for('import_job', pk=job.pk, _external=True)
+    return job.serialize(), 202, {'Location': url}
+
+
+def get_job(pk):
+    """Job of pk, if queued by the user of the current session, or by its
+    client when it has no user."""
+    Job, Session = jobs.Job, amodels.Session
+    session = context.get('session')
+    qs = Job.select().join(Session).where(Job.pk == pk)
+    if session._data.get('user'):
+        qs = qs.where(Session.user == session._data['user'])
+    else:
+        qs = qs.where(Session.client == session._data.get('client'))
+    try:
+        return qs.get()
+    except Job.DoesNotExist:
+        abort(404, error='Job not found')
+
+
+@app.route('/import/jobs/<int:pk>', methods=['GET'])
+@auth.require_oauth()
+@app.jsonify
+def import_job(pk):
+    """Get the status, progress and report of an import job."""
+    return get_job(pk).serialize()
+
+
+@app.route('/import/jobs/<int:pk>', methods=['DELETE'])
+@auth.require_oauth()
+@app.jsonify
+def cancel_import_job(pk):
+    """Cancel an import job. Rows already imported are kept."""
+    job = get_job(pk)
+    if job.status in jobs.Job.FINISHED:
+        abort(409, error='Job is already {}'.format(job.status))
+    job.cancel()
+    return get_job(pk).serialize()
+
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>', methods=['GET'])
+@auth.require_oauth()
+def get_tile(z, x, y):
+    """Get positions and housenumbers as a Mapbox Vector Tile."""
+    if not tiles.is_valid(z, x, y):
+        abort(400, error='Invalid tile, zoom must be between {} and {}'
+                         .format(tiles.MIN_ZOOM, tiles.MAX_ZOOM))
+    body = tiles.cache.get(z, x, y)
+    response = Response(body.data, mimetype=tiles.MIMETYPE)
+    response.compressed_body = body
+    return response
 
 
 @app.resource
@@ -597,9 +1124,24 @@ class DiffEndpoint(CollectionEndpoint):
         return self.collection(qs.serialize())
 
 
+@app.route('/metrics', methods=['GET'])
+@auth.require_oauth()
+def get_metrics():
+    """Request and SQL metrics of this process, in Prometheus format."""
+    return Response(metrics.registry.render(), mimetype=metrics.MIMETYPE)
+
+
 @app.route('/openapi', methods=['GET'])
 def openapi():
-    return dumps(app._schema)
+    schema = app._schema
+    body = schema.encoded
+    response = Response(body.data, mimetype='application/json')
+    response.compressed_body = body
+    response.set_etag(schema.etag)
+    # Compress before the conditional check, so the ETag matches the one
+    # the client got for its encoding.
+    compress_response(response, request.accept_encodings)
+    return response.make_conditional(request)
 
 
 app._schema.register_model(amodels.Session)
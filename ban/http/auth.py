@@ -1,12 +1,16 @@
+import threading
+from datetime import timedelta
+
 from .utils import abort
 from flask_oauthlib.provider import OAuth2Provider
 from flask import request
 from werkzeug.datastructures import ImmutableMultiDict
 
 from ban.auth import models
-from ban.core import context
-from ban.utils import is_uuid4
+from ban.core import config, context
+from ban.utils import is_uuid4, utcnow
 
+from .limits import rate_limiter
 from .wsgi import app
 
 auth = OAuth2Provider(app)
@@ -36,17 +40,96 @@ def usergetter(username, password, client, req):
     return None
 
 
+class TokenCache:
+    """Thread safe TTL cache of validated tokens by access_token.
+
+    Tokens are stored with their session, client and user already loaded, so
+    authenticating a request is a dict lookup in the common case.
+
+    A revoked token is only evicted from the cache of the process serving
+    the revocation: the TTL is kept short, as other processes accept it
+    until it expires."""
+
+    MAX_SIZE = 10000
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return int(config.get('TOKEN_CACHE_TTL', 5))
+
+    def get(self, access_token):
+        entry = self._entries.get(access_token)
+        if entry is None:
+            return None
+        token, expires = entry
+        if utcnow() >= expires:
+            self.invalidate(access_token)
+            return None
+        return token
+
+    def set(self, token, expires):
+        # Never keep a token in cache longer than its own validity.
+        expires = min(utcnow() + timedelta(seconds=self.ttl), expires)
+        with self._lock:
+            if len(self._entries) >= self.MAX_SIZE:
+                self._purge()
+            self._entries[token.access_token] = (token, expires)
+
+    def invalidate(self, access_token=None):
+        with self._lock:
+            if access_token is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(access_token, None)
+
+    def _purge(self):
+        now = utcnow()
+        expired = [k for k, (t, e) in self._entries.items() if now >= e]
+        for key in expired:
+            del self._entries[key]
+        if len(self._entries) >= self.MAX_SIZE:
+            self._entries.clear()
+
+
+tokens = TokenCache()
+
+
+def load_token(access_token):
+    Token, Session = models.Token, models.Session
+    token = (Token.select(Token, Session).join(Session)
+                  .where(Token.access_token == access_token).limit(1).first())
+    if not token or token.is_expired():
+        return None
+    # Preload relations, so they are cached along with the token.
+    token.session.client
+    token.session.user
+    expires = token.expires
+    # We use TZ aware datetime while Flask Oauthlib wants naive ones.
+    token.expires = token.expires.replace(tzinfo=None)
+    tokens.set(token, expires)
+    return token
+
+
 @auth.tokengetter
 def tokengetter(access_token=None, refresh_token=None):
     if access_token:
-        token = models.Token.first(models.Token.access_token == access_token)
+        token = tokens.get(access_token) or load_token(access_token)
         if token:
             context.set('session', token.session)
-            # We use TZ aware datetime while Flask Oauthlib wants naive ones.
-            token.expires = token.expires.replace(tzinfo=None)
             return token
 
 
+@auth.after_request
+def rate_limit(valid, req):
+    # Only valid requests have a token, thus a client to limit.
+    if valid:
+        rate_limiter.check(req.access_token)
+    return valid, req
+
+
 @auth.tokensetter
 def tokensetter(metadata, req, *args, **kwargs):
     # req: oauthlib.Request (not Flask one).
@@ -77,3 +160,13 @@ def grantsetter(client_id, code, request, *args, **kwargs):
 def authorize(*args, **kwargs):
     """Get a token to use the API."""
     return None
+
+
+@app.route('/token/revoke', methods=['POST'])
+@auth.require_oauth()
+def revoke():
+    """Revoke the token used to authenticate this request."""
+    token = request.oauth.access_token
+    tokens.invalidate(token.access_token)
+    models.Token.delete().where(models.Token.pk == token.pk).execute()
+    return '', 204
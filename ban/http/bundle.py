@@ -0,0 +1,226 @@
+"""Whole municipality documents: postcodes, groups, housenumbers and
+positions, built with a fixed number of queries."""
+import threading
+import time
+from collections import OrderedDict
+
+import peewee
+
+from ban import db
+from ban.core import config, models, versioning
+from ban.core.encoder import dumps
+
+from . import limits
+from .compression import CompressedBody
+
+KEYS = ['municipality', 'postcodes', 'groups', 'housenumbers', 'positions']
+RELATIONS = (db.ForeignKeyField, db.ManyToManyField,
+             peewee.ReverseRelationDescriptor)
+
+
+def document(instance, relations):
+    """Serialize instance collection fields, taking relations references
+    from the given dict instead of querying them."""
+    cls = instance.__class__
+    mask = {}
+    names = []
+    for name in cls.collection_fields:
+        if isinstance(getattr(cls, name, None), RELATIONS):
+            names.append(name)
+        else:
+            mask[name] = {}
+    data = instance.serialize(mask)
+    for name in names:
+        data[name] = relations[name]
+    return data
+
+
+def load_ids(model, pks, known):
+    """Complete the known {pk: id} mapping with the missing pks, in one
+    query."""
+    missing = {pk for pk in pks if pk is not None and pk not in known}
+    if missing:
+        known.update(model.raw_select(model.pk, model.id)
+                          .where(model.pk << list(missing))
+                          .order_by().tuples())
+    return known
+
+
+def build(municipality):
+    """Return the bundle of municipality as a dict of KEYS."""
+    PostCode, Group = models.PostCode, models.Group
+    HouseNumber, Position = models.HouseNumber, models.Position
+    pk = municipality.pk
+    postcodes = list(PostCode.select().where(PostCode.municipality == pk)
+                             .order_by(PostCode.pk))
+    groups = list(Group.select().where(Group.municipality == pk)
+                       .order_by(Group.pk))
+    housenumbers = list(HouseNumber.select().join(Group)
+                                   .where(Group.municipality == pk)
+                                   .order_by(HouseNumber.pk))
+    positions = list(Position.select().join(HouseNumber).join(Group)
+                             .where(Group.municipality == pk)
+                             .order_by(Position.pk))
+    m2m = HouseNumber.ancestors.get_through_model()
+    in_municipality = (HouseNumber.select(HouseNumber.pk).join(Group)
+                                  .where(Group.municipality == pk))
+    ancestors = {}
+    for housenumber, ancestor in (m2m.select(m2m.housenumber, Group.id)
+                                     .join(Group)
+                                     .where(m2m.housenumber << in_municipality)
+                                     .order_by(Group.pk).tuples()):
+        ancestors.setdefault(housenumber, []).append(ancestor)
+    hn_positions = {}
+    for position in positions:
+        hn_positions.setdefault(position._data['housenumber'], []).append(
+            position.id)
+
+    group_ids = {g.pk: g.id for g in groups}
+    postcode_ids = load_ids(PostCode,
+                            [h._data.get('postcode') for h in housenumbers],
+                            {p.pk: p.id for p in postcodes})
+    housenumber_ids = {h.pk: h.id for h in housenumbers}
+    position_ids = load_ids(Position,
+                            [p._data.get('parent') for p in positions],
+                            {p.pk: p.id for p in positions})
+    return {
+        'municipality': document(municipality, {
+            'postcodes': [p.id for p in postcodes]}),
+        'postcodes': [document(p, {'municipality': municipality.id})
+                      for p in postcodes],
+        'groups': [document(g, {'municipality': municipality.id})
+                   for g in groups],
+        'housenumbers': [document(h, {
+            'parent': group_ids[h._data['parent']],
+            'postcode': postcode_ids.get(h._data.get('postcode')),
+            'ancestors': ancestors.get(h.pk, []),
+            'positions': hn_positions.get(h.pk, []),
+        }) for h in housenumbers],
+        'positions': [document(p, {
+            'housenumber': housenumber_ids[p._data['housenumber']],
+            'parent': position_ids.get(p._data.get('parent')),
+        }) for p in positions],
+    }
+
+
+def references(data):
+    """All string values of a version data, among which the BAN ids it
+    references."""
+    refs = set()
+    for value in (data or {}).values():
+        if isinstance(value, str):
+            refs.add(value)
+        elif isinstance(value, list):
+            refs.update(v for v in value if isinstance(v, str))
+    return refs
+
+
+class Bundle:
+
+    def __init__(self, data):
+        self.data = data
+        # All ids of the bundle, to know which diffs touch it.
+        self.ids = {data['municipality']['id']}
+        for key in KEYS[1:]:
+            self.ids.update(d['id'] for d in data[key])
+        self._bodies = {}
+
+    def encoded(self, format='json'):
+        """Return the bundle as a CompressedBody, either one JSON document
+        or one line per resource (ndjson)."""
+        if format not in self._bodies:
+            if format == 'ndjson':
+                lines = [dumps(self.data['municipality'])]
+                for key in KEYS[1:]:
+                    lines.extend(dumps(d) for d in self.data[key])
+                body = '\n'.join(lines) + '\n'
+            else:
+                body = dumps(self.data)
+            self._bodies[format] = CompressedBody(body)
+        return self._bodies[format]
+
+
+class BundleCache:
+    """LRU cache of bundles by INSEE, invalidated by diffs referencing any
+    of their resources."""
+
+    def __init__(self):
+        self._bundles = OrderedDict()
+        self._lock = threading.Lock()
+        self._diffs = versioning.Feed(versioning.Diff)
+        self._refreshes = versioning.Feed(versioning.Refresh)
+        # Incremented by evictions: bundles built meanwhile may be stale.
+        self._generation = 0
+        self._last_check = 0
+
+    @property
+    def max_size(self):
+        return int(config.get('BUNDLE_CACHE_SIZE', 100))
+
+    @property
+    def refresh_interval(self):
+        return float(config.get('BUNDLE_REFRESH_INTERVAL', 1))
+
+    def get(self, municipality):
+        self.refresh()
+        key = municipality.insee
+        with self._lock:
+            bundle = self._bundles.get(key)
+            if bundle is not None:
+                self._bundles.move_to_end(key)
+            generation = self._generation
+        if bundle is None:
+            with limits.admission.slot():
+                bundle = Bundle(build(municipality))
+            with self._lock:
+                if generation != self._generation:
+                    # Changes seen while building may have been missed.
+                    return bundle
+                self._bundles[key] = bundle
+                while len(self._bundles) > self.max_size:
+                    self._bundles.popitem(last=False)
+        return bundle
+
+    def clear(self):
+        with self._lock:
+            self._bundles.clear()
+            self._diffs = versioning.Feed(versioning.Diff)
+            self._refreshes = versioning.Feed(versioning.Refresh)
+
+    def refresh(self, force=False):
+        """Evict bundles touched by diffs created since last call, or by
+        imports skipping diffs."""
+        now = time.monotonic()
+        if not force and now - self._last_check < self.refresh_interval:
+            return
+        self._last_check = now
+        Diff, Version = versioning.Diff, versioning.Version
+        Refresh = versioning.Refresh
+        refs = set()
+        diffs = self._diffs.poll()
+        if diffs:
+            versions = (Version.select(Version.data)
+                               .join(Diff, on=((Diff.new == Version.pk) |
+                                               (Diff.old == Version.pk)))
+                               .where(Diff.pk << diffs)
+                               .tuples())
+            for data, in versions:
+                refs |= references(data)
+        refreshes = self._refreshes.poll()
+        if refreshes:
+            rows = (Refresh.select(Refresh.insee)
+                           .where(Refresh.pk << refreshes).tuples())
+            refs |= {insee for insee, in rows}
+        if not refs:
+            return
+        with self._lock:
+            self._generation += 1
+            if None in refs:
+                # Changes in unknown municipalities.
+                self._bundles.clear()
+            for key, bundle in list(self._bundles.items()):
+                if key in refs or bundle.ids & refs:
+                    del self._bundles[key]
+
+
+cache = BundleCache()
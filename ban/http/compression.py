@@ -0,0 +1,92 @@
+import gzip
+
+from ban.core import config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# By order of preference, when the client gives them the same quality.
+ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/plain',
+                'text/csv', 'application/vnd.mapbox-vector-tile')
+
+
+def min_size():
+    return int(config.get('COMPRESS_MIN_SIZE', 1024))
+
+
+def level():
+    return int(config.get('COMPRESS_LEVEL', 6))
+
+
+def negotiate(accept_encodings):
+    """Return the preferred supported encoding from request Accept-Encoding
+    header, or None."""
+    return accept_encodings.best_match(ENCODINGS)
+
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level())
+    if encoding == 'br':
+        # Brotli quality goes up to 11, gzip level up to 9.
+        return brotli.compress(data, quality=min(level() + 2, 11))
+    raise ValueError('Unsupported encoding {}'.format(encoding))
+
+
+class CompressedBody:
+    """Response body that compresses itself once per encoding.
+
+    Meant to be stored in caches, so that the compression cost is only paid
+    on the first response served for a given encoding.
+    """
+
+    def __init__(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.data = data
+        self._encoded = {}
+
+    def __len__(self):
+        return len(self.data)
+
+    def encode(self, encoding=None):
+        if not encoding:
+            return self.data
+        if encoding not in self._encoded:
+            self._encoded[encoding] = compress(self.data, encoding)
+        return self._encoded[encoding]
+
+
+def compress_response(response, accept_encodings):
+    """Compress response body in place according to client capabilities.
+
+    A view can attach a cached `CompressedBody` as `response.compressed_body`
+    to reuse the already compressed payload."""
+    response.vary.add('Accept-Encoding')
+    if (response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.status_code < 200
+            or response.status_code in (204, 304)
+            or response.mimetype not in COMPRESSIBLE):
+        return response
+    body = getattr(response, 'compressed_body', None)
+    if body is not None:
+        size = len(body)
+    else:
+        size = response.calculate_content_length()
+    if not size or size < min_size():
+        return response
+    encoding = negotiate(accept_encodings)
+    if not encoding:
+        return response
+    if body is None:
+        body = CompressedBody(response.get_data())
+    response.set_data(body.encode(encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag('{}-{}'.format(etag, encoding), weak)
+    return response
@@ -0,0 +1,162 @@
+"""Per client rate limiting and admission control of expensive endpoints.
+
+Limits are per process: with several workers, the effective rate is
+multiplied by the number of workers.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from ban.core import config
+
+from .utils import abort
+
+
+def parse_limit(value):
+    """Parse "rate[/burst]" (in requests per second) into (rate, burst)."""
+    rate, _, burst = str(value).partition('/')
+    rate = float(rate)
+    burst = float(burst) if burst else max(rate * 2, 1)
+    return rate, burst
+
+
+def parse_limits(value):
+    """Parse RATE_LIMITS, either a dict or a "key=rate[/burst],…" string,
+    where key is a client_id or "scope:<name>"."""
+    if not value:
+        return {}
+    if isinstance(value, str):
+        value = dict(item.strip().split('=', 1)
+                     for item in value.split(',') if item.strip())
+    return {key.strip(): parse_limit(limit) for key, limit in value.items()}
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Consume one token, and return 0, or the number of seconds to wait
+        before a token is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Token buckets by client, configured with RATE_LIMIT (default for all
+    clients, 0 to disable) and RATE_LIMITS (per client or scope)."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def limit_for(self, token):
+        """Return (rate, burst) for this token, or None if not limited."""
+        limits = parse_limits(config.get('RATE_LIMITS'))
+        client = token.session.client
+        if client and str(client.client_id) in limits:
+            return limits[str(client.client_id)]
+        scoped = [limits['scope:{}'.format(scope)]
+                  for scope in token.scopes or []
+                  if 'scope:{}'.format(scope) in limits]
+        if scoped:
+            # The most generous scope wins.
+            return max(scoped)
+        default = config.get('RATE_LIMIT')
+        if default:
+            rate, burst = parse_limit(default)
+            if rate:
+                return rate, burst
+        return None
+
+    def check(self, token):
+        limit = self.limit_for(token)
+        if limit is None:
+            return
+        session = token.session
+        key = (('client', session.client.pk) if session.client
+               else ('user', session.user.pk if session.user else None))
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or (bucket.rate, bucket.burst) != limit:
+                bucket = self._buckets[key] = TokenBucket(*limit)
+            wait = bucket.take()
+        if wait:
+            abort(429, headers={'Retry-After': str(math.ceil(wait))},
+                  error='Rate limit exceeded')
+
+
+rate_limiter = RateLimiter()
+
+
+class Admission:
+    """Cap the number of expensive requests running concurrently, making
+    the others wait in line up to EXPENSIVE_QUEUE_TIMEOUT seconds."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._semaphore = None
+        self._size = None
+        self._local = threading.local()
+
+    @property
+    def size(self):
+        return int(config.get('EXPENSIVE_CONCURRENCY', 4))
+
+    @property
+    def timeout(self):
+        return float(config.get('EXPENSIVE_QUEUE_TIMEOUT', 10))
+
+    @property
+    def semaphore(self):
+        with self._lock:
+            if self._semaphore is None or self._size != self.size:
+                self._size = self.size
+                self._semaphore = threading.BoundedSemaphore(self._size)
+            return self._semaphore
+
+    @contextmanager
+    def slot(self, needed=True):
+        # Nested slots (eg. a big page of an expensive endpoint) reuse the
+        # one already held by the thread.
+        if not needed or getattr(self._local, 'held', False):
+            yield
+            return
+        semaphore = self.semaphore
+        if not semaphore.acquire(timeout=self.timeout):
+            abort(503, headers={'Retry-After': str(math.ceil(self.timeout))},
+                  error='Too many expensive requests, retry later')
+        self._local.held = True
+        try:
+            yield
+        finally:
+            self._local.held = False
+            semaphore.release()
+
+
+admission = Admission()
+
+
+def expensive(func):
+    """Run the decorated view within an admission slot."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with admission.slot():
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,161 @@
+"""Per endpoint request and SQL metrics, exposed in Prometheus text format.
+
+Metrics are per process: each worker must be scraped on its own.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from werkzeug.wsgi import ClosingIterator
+
+from ban.core import context
+
+ENVIRON_KEY = 'ban.metrics'
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MIMETYPE = 'text/plain; version=0.0.4'
+
+
+class RequestStats:
+    """Timings of the current request, SQL queries included."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.endpoint = None
+        self.sql_count = 0
+        self.sql_time = 0
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def add_query(self, duration):
+        self.sql_count += 1
+        self.sql_time += duration
+
+
+def record_query(duration):
+    """Called by the database for each executed statement."""
+    stats = context.get('request_stats')
+    if stats is not None:
+        stats.add_query(duration)
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.requests = defaultdict(int)
+        self.latency = defaultdict(Histogram)
+        self.sql_count = defaultdict(int)
+        self.sql_time = defaultdict(float)
+
+    def record(self, stats, method, status):
+        # Unrouted requests (404…) are gathered, to keep a bounded number of
+        # series.
+        endpoint = stats.endpoint or 'unknown'
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.latency[endpoint].observe(stats.elapsed)
+            self.sql_count[endpoint] += stats.sql_count
+            self.sql_time[endpoint] += stats.sql_time
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, doc):
+            lines.append('# HELP {} {}'.format(name, doc))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        def sample(name, labels, value):
+            labels = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+            lines.append('{}{{{}}} {}'.format(name, labels, value))
+
+        with self._lock:
+            metric('ban_http_requests_total', 'counter',
+                   'Number of HTTP requests.')
+            for (endpoint, method, status), count in sorted(
+                    self.requests.items()):
+                sample('ban_http_requests_total', [
+                    ('endpoint', endpoint), ('method', method),
+                    ('status', status)], count)
+            name = 'ban_http_request_duration_seconds'
+            metric(name, 'histogram', 'HTTP request latency.')
+            for endpoint, histogram in sorted(self.latency.items()):
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    sample(name + '_bucket', [('endpoint', endpoint),
+                                              ('le', bound)], count)
+                sample(name + '_bucket', [('endpoint', endpoint),
+                                          ('le', '+Inf')], histogram.count)
+                sample(name + '_sum', [('endpoint', endpoint)],
+                       histogram.sum)
+                sample(name + '_count', [('endpoint', endpoint)],
+                       histogram.count)
+            metric('ban_sql_queries_total', 'counter',
+                   'Number of SQL statements run by HTTP requests.')
+            for endpoint, count in sorted(self.sql_count.items()):
+                sample('ban_sql_queries_total', [('endpoint', endpoint)],
+                       count)
+            metric('ban_sql_duration_seconds_total', 'counter',
+                   'Time spent in SQL statements by HTTP requests.')
+            for endpoint, duration in sorted(self.sql_time.items()):
+                sample('ban_sql_duration_seconds_total',
+                       [('endpoint', endpoint)], duration)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Instrumentation:
+    """WSGI middleware recording each request in the registry, once its
+    body has been fully sent."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        stats = environ[ENVIRON_KEY] = RequestStats()
+        context.set('request_stats', stats)
+        status = []
+
+        def _start_response(status_, headers, exc_info=None):
+            status[:] = [status_.split(' ', 1)[0]]
+            return start_response(status_, headers, exc_info)
+
+        def finish():
+            context.set('request_stats', None)
+            registry.record(stats, environ.get('REQUEST_METHOD'),
+                            status[0] if status else '500')
+
+        try:
+            iterable = self.app(environ, _start_response)
+        except Exception:
+            finish()
+            raise
+        return ClosingIterator(iterable, [finish])
+
+
+def server_timing(stats):
+    """Server-Timing header value for the current request stats."""
+    return ('sql;dur={:.2f};desc="{} queries", app;dur={:.2f}'
+            .format(stats.sql_time * 1000, stats.sql_count,
+                    stats.elapsed * 1000))
@@ -1,6 +1,16 @@
+import hashlib
+import json
+import threading
+from copy import deepcopy
+from pathlib import Path
+
 import yaml
 
 from ban import __version__, db
+from ban.core import config
+from ban.core.encoder import dumps
+
+from .compression import CompressedBody
 
 
 BASE = {
@@ -50,10 +60,103 @@ BASE = {
 
 
 class Schema(dict):
+    """OpenAPI schema, built lazily.
+
+    Models and endpoints are only recorded at import time: docstrings are
+    parsed on first `load`, unless a cached artifact (see `dump`) matching
+    the current code is available.
+    """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.update(BASE)
+        self.update(deepcopy(BASE))
+        self._models = []
+        self._endpoints = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._built = False
+        self._encoded = None
+        self._etag = None
+
+    @property
+    def path(self):
+        return Path(config.get('OPENAPI_PATH',
+                               Path(__file__).parent / 'openapi.json'))
+
+    @property
+    def key(self):
+        """Hash of what the schema is built from, to validate artifacts."""
+        hash_ = hashlib.sha1(__version__.encode())
+        for model in self._models:
+            hash_.update(model.__name__.encode())
+            if hasattr(model, '__openapi__'):
+                hash_.update(model.__openapi__.encode())
+            else:
+                # The definition itself, not a partial list of its inputs.
+                definition = self.model_definition(model)
+                hash_.update(json.dumps(definition, sort_keys=True,
+                                        default=str).encode())
+        for path, func, methods, endpoint in self._endpoints:
+            hash_.update('{}{}{}{}'.format(path, methods, endpoint.__name__,
+                                           func.__doc__).encode())
+        return hash_.hexdigest()
+
+    def build(self):
+        """Parse models and endpoints docstrings into the schema."""
+        self.clear()
+        self.update(deepcopy(BASE))
+        for model in self._models:
+            self.add_model(model)
+        for path, func, methods, endpoint in self._endpoints:
+            self.add_endpoint(path, func, methods, endpoint)
+
+    def load(self):
+        """Build the schema or load it from a valid artifact, only once."""
+        if self._built:
+            return self
+        with self._lock:
+            if not self._built:
+                data = self.load_artifact()
+                if data is None:
+                    self.build()
+                else:
+                    self.clear()
+                    self.update(data)
+                self._built = True
+        return self
+
+    def load_artifact(self):
+        try:
+            with self.path.open(encoding='utf-8') as f:
+                artifact = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if artifact.get('key') != self.key:
+            return None
+        return artifact.get('schema')
+
+    def dump(self, path=None):
+        """Write the schema as an artifact to be loaded by next processes."""
+        path = Path(path or self.path)
+        self.load()
+        with path.open('w', encoding='utf-8') as f:
+            f.write(dumps({'key': self.key, 'schema': self}))
+        return path
+
+    @property
+    def encoded(self):
+        """Schema as (pre)compressed JSON bytes."""
+        if self._encoded is None:
+            self._encoded = CompressedBody(dumps(self.load()))
+        return self._encoded
+
+    @property
+    def etag(self):
+        if self._etag is None:
+            self._etag = hashlib.sha1(self.encoded.data).hexdigest()
+        return self._etag
 
     def get_responder_summary(self, responder, resource):
         return (responder.__doc__ or '').split('\n\n')[0].format(
@@ -77,6 +180,10 @@ class Schema(dict):
         return default
 
     def register_model(self, model):
+        self._models.append(model)
+        self.reset()
+
+    def add_model(self, model):
         if hasattr(model, '__openapi__'):
             definition = yaml.load(model.__openapi__)
         else:
@@ -135,6 +242,10 @@ class Schema(dict):
         return schema
 
     def register_endpoint(self, path, func, methods, endpoint):
+        self._endpoints.append((path, func, methods, endpoint))
+        self.reset()
+
+    def add_endpoint(self, path, func, methods, endpoint):
         definition = {verb.lower(): self.get_responder_doc(func, endpoint)
                       for verb in methods}
         if path in self['paths']:
@@ -0,0 +1,254 @@
+"""Mapbox Vector Tiles of positions and housenumbers, rendered by PostGIS."""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import peewee
+
+from ban.core import config, models, versioning
+
+from .compression import CompressedBody
+
+MIMETYPE = 'application/vnd.mapbox-vector-tile'
+EXTENT = 4096
+BUFFER = 64
+MIN_ZOOM = 8
+# From this zoom, all positions are rendered, without thinning.
+FULL_ZOOM = 16
+MAX_ZOOM = 22
+# Half the Web Mercator world width, in meters.
+ORIGIN = 20037508.342789244
+
+
+def is_valid(z, x, y):
+    return MIN_ZOOM <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_bounds(z, x, y):
+    """Return (xmin, ymin, xmax, ymax) of a tile, in EPSG:3857."""
+    size = 2 * ORIGIN / 2 ** z
+    xmin = -ORIGIN + x * size
+    ymax = ORIGIN - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def tile_for(lon, lat, z):
+    """Return (x, y) of the tile containing lon/lat at zoom z."""
+    n = 2 ** z
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180) / 360 * n)
+    rad = math.radians(lat)
+    y = int((1 - math.log(math.tan(rad) + 1 / math.cos(rad)) / math.pi) / 2
+            * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def grid_size(z):
+    """Thinning grid cell size, in meters, or None to keep all features."""
+    if z >= FULL_ZOOM:
+        return None
+    # Keep at most one feature per 16x16 tile units cell.
+    return 2 * ORIGIN / 2 ** z / EXTENT * 16
+
+
+def layer_query(z, x, y, housenumbers=False):
+    Position, HouseNumber = models.Position, models.HouseNumber
+    envelope = peewee.fn.ST_MakeEnvelope(*(tile_bounds(z, x, y) + (3857,)))
+    center = peewee.fn.ST_Transform(Position.center, 3857)
+    geom = peewee.fn.ST_AsMVTGeom(center, envelope, EXTENT, BUFFER, True)
+    fields = [geom.alias('geom'), HouseNumber.id.alias('housenumber'),
+              HouseNumber.number, HouseNumber.ordinal, HouseNumber.cia]
+    if not housenumbers:
+        fields += [Position.id.alias('id'), Position.kind,
+                   Position.positioning]
+    qs = (Position.select(*fields)
+                  .join(HouseNumber)
+                  .where(HouseNumber.deleted_at.is_null(),
+                         Position.center.contained(
+                            peewee.fn.ST_Transform(envelope, 4326))))
+    distinct = []
+    if housenumbers:
+        # One point per housenumber.
+        distinct.append(HouseNumber.pk)
+    size = grid_size(z)
+    if size:
+        distinct.insert(0, peewee.fn.ST_SnapToGrid(center, size))
+    if distinct:
+        qs = qs.distinct(distinct).order_by(*distinct + [Position.pk])
+    return qs
+
+
+def render(z, x, y):
+    """Return the tile as MVT bytes, with a `positions` layer and a
+    `housenumbers` layer (one point per housenumber)."""
+    database = models.Position._meta.database
+    data = b''
+    for name, housenumbers in (('positions', False), ('housenumbers', True)):
+        sql, params = layer_query(z, x, y, housenumbers).sql()
+        sql = ('SELECT ST_AsMVT(tile, %s, %s, %s) FROM ({}) AS tile'
+               .format(sql))
+        row = database.execute_sql(sql, [name, EXTENT, 'geom'] + params)
+        row = row.fetchone()
+        if row and row[0]:
+            # MVT layers can be concatenated.
+            data += bytes(row[0])
+    return data
+
+
+def housenumber_centers(ids):
+    """Points the housenumbers of ids are rendered at: their cached center
+    and the centers of their positions, deleted ones included."""
+    if not ids:
+        return []
+    HouseNumber, Position = models.HouseNumber, models.Position
+    centers = (HouseNumber.raw_select(HouseNumber.center)
+                          .where(HouseNumber.id << list(ids),
+                                 HouseNumber.center.is_null(False))
+                          .tuples())
+    positions = (Position.raw_select(Position.center)
+                         .join(HouseNumber)
+                         .where(HouseNumber.id << list(ids),
+                                Position.center.is_null(False))
+                         .tuples())
+    return [center for center, in centers] + [center for center,
+                                              in positions]
+
+
+def municipality_bounds(insees):
+    """(west, south, east, north) of the positions of each municipality of
+    insees, deleted ones included."""
+    Position, HouseNumber = models.Position, models.HouseNumber
+    Group, Municipality = models.Group, models.Municipality
+    extent = peewee.fn.ST_Extent(Position.center)
+    return (Position.raw_select(peewee.fn.ST_XMin(extent),
+                                peewee.fn.ST_YMin(extent),
+                                peewee.fn.ST_XMax(extent),
+                                peewee.fn.ST_YMax(extent))
+                    .join(HouseNumber)
+                    .join(Group)
+                    .join(Municipality)
+                    .where(Municipality.insee << list(insees),
+                           Position.center.is_null(False))
+                    .group_by(Municipality.pk)
+                    .order_by()
+                    .tuples())
+
+
+class TileCache:
+    """LRU cache of rendered tiles, invalidated by position and housenumber
+    diffs."""
+
+    def __init__(self):
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self._diffs = versioning.Feed(versioning.Diff)
+        self._refreshes = versioning.Feed(versioning.Refresh)
+        # Incremented by evictions: tiles rendered meanwhile may be stale.
+        self._generation = 0
+        self._last_check = 0
+
+    @property
+    def max_size(self):
+        return int(config.get('TILES_CACHE_SIZE', 10000))
+
+    @property
+    def refresh_interval(self):
+        return float(config.get('TILES_REFRESH_INTERVAL', 1))
+
+    def get(self, z, x, y):
+        self.refresh()
+        with self._lock:
+            body = self._tiles.get((z, x, y))
+            if body is not None:
+                self._tiles.move_to_end((z, x, y))
+            generation = self._generation
+        if body is None:
+            body = CompressedBody(render(z, x, y))
+            with self._lock:
+                if generation != self._generation:
+                    # Changes seen while rendering may have been missed.
+                    return body
+                self._tiles[(z, x, y)] = body
+                while len(self._tiles) > self.max_size:
+                    self._tiles.popitem(last=False)
+        return body
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._diffs = versioning.Feed(versioning.Diff)
+            self._refreshes = versioning.Feed(versioning.Refresh)
+
+    def refresh(self, force=False):
+        """Evict tiles touched by position and housenumber diffs created
+        since last call, or by imports skipping diffs."""
+        now = time.monotonic()
+        if not force and now - self._last_check < self.refresh_interval:
+            return
+        self._last_check = now
+        Diff, Version = versioning.Diff, versioning.Version
+        Refresh = versioning.Refresh
+        diffs = self._diffs.poll()
+        if diffs:
+            versions = (Version.select(Version.model_name, Version.data)
+                               .join(Diff, on=((Diff.new == Version.pk) |
+                                               (Diff.old == Version.pk)))
+                               .where(Diff.pk << diffs,
+                                      Version.model_name << ['position',
+                                                             'housenumber'])
+                               .tuples())
+            housenumbers = set()
+            for model_name, data in versions:
+                data = data or {}
+                if model_name == 'housenumber':
+                    # The housenumbers layer renders number, ordinal and
+                    # cia.
+                    if data.get('id'):
+                        housenumbers.add(data['id'])
+                    continue
+                center = data.get('center')
+                if center:
+                    self.evict(*center['coordinates'][:2])
+            for center in housenumber_centers(housenumbers):
+                self.evict(*center.coords[:2])
+        refreshes = self._refreshes.poll()
+        if refreshes:
+            insees = {insee for insee, in (
+                Refresh.select(Refresh.insee)
+                       .where(Refresh.pk << refreshes).tuples())}
+            if None in insees:
+                # Changes in unknown municipalities.
+                with self._lock:
+                    self._tiles.clear()
+                    self._generation += 1
+            else:
+                for bounds in municipality_bounds(insees):
+                    self.evict_bounds(*bounds)
+
+    def evict(self, lon, lat):
+        """Remove all cached tiles (and their neighbours, because of the
+        tile buffer) containing lon/lat."""
+        with self._lock:
+            self._generation += 1
+            zooms = {z for z, x, y in self._tiles}
+            for z in zooms:
+                x, y = tile_for(lon, lat, z)
+                for dx in (-1, 0, 1):
+                    for dy in (-1, 0, 1):
+                        self._tiles.pop((z, x + dx, y + dy), None)
+
+
+    def evict_bounds(self, west, south, east, north):
+        """Remove all cached tiles (and their neighbours) intersecting the
+        west, south, east, north box."""
+        with self._lock:
+            self._generation += 1
+            for z, x, y in list(self._tiles):
+                xmin, ymin = tile_for(west, north, z)
+                xmax, ymax = tile_for(east, south, z)
+                if xmin - 1 <= x <= xmax + 1 and ymin - 1 <= y <= ymax + 1:
+                    del self._tiles[(z, x, y)]
+
+
+cache = TileCache()
@@ -30,6 +30,14 @@ def get_bbox(args):
     return bbox
 
 
+def get_grid_size(bbox, cells):
+    """Size of a grid cell, in degrees, so that the largest side of the bbox
+    is split in `cells` cells."""
+    width = abs(bbox['east'] - bbox['west'])
+    height = abs(bbox['north'] - bbox['south'])
+    return max(width, height) / cells or 1e-6
+
+
 # Do not encode them, as per RFC 3986
 RESERVED = ":/?#[]@!$&'()*+,;="
 
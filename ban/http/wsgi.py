@@ -3,13 +3,16 @@ from datetime import timezone
 from functools import wraps
 
 from dateutil.parser import parse as parse_date
-from flask import Flask, make_response
+from flask import Flask, make_response, request
 from flask_cors import CORS
 from werkzeug.routing import BaseConverter, ValidationError
 
+from ban import db
 from ban.core import context
 from ban.core.encoder import dumps
 
+from . import metrics
+from .compression import compress_response
 from .schema import Schema
 
 
@@ -77,6 +80,8 @@ class DateTimeConverter(BaseConverter):
 
 app = application = App(__name__)
 CORS(app)
+app.wsgi_app = metrics.Instrumentation(app.wsgi_app)
+db.default.listeners.append(metrics.record_query)
 app.url_map.converters['datetime'] = DateTimeConverter
 
 
@@ -101,3 +106,23 @@ def log_headers(resp):
         if session.user:
             resp.headers.add('Session-User', session.user.id)
     return resp
+
+
+@app.before_request
+def set_metrics_endpoint():
+    stats = request.environ.get(metrics.ENVIRON_KEY)
+    if stats:
+        stats.endpoint = request.endpoint
+
+
+@app.after_request
+def add_server_timing(resp):
+    stats = request.environ.get(metrics.ENVIRON_KEY)
+    if app.debug and stats:
+        resp.headers['Server-Timing'] = metrics.server_timing(stats)
+    return resp
+
+
+@app.after_request
+def compress(resp):
+    return compress_response(resp, request.accept_encodings)
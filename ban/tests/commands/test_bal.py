@@ -261,3 +261,18 @@ def test_bal_should_create_position_if_kind_does_not_exist(staff):
     assert position.center == (-1.52808691540987, 48.1396656060165)
     position.housenumber == housenumber
     old_position.housenumber == housenumber
+
+
+def test_load_csv_streams_rows_and_reports_bytes_read(tmpdir):
+    from ban.commands.helpers import load_csv
+    path = Path(str(tmpdir.join('bal.csv')))
+    path.write_bytes(codecs.BOM_UTF8 + ('numero;voie_nom\n' +
+                                        '1;Rue de l’Église\n' * 5000)
+                     .encode('utf-8'))
+    reader = load_csv(path, encoding='utf-8-sig')
+    rows = iter(reader)
+    assert next(rows) == {'numero': '1', 'voie_nom': 'Rue de l’Église'}
+    # Only the first block has been read.
+    assert reader.done < reader.size / 2
+    assert sum(1 for row in rows) == 4999
+    assert reader.done == reader.size
@@ -1,13 +1,24 @@
 import json
+import threading
+import time
 from unittest.mock import Mock
 from pathlib import Path
 
+import pytest
+
 from ban.auth import models as amodels
 from ban.commands.auth import (createclient, createuser, dummytoken,
                                listclients, listusers)
-from ban.commands.db import truncate
+from ban.commands.checkpoints import Checkpoint, Journal
+from ban.commands.db import reindex, truncate
 from ban.commands.export import resources
-from ban.core import models
+from ban.commands.helpers import (batch, chunks, nodiff, partition_of,
+                                  pipeline, split)
+from ban.commands.init import parse_line
+from ban.commands.lookups import Lookups
+from ban.commands.reporter import ERROR, NOTICE
+from ban.core import context, models
+from ban.core.versioning import Diff
 from ban.core.encoder import dumps
 from ban.tests import factories
 
@@ -103,6 +114,15 @@ def test_truncate_should_not_ask_for_confirm_in_force_mode(monkeypatch):
     assert not models.Municipality.select().count()
 
 
+def test_reindex_should_compute_missing_search_fields():
+    municipality = factories.MunicipalityFactory(name='Saint-Émilion')
+    models.Municipality.update(normalized=None).execute()
+    reindex()
+    municipality = models.Municipality.get(
+        models.Municipality.pk == municipality.pk)
+    assert municipality.normalized == 'saint emilion'
+
+
 def test_export_resources():
     mun = factories.MunicipalityFactory()
     street = factories.GroupFactory(municipality=mun)
@@ -143,3 +163,241 @@ def test_report_to(tmpdir, config):
     dummytoken.invoke(args)
     with report_to.open() as f:
         assert 'Created token' in f.read()
+
+
+def test_chunks_should_honour_size_and_skip_empty_items():
+    assert list(chunks([1, None, 2, 3, {}, 4, 5], 2)) == [[1, 2], [3, 4],
+                                                          [5]]
+
+
+def test_batch_should_rollback_only_failing_items(session, reporter):
+
+    def process(insee):
+        # Workers do not share the main thread context.
+        context.set('session', session)
+        # Second creation of the same insee fails on the unique index.
+        factories.MunicipalityFactory(insee=insee)
+
+    batch(process, ['12345', '12345', '12346'], chunksize=10,
+          progress=False)
+    assert models.Municipality.select().count() == 2
+    assert len(reporter._reports[ERROR]['Database error']) == 1
+
+
+def test_batch_workers_share_one_session_and_warm_lookups(staff, reporter,
+                                                          config):
+    config.WORKERS = 1
+    municipality = factories.MunicipalityFactory(insee='12345')
+    seen = []
+
+    def process(item):
+        seen.append((context.get('session'), context.get('lookups')))
+
+    batch(process, range(1, 6), chunksize=2, progress=False)
+    assert len(seen) == 5
+    assert len({session.pk for session, _ in seen}) == 1
+    lookups = seen[0][1]
+    assert lookups.municipalities['12345'].pk == municipality.pk
+
+
+def test_batch_should_skip_committed_chunks_when_resuming(tmpdir, staff,
+                                                          reporter, config):
+    config.WORKERS = 1
+    f = tmpdir.join('input')
+    f.write('data')
+    journal = Journal(str(f), 2)
+    journal.start()
+    journal.commit(0, {0: 2})
+    journal.commit(2, {0: 2})
+    seen = []
+    batch(seen.append, range(1, 8), chunksize=2, progress=False,
+          journal=journal, resume=True)
+    assert seen == [3, 4, 7]
+    assert reporter._reports[NOTICE]['Resuming, skipped committed chunks']
+    # Once done, there is nothing left to resume.
+    assert journal.start(resume=True) == set()
+
+
+def test_journal_should_forget_checkpoints_of_a_changed_file(tmpdir):
+    f = tmpdir.join('input')
+    f.write('data')
+    journal = Journal(str(f), 2)
+    journal.start()
+    journal.commit(0, {0: 2})
+    f.write('changed')
+    Journal(str(f), 2).start()
+    assert not Checkpoint.select().count()
+
+
+def test_batch_should_record_committed_chunks(tmpdir, staff, reporter,
+                                              config, monkeypatch):
+    config.WORKERS = 1
+    f = tmpdir.join('input')
+    f.write('data')
+    journal = Journal(str(f), 2)
+    # Keep the checkpoints to inspect them.
+    monkeypatch.setattr(journal, 'clear', lambda: None)
+    batch(lambda item: None, range(1, 6), chunksize=2, progress=False,
+          journal=journal)
+    assert journal.start(resume=True) == {(0, 0), (1, 0), (2, 0)}
+    f.write('changed')
+    assert Journal(str(f), 2).fingerprint != journal.fingerprint
+    assert Journal(str(f), 3).fingerprint != Journal(str(f), 2).fingerprint
+
+
+def test_nodiff_only_skips_the_diffs_of_the_current_thread(session):
+
+    def create(insee):
+        context.set('session', session)
+        factories.MunicipalityFactory(insee=insee)
+
+    @nodiff
+    def load():
+        create('12345')
+        thread = threading.Thread(target=create, args=['12346'])
+        thread.start()
+        thread.join()
+
+    load()
+    assert Diff.select().count() == 1
+
+
+def test_batch_workers_should_skip_diffs_within_nodiff(session, reporter):
+
+    def process(insee):
+        context.set('session', session)
+        factories.MunicipalityFactory(insee=insee)
+
+    nodiff(batch)(process, ['12345', '12346'], chunksize=1, progress=False)
+    assert models.Municipality.select().count() == 2
+    assert not Diff.select().count()
+
+
+def test_split_should_group_items_by_lane_keeping_order():
+    items = [('a', 1), ('b', 1), ('a', 2), ('c', 1), ('b', 2)]
+    keys = set()
+    lanes = split(3, items, lambda item: item[0], 2,
+                  skip={(3, partition_of('c'))}, keys=keys)
+    # Skipped items are counted in.
+    assert keys == {'a', 'b', 'c'}
+    for lane, (parts, chunk) in lanes.items():
+        assert all(partition_of(key) % 2 == lane for key, _ in chunk)
+        assert sum(parts.values()) == len(chunk)
+    parted = [chunk for _, chunk in lanes.values()]
+    assert sorted(item for chunk in parted for item in chunk) == [
+        ('a', 1), ('a', 2), ('b', 1), ('b', 2)]
+    for chunk in parted:
+        assert chunk == sorted(chunk, key=lambda item: item[1])
+
+
+def test_batch_should_process_a_partition_in_order(staff, reporter, config):
+    config.WORKERS = 4
+    items = [(key, number) for number in range(20) for key in 'abcdef']
+    seen = []
+    batch(seen.append, items, chunksize=5, progress=False,
+          partition=lambda item: item[0])
+    assert sorted(seen) == sorted(items)
+    for key in 'abcdef':
+        assert [n for k, n in seen if k == key] == list(range(20))
+
+
+def test_pipeline_should_parse_in_processes_keeping_order():
+    lines = ['{"line": %d}\n' % i for i in range(10)] + ['\n']
+    feed = pipeline(lines, 3, 1, parse=parse_line, skip={1}, parsers=2)
+    parsed = [chunk for index, chunk, progress in feed]
+    assert parsed[0] == [{'line': 0}, {'line': 1}, {'line': 2}]
+    # Skipped chunks are not parsed.
+    assert parsed[1] == lines[3:6]
+    # Blank lines are dropped.
+    assert parsed[3] == [{'line': 9}]
+
+
+def test_pipeline_should_raise_reading_errors():
+
+    def rows():
+        yield 'first'
+        raise ValueError('Corrupted')
+
+    with pytest.raises(ValueError):
+        list(pipeline(rows(), 1, 1))
+
+
+def test_pipeline_should_stop_reading_once_closed():
+    read = []
+
+    def rows():
+        for row in range(1, 101):
+            read.append(row)
+            yield row
+
+    feed = pipeline(rows(), 1, 1)
+    assert next(feed)[1] == [1]
+    feed.close()
+    # Let the reader notice.
+    time.sleep(0.5)
+    count = len(read)
+    assert count < 100
+    time.sleep(0.2)
+    assert len(read) == count
+
+
+def test_lookups_load_groups_by_municipality():
+    group = factories.GroupFactory(municipality__insee='12345',
+                                   fantoir='123450001', ign='IGNGROUP')
+    lookups = Lookups()
+    assert lookups.group('fantoir', '1234500012').pk == group.pk
+    assert '12345' in lookups.loaded
+    assert lookups.group('ign', 'IGNGROUP').pk == group.pk
+
+
+def test_lookups_load_should_serve_found_and_missing_values(monkeypatch):
+    housenumber = factories.HouseNumberFactory()
+    lookups = Lookups()
+    lookups.load(models.HouseNumber, 'cia', [housenumber.cia, '90001_XXXX_1_'])
+
+    def first(*args, **kwargs):
+        raise AssertionError('Should not query')
+
+    monkeypatch.setattr(models.HouseNumber, 'first', first)
+    found = lookups.find(models.HouseNumber, 'cia', housenumber.cia)
+    assert found.pk == housenumber.pk
+    assert lookups.find(models.HouseNumber, 'id', housenumber.id) == found
+    assert lookups.find(models.HouseNumber, 'cia', '90001_XXXX_1_') is None
+
+
+def test_lookups_positions_should_include_added_positions():
+    housenumber = factories.HouseNumberFactory()
+    lookups = Lookups()
+    assert lookups.positions(housenumber) == []
+    position = factories.PositionFactory(housenumber=housenumber)
+    lookups.add(position)
+    assert lookups.positions(housenumber) == [position]
+
+
+def test_lookups_housenumber_should_find_by_number(monkeypatch):
+    housenumber = factories.HouseNumberFactory(number='12', ordinal='bis')
+    parent = housenumber.parent
+    lookups = Lookups()
+    lookups.load_housenumbers([parent])
+
+    def select(*args, **kwargs):
+        raise AssertionError('Should not query')
+
+    monkeypatch.setattr(models.HouseNumber, 'select', select)
+    found = lookups.housenumber(parent, '12', 'bis')
+    assert found.pk == housenumber.pk
+    assert lookups.housenumber(parent, '12') is None
+    found.number = '13'
+    assert lookups.housenumber(parent, '12', 'bis') is None
+
+
+def test_lookups_warm_should_share_tables_until_they_change():
+    factories.MunicipalityFactory(insee='12345')
+    first, second = Lookups(), Lookups()
+    first.warm()
+    second.warm()
+    assert first.municipalities['12345'] is second.municipalities['12345']
+    assert first.municipalities is not second.municipalities
+    factories.MunicipalityFactory(insee='12346')
+    second.warm()
+    assert '12346' in second.municipalities
@@ -1,7 +1,12 @@
 import json
+from pathlib import Path
 
-from ban.commands.init import process_row, init
-from ban.core import models
+import pytest
+
+from ban.commands.bulk import load
+from ban.commands.init import expand, init, plan, process_row
+from ban.commands.reporter import ERROR
+from ban.core import models, stats
 from ban.tests import factories
 
 
@@ -454,3 +459,127 @@ def test_import_group_from_bano_dgfip(session):
     assert group.name == 'Lotissement Bellevue'
     assert group.addressing == 'classical'
     assert group.version == 2
+
+
+def test_bulk_init_creates_resources_and_versions(tmpdir, session):
+    rows = [
+        {'type': 'municipality', 'source': 'INSEE/COG (2015)',
+         'insee': '33001', 'name': 'Abzac'},
+        {'type': 'postcode', 'source': 'La Poste (2016-03)',
+         'postcode': '33230', 'name': 'ABZAC', 'municipality:insee': '33001'},
+        {'type': 'group', 'source': 'DGFIP/FANTOIR (2015-07)',
+         'group': 'way', 'municipality:insee': '33001',
+         'fantoir': '330010005A', 'name': "Rue de l'Église"},
+        {'type': 'housenumber', 'source': 'BAN (2016-06-05)',
+         'group:fantoir': '330010005', 'numero': '1', 'ordinal': 'bis',
+         'postcode:code': '33230'},
+        {'type': 'position', 'kind': 'entrance', 'source': 'BAN (2016-06-05)',
+         'housenumber:cia': '33001_0005_1_bis', 'ign': 'ADRNIVX_1',
+         'geometry': {'type': 'Point', 'coordinates': [-0.12, 45.01]}},
+    ]
+    f = tmpdir.join('init.json')
+    f.write('\n'.join(json.dumps(row) for row in rows) + '\n')
+    init(str(f), bulk=True)
+    group = models.Group.get(models.Group.fantoir == '330010005')
+    assert group.municipality.insee == '33001'
+    assert group.normalized == 'rue de l eglise'
+    housenumber = models.HouseNumber.first()
+    assert housenumber.cia == '33001_0005_1_BIS'
+    assert housenumber.parent == group
+    assert housenumber.postcode.code == '33230'
+    assert housenumber.center.coords == (-0.12, 45.01)
+    position = models.Position.first()
+    assert position.housenumber == housenumber
+    assert position.positioning == 'other'
+    version = housenumber.load_version()
+    assert version.data == housenumber.as_version
+    assert position.load_version().data == position.as_version
+
+
+def test_bulk_init_skips_existing_and_invalid_rows(tmpdir, session):
+    factories.MunicipalityFactory(insee='33001')
+    rows = [
+        {'type': 'municipality', 'source': 'INSEE/COG (2015)',
+         'insee': '33001', 'name': 'Abzac'},
+        {'type': 'municipality', 'source': 'INSEE/COG (2015)',
+         'insee': '33002', 'name': 'Aillas'},
+        {'type': 'municipality', 'source': 'INSEE/COG (2015)',
+         'insee': '33002', 'name': 'Aillas'},
+        {'type': 'municipality', 'source': 'INSEE/COG (2015)',
+         'insee': '330030', 'name': 'Ambarès'},
+        {'type': 'group', 'source': 'IGN (2016-06)', 'ign': 'X',
+         'municipality:insee': '99999', 'name': 'Nowhere', 'group': 'way'},
+    ]
+    f = tmpdir.join('init.json')
+    f.write('\n'.join(json.dumps(row) for row in rows) + '\n')
+    init(str(f), bulk=True)
+    assert models.Municipality.select().count() == 2
+    assert not models.Group.select().count()
+
+
+def test_bulk_load_skips_blank_lines(tmpdir, session, reporter):
+    row = {'type': 'municipality', 'source': 'INSEE/COG (2015)',
+           'insee': '33001', 'name': 'Abzac'}
+    f = tmpdir.join('init.json')
+    f.write('\n' + json.dumps(row) + '\n\n  \n')
+    assert load(str(f)) == 1
+    assert models.Municipality.select().count() == 1
+    assert not reporter._reports[ERROR]
+
+
+def test_bulk_init_cannot_be_resumed(tmpdir, session):
+    f = tmpdir.join('init.json')
+    f.write(json.dumps({'type': 'municipality', 'insee': '33001',
+                        'name': 'Abzac'}) + '\n')
+    with pytest.raises(SystemExit):
+        init(str(f), bulk=True, resume=True)
+    assert not models.Municipality.select().count()
+
+
+# Fewer workers than files: files share them, and wait in turn.
+@pytest.mark.parametrize('workers', [2, 8])
+def test_init_should_import_a_directory_in_dependency_order(tmpdir, session,
+                                                           config, workers):
+    config.WORKERS = workers
+    rows = {
+        # File names are in reverse dependency order.
+        'a.json': {'type': 'position', 'kind': 'entrance',
+                   'source': 'BAN (2016-06-05)',
+                   'housenumber:cia': '33001_0005_1_',
+                   'geometry': {'type': 'Point',
+                                'coordinates': [-0.12, 45.01]}},
+        'b.json': {'type': 'housenumber', 'source': 'BAN (2016-06-05)',
+                   'group:fantoir': '330010005', 'numero': '1'},
+        'c.json': {'type': 'group', 'source': 'DGFIP/FANTOIR (2015-07)',
+                   'group': 'way', 'municipality:insee': '33001',
+                   'fantoir': '330010005', 'name': 'Rue des Écoles'},
+        'd.json': {'type': 'municipality', 'source': 'INSEE/COG (2015)',
+                   'insee': '33001', 'name': 'Abzac'},
+    }
+    for name, row in rows.items():
+        tmpdir.join(name).write(json.dumps(row) + '\n')
+    init(str(tmpdir))
+    position = models.Position.first()
+    assert position.housenumber.cia == '33001_0005_1_'
+    assert position.housenumber.parent.municipality.insee == '33001'
+    # Not tracked row by row, rebuilt once done.
+    assert stats.count('positions') == 1
+
+
+def test_init_plan_should_only_wait_for_needed_files(tmpdir):
+    for name, kind in [('mun', 'municipality'), ('pc', 'postcode'),
+                       ('group', 'group'), ('hn', 'housenumber')]:
+        tmpdir.join(name + '.json').write(json.dumps({'type': kind}))
+    tmpdir.join('import.manifest').write('# Groups only.\ngroup.json\n')
+    assert [p.name for p in expand([str(tmpdir.join('import.manifest'))])
+            ] == ['group.json']
+    paths = [str(tmpdir.join(name + '.json'))
+             for name in ['hn', 'group', 'pc', 'mun']]
+    needs = {path.name: sorted(p.name for p in needed)
+             for path, needed in plan(map(Path, paths))}
+    assert needs == {
+        'mun.json': [],
+        'pc.json': ['mun.json'],
+        'group.json': ['mun.json'],
+        'hn.json': ['group.json', 'mun.json', 'pc.json'],
+    }
@@ -1,6 +1,9 @@
 import pytest
 
-from ..factories import ClientFactory, UserFactory
+from ban.auth import models
+from ban.http.auth import tokens
+
+from ..factories import ClientFactory, TokenFactory, UserFactory
 
 
 def test_access_token_with_client_credentials_and_ip(client):
@@ -82,3 +85,34 @@ def test_can_request_token_with_json_enoded_body(client):
     }, content_type='application/json')
     assert resp.status_code == 200
     assert 'access_token' in resp.json
+
+
+def test_token_is_cached_with_its_session(get):
+    token = TokenFactory()
+    headers = {'Authorization': 'Bearer {}'.format(token.access_token)}
+    resp = get('/municipality', headers=headers)
+    assert resp.status_code == 200
+    models.Token.delete().where(models.Token.pk == token.pk).execute()
+    resp = get('/municipality', headers=headers)
+    assert resp.status_code == 200
+    assert resp.headers['Session-Client'] == token.session.client.id
+    tokens.invalidate(token.access_token)
+    resp = get('/municipality', headers=headers)
+    assert resp.status_code == 401
+
+
+def test_expired_token_is_not_accepted(get):
+    token = TokenFactory(expires_in=-60)
+    headers = {'Authorization': 'Bearer {}'.format(token.access_token)}
+    resp = get('/municipality', headers=headers)
+    assert resp.status_code == 401
+
+
+def test_revoke_token(client):
+    token = TokenFactory()
+    headers = {'Authorization': 'Bearer {}'.format(token.access_token)}
+    resp = client.post('/token/revoke', headers=headers)
+    assert resp.status_code == 204
+    assert not models.Token.select().count()
+    resp = client.get('/municipality', headers=headers)
+    assert resp.status_code == 401
@@ -0,0 +1,45 @@
+import pytest
+
+from ban.core.autocomplete import index
+
+from ..factories import GroupFactory
+from .utils import authorize
+
+
+@pytest.fixture
+def autocomplete(config):
+    config.AUTOCOMPLETE = True
+    config.AUTOCOMPLETE_REFRESH_INTERVAL = 0
+    index.clear()
+    yield
+    index.clear()
+
+
+def test_cannot_autocomplete_without_auth(get):
+    resp = get('/autocomplete?q=rue')
+    assert resp.status_code == 401
+
+
+@authorize
+def test_autocomplete_is_disabled_by_default(get):
+    resp = get('/autocomplete?q=rue')
+    assert resp.status_code == 501
+
+
+@authorize
+def test_autocomplete(get, autocomplete):
+    group = GroupFactory(name='Rue des Lilas')
+    resp = get('/autocomplete?q=rue des li')
+    assert resp.status_code == 200
+    assert resp.json['total'] == 1
+    assert resp.json['collection'][0]['id'] == group.id
+    # Index is refreshed from the diffs.
+    other = GroupFactory(name='Rue des Lys')
+    resp = get('/autocomplete?q=rue des l')
+    assert [r['id'] for r in resp.json['collection']] == [group.id, other.id]
+
+
+@authorize
+def test_autocomplete_without_query(get, autocomplete):
+    resp = get('/autocomplete')
+    assert resp.status_code == 400
@@ -1,5 +1,10 @@
+import os
 from io import BytesIO
 
+import pytest
+
+from ban.commands import jobs
+from ban.commands.checkpoints import Checkpoint, Journal
 from ban.core import models
 from ban.tests import factories
 
@@ -15,13 +20,22 @@ def test_bal_import_from_data_file(staff, client):
     resp = client.post('/import/bal',
                        data={'data': (BytesIO(content.encode()), 'test.csv')},
                        content_type='multipart/form-data')
-    assert resp.status_code == 200
+    assert resp.status_code == 202
+    assert resp.json['status'] == 'queued'
+    url = resp.headers['Location']
+    assert url.endswith('/import/jobs/{}'.format(resp.json['id']))
+    jobs.runner.join()
     assert models.Group.select().count() == 1
     group = models.Group.select().first()
     assert group.name == "Mail Anita Conti"
     assert group.fantoir == "350010005"
-    assert 'report' in resp.json
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert resp.json['status'] == 'done'
+    assert resp.json['progress'] == 100
+    assert resp.json['counts']['notice'] == 1
     assert 'notice' in resp.json['report']
+    assert not os.path.exists(jobs.Job.get().path)
 
 
 def test_cannot_use_bal_import_without_auth(staff, client):
@@ -36,3 +50,72 @@ def test_data_file_is_mandatory(staff, client):
     resp = client.post('/import/bal', data={'badname': (b'aaa', 'test.csv')},
                        content_type='multipart/form-data')
     assert resp.status_code == 400
+
+
+@authorize
+def test_queued_import_job_can_be_cancelled(session, client):
+    job = jobs.Job.create(kind='bal', path='/tmp/missing.csv', size=10,
+                          session=session)
+    resp = client.delete('/import/jobs/{}'.format(job.pk))
+    assert resp.status_code == 200
+    assert resp.json['status'] == 'cancelled'
+    # Too late now.
+    resp = client.delete('/import/jobs/{}'.format(job.pk))
+    assert resp.status_code == 409
+    jobs.run(job.pk)
+    assert jobs.Job.get(jobs.Job.pk == job.pk).started_at is None
+
+
+def test_failed_import_job_forgets_its_checkpoints(session, tmpdir,
+                                                   monkeypatch):
+    path = tmpdir.join('bal.csv')
+    path.write('cle_interop\n')
+    job = jobs.Job.create(kind='bal', path=str(path), size=10,
+                          session=session)
+
+    def fail(path, progress):
+        Journal(path, 10).commit(0, {0: 10})
+        raise ValueError('Boom')
+
+    monkeypatch.setitem(jobs.KINDS, 'bal', fail)
+    jobs.run(job.pk)
+    assert jobs.Job.get(jobs.Job.pk == job.pk).status == jobs.Job.FAILED
+    assert not Checkpoint.select().count()
+    assert not path.exists()
+
+
+def test_running_import_job_stops_once_cancelled(session, reporter):
+    job = jobs.Job.create(kind='bal', path='/tmp/missing.csv', size=10,
+                          status=jobs.Job.RUNNING)
+    progress = jobs.Progress(job.pk, reporter, interval=0)
+    progress(done=4)
+    assert jobs.Job.get(jobs.Job.pk == job.pk).done == 4
+    job.cancel()
+    with pytest.raises(jobs.Cancelled):
+        progress(done=6)
+    # Running jobs are only marked cancelled once stopped.
+    assert jobs.Job.get(jobs.Job.pk == job.pk).status == jobs.Job.RUNNING
+
+
+@authorize
+def test_unknown_import_job_is_not_found(client):
+    resp = client.get('/import/jobs/123')
+    assert resp.status_code == 404
+
+
+@authorize
+def test_import_job_of_another_user_is_not_found(session, client):
+    other = factories.SessionFactory()
+    job = jobs.Job.create(kind='bal', path='/tmp/missing.csv', size=10,
+                          session=other)
+    resp = client.get('/import/jobs/{}'.format(job.pk))
+    assert resp.status_code == 404
+    resp = client.delete('/import/jobs/{}'.format(job.pk))
+    assert resp.status_code == 404
+    assert not jobs.Job.get(jobs.Job.pk == job.pk).cancelled
+
+
+def test_cannot_get_import_job_without_auth(client):
+    job = jobs.Job.create(kind='bal', path='/tmp/missing.csv')
+    resp = client.get('/import/jobs/{}'.format(job.pk))
+    assert resp.status_code == 401
@@ -430,3 +430,106 @@ def test_housenumber_select_use_default_orderby(get):
     assert resp.json['collection'][3]['ordinal'] == 'bis'
     assert resp.json['collection'][4]['number'] == '2'
     assert resp.json['collection'][4]['ordinal'] == 'ter'
+
+
+@authorize
+def test_get_housenumber_collection_by_identifiers(get):
+    hn1 = HouseNumberFactory(number="1", parent__fantoir="900011234")
+    hn2 = HouseNumberFactory(number="2", ign="IGNXXX")
+    HouseNumberFactory(number="3")
+    resp = get('/housenumber?id=ign:IGNXXX&id=cia:{}&id=cia:unknown'.format(
+               hn1.cia))
+    assert resp.status_code == 200
+    assert resp.json['total'] == 3
+    assert resp.json['collection'][0]['id'] == hn2.id
+    assert resp.json['collection'][1]['id'] == hn1.id
+    assert resp.json['collection'][2] is None
+    assert 'cia:unknown' in resp.json['errors']
+
+
+@authorize
+def test_resolve_housenumbers_follows_redirects(client):
+    housenumber = HouseNumberFactory(number="1", ign="IGNXXX")
+    housenumber.ign = "IGNYYY"
+    housenumber.increment_version()
+    housenumber.save()
+    resp = client.post('/housenumber/resolve',
+                       ['ign:IGNXXX', housenumber.id])
+    assert resp.status_code == 200
+    assert resp.json['collection'][0]['id'] == housenumber.id
+    assert resp.json['collection'][1]['id'] == housenumber.id
+    assert 'errors' not in resp.json
+
+
+@authorize
+def test_resolve_housenumbers_does_not_serve_deleted_ones(client):
+    housenumber = HouseNumberFactory(number="1", ign="IGNXXX")
+    housenumber.mark_deleted()
+    resp = client.post('/housenumber/resolve', ['ign:IGNXXX'])
+    assert resp.status_code == 200
+    assert resp.json['collection'] == [None]
+    assert resp.json['errors'] == {'ign:IGNXXX': 'Resource is deleted'}
+
+
+@authorize
+def test_resolve_housenumbers_needs_a_list(client):
+    resp = client.post('/housenumber/resolve', {'id': 'ign:IGNXXX'})
+    assert resp.status_code == 400
+
+
+@authorize
+def test_get_housenumber_collection_aggregated_by_grid(get):
+    housenumber = HouseNumberFactory()
+    PositionFactory(center=(1.01, 1.01), housenumber=housenumber,
+                    kind='entrance')
+    PositionFactory(center=(1.02, 1.02), housenumber=housenumber,
+                    kind='building')
+    PositionFactory(center=(1.9, 1.9))
+    resp = get('/housenumber?north=2&south=1&west=1&east=2&aggregate=1'
+               '&cells=2')
+    assert resp.status_code == 200
+    assert resp.json['total'] == 2
+    counts = sorted(c['count'] for c in resp.json['collection'])
+    assert counts == [1, 1]
+
+
+@authorize
+def test_get_housenumber_collection_by_group_is_paginated(get):
+    street = GroupFactory()
+    district = GroupFactory(kind=models.Group.AREA)
+    for number in range(1, 5):
+        HouseNumberFactory(number=str(number), parent=street)
+    in_district = HouseNumberFactory(number='5', ancestors=[street])
+    HouseNumberFactory(number='6', ancestors=[district])
+    resp = get('/housenumber?group={}&limit=2&offset=3'.format(street.id))
+    assert resp.status_code == 200
+    assert resp.json['total'] == 5
+    assert [h['number'] for h in resp.json['collection']] == ['4', '5']
+    assert resp.json['collection'][1]['id'] == in_district.id
+    assert 'next' not in resp.json
+    assert 'previous' in resp.json
+
+
+@authorize
+def test_get_housenumber_collection_by_ancestors(get):
+    street = GroupFactory()
+    district = GroupFactory(kind=models.Group.AREA)
+    HouseNumberFactory(number='1', parent=street)
+    housenumber = HouseNumberFactory(number='2', parent=street,
+                                     ancestors=[district])
+    resp = get('/housenumber?ancestors={}'.format(district.id))
+    assert resp.status_code == 200
+    assert resp.json['total'] == 1
+    assert resp.json['collection'][0]['id'] == housenumber.id
+
+
+@authorize
+def test_get_housenumber_collection_by_group_aggregated(get):
+    street = GroupFactory()
+    housenumber = HouseNumberFactory(parent=street)
+    PositionFactory(center=(1.01, 1.01), housenumber=housenumber)
+    PositionFactory(center=(1.02, 1.02))
+    resp = get('/housenumber?north=2&south=1&west=1&east=2&aggregate=1'
+               '&group={}'.format(street.id))
+    assert resp.status_code == 200
+    assert resp.json['total'] == 1
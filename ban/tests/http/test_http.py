@@ -1,3 +1,7 @@
+import gzip
+import json
+
+from ban.http.compression import CompressedBody
 from ban.http.utils import link
 from ..factories import MunicipalityFactory
 
@@ -29,3 +33,39 @@ def test_link_headers():
     assert headers == {
         'Link': '<http://ban.fr>; rel=alternate, <http://another.fr>; rel=alternate'  # noqa
     }
+
+
+def test_response_is_gzipped_if_accepted(get):
+    resp = get('/openapi', headers={'Accept-Encoding': 'gzip'})
+    assert resp.status_code == 200
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in resp.headers['Vary']
+    assert json.loads(gzip.decompress(resp.data).decode())['swagger']
+
+
+def test_response_is_not_compressed_if_not_accepted(get):
+    resp = get('/openapi')
+    assert resp.status_code == 200
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.json['swagger']
+
+
+def test_small_response_is_not_compressed(get, config):
+    config.COMPRESS_MIN_SIZE = 10 ** 9
+    resp = get('/openapi', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers
+
+
+def test_compressed_body_compresses_once(monkeypatch):
+    body = CompressedBody('{"foo": "bar"}')
+    calls = []
+
+    def compress(data, encoding):
+        calls.append(encoding)
+        return b'compressed'
+
+    monkeypatch.setattr('ban.http.compression.compress', compress)
+    assert body.encode('gzip') == b'compressed'
+    assert body.encode('gzip') == b'compressed'
+    assert body.encode() == b'{"foo": "bar"}'
+    assert calls == ['gzip']
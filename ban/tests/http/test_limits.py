@@ -0,0 +1,98 @@
+import threading
+
+from ban.http.limits import TokenBucket, admission, parse_limits
+
+from ..factories import TokenFactory
+
+
+def get_with(get, token, url='/municipality'):
+    headers = {'Authorization': 'Bearer {}'.format(token.access_token)}
+    return get(url, headers=headers)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=1, burst=2)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert 0 < bucket.take() <= 1
+
+
+def test_parse_limits():
+    assert parse_limits('abc=10, scope:view=5/20') == {
+        'abc': (10, 20), 'scope:view': (5, 20)}
+    assert parse_limits(None) == {}
+
+
+def test_no_rate_limit_by_default(get):
+    token = TokenFactory()
+    for i in range(5):
+        assert get_with(get, token).status_code == 200
+
+
+def test_rate_limit_returns_429(get, config):
+    config.RATE_LIMIT = '0.1/2'
+    token = TokenFactory()
+    assert get_with(get, token).status_code == 200
+    assert get_with(get, token).status_code == 200
+    resp = get_with(get, token)
+    assert resp.status_code == 429
+    assert int(resp.headers['Retry-After']) > 0
+
+
+def test_rate_limit_is_per_client(get, config):
+    config.RATE_LIMIT = '0.1/1'
+    token = TokenFactory()
+    other = TokenFactory()
+    assert get_with(get, token).status_code == 200
+    assert get_with(get, token).status_code == 429
+    assert get_with(get, other).status_code == 200
+
+
+def test_rate_limit_by_client_id(get, config):
+    config.RATE_LIMIT = '0.1/1'
+    token = TokenFactory()
+    config.RATE_LIMITS = '{}=100'.format(token.session.client.client_id)
+    for i in range(5):
+        assert get_with(get, token).status_code == 200
+
+
+def test_rate_limit_by_scope(get, config):
+    config.RATE_LIMITS = 'scope:view=0.1/1'
+    token = TokenFactory(scope='view')
+    assert get_with(get, token).status_code == 200
+    assert get_with(get, token).status_code == 429
+
+
+def test_expensive_endpoint_is_rejected_when_full(get, config):
+    config.EXPENSIVE_CONCURRENCY = 1
+    config.EXPENSIVE_QUEUE_TIMEOUT = 0.01
+    token = TokenFactory()
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with admission.slot():
+            acquired.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    acquired.wait()
+    try:
+        resp = get_with(get, token, '/municipality?limit=500')
+        assert resp.status_code == 503
+        assert 'Retry-After' in resp.headers
+        # Small pages are not concerned.
+        assert get_with(get, token).status_code == 200
+    finally:
+        release.set()
+        thread.join()
+    assert get_with(get, token, '/municipality?limit=500').status_code == 200
+
+
+def test_nested_slots_do_not_deadlock(config):
+    config.EXPENSIVE_CONCURRENCY = 1
+    config.EXPENSIVE_QUEUE_TIMEOUT = 0.01
+    with admission.slot():
+        with admission.slot():
+            pass
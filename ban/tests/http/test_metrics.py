@@ -0,0 +1,58 @@
+from ban.http.metrics import Registry, RequestStats, registry
+from ban.http.wsgi import app
+
+from .utils import authorize
+
+
+def test_registry_render():
+    reg = Registry()
+    stats = RequestStats()
+    stats.endpoint = 'municipality-get-collection'
+    stats.add_query(0.002)
+    stats.add_query(0.003)
+    reg.record(stats, 'GET', '200')
+    text = reg.render()
+    assert ('ban_http_requests_total{endpoint="municipality-get-collection",'
+            'method="GET",status="200"} 1') in text
+    assert ('ban_http_request_duration_seconds_count'
+            '{endpoint="municipality-get-collection"} 1') in text
+    assert ('ban_sql_queries_total{endpoint="municipality-get-collection"} 2'
+            in text)
+
+
+@authorize
+def test_requests_are_recorded(get):
+    registry.clear()
+    # Buffered, so the test client closes the response, as servers do.
+    resp = get('/municipality', buffered=True)
+    assert resp.status_code == 200
+    assert registry.requests[('municipality-get-collection', 'GET',
+                              '200')] == 1
+    # At least the token lookup, the count and the select.
+    assert registry.sql_count['municipality-get-collection'] >= 2
+
+
+def test_cannot_get_metrics_without_auth(get):
+    resp = get('/metrics')
+    assert resp.status_code == 401
+
+
+@authorize
+def test_metrics_endpoint(get):
+    registry.clear()
+    get('/municipality', buffered=True)
+    resp = get('/metrics')
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/plain'
+    text = resp.data.decode()
+    assert ('ban_http_requests_total{endpoint="municipality-get-collection",'
+            'method="GET",status="200"} 1') in text
+
+
+@authorize
+def test_server_timing_in_debug_mode(get, monkeypatch):
+    resp = get('/municipality')
+    assert 'Server-Timing' not in resp.headers
+    monkeypatch.setattr(app, 'debug', True)
+    resp = get('/municipality')
+    assert resp.headers['Server-Timing'].startswith('sql;dur=')
@@ -1,12 +1,14 @@
 import json
 from datetime import datetime
 
+from ban.commands.helpers import nodiff
 from ban.core import models, context
 from ban.core.encoder import dumps
-from ban.core.versioning import Version, Redirect
+from ban.core.versioning import Version, Redirect, Refresh
 from ban.utils import utcnow
 
-from ..factories import MunicipalityFactory, PostCodeFactory, GroupFactory
+from ..factories import (GroupFactory, HouseNumberFactory,
+                         MunicipalityFactory, PositionFactory, PostCodeFactory)
 from .utils import authorize
 
 
@@ -445,3 +447,75 @@ def test_authorized_responses_contain_sessions_data(get):
     session = context.get('session')
     assert resp.headers['Session-Client'] == session.client.id
     assert resp.headers['Session-User'] == session.user.id
+
+
+@authorize
+def test_get_municipality_bundle(get):
+    municipality = MunicipalityFactory()
+    postcode = PostCodeFactory(municipality=municipality)
+    street = GroupFactory(municipality=municipality)
+    district = GroupFactory(municipality=municipality, kind='area')
+    housenumber = HouseNumberFactory(parent=street, postcode=postcode,
+                                     ancestors=[district])
+    position = PositionFactory(housenumber=housenumber, center=(1, 2))
+    PositionFactory()  # Elsewhere.
+    resp = get('/municipality/{}/bundle'.format(municipality.id))
+    assert resp.status_code == 200
+    data = resp.json
+    assert data['municipality']['id'] == municipality.id
+    assert [p['id'] for p in data['postcodes']] == [postcode.id]
+    assert [g['id'] for g in data['groups']] == [street.id, district.id]
+    assert data['housenumbers'] == [json.loads(dumps(
+        housenumber.as_relation))]
+    assert data['housenumbers'][0]['parent'] == street.id
+    assert data['positions'] == [json.loads(dumps(position.as_relation))]
+
+
+@authorize
+def test_get_municipality_bundle_as_ndjson(get):
+    municipality = MunicipalityFactory()
+    group = GroupFactory(municipality=municipality)
+    resp = get('/municipality/{}/bundle?format=ndjson'.format(
+        municipality.id))
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/x-ndjson'
+    lines = [json.loads(l) for l in resp.data.decode().splitlines()]
+    assert [l['id'] for l in lines] == [municipality.id, group.id]
+
+
+@authorize
+def test_municipality_bundle_is_refreshed_by_diffs(get, config):
+    config.BUNDLE_REFRESH_INTERVAL = 0
+    municipality = MunicipalityFactory()
+    street = GroupFactory(municipality=municipality)
+    resp = get('/municipality/{}/bundle'.format(municipality.id))
+    assert len(resp.json['groups']) == 1
+    # Cached.
+    resp = get('/municipality/{}/bundle'.format(municipality.id))
+    assert len(resp.json['groups']) == 1
+    GroupFactory(municipality=municipality)
+    resp = get('/municipality/{}/bundle'.format(municipality.id))
+    assert len(resp.json['groups']) == 2
+    street.name = 'Rue des Lilas'
+    street.increment_version()
+    street.save()
+    resp = get('/municipality/{}/bundle'.format(municipality.id))
+    assert resp.json['groups'][0]['name'] == 'Rue des Lilas'
+
+
+@authorize
+def test_municipality_bundle_is_refreshed_by_imports(get, config):
+    config.BUNDLE_REFRESH_INTERVAL = 0
+    municipality = MunicipalityFactory(insee='33001')
+    url = '/municipality/{}/bundle'.format(municipality.id)
+    assert not get(url).json['groups']
+
+    @nodiff
+    def load():
+        GroupFactory(municipality=municipality)
+
+    load()
+    # No diff to tell.
+    assert not get(url).json['groups']
+    Refresh.record(['33001'])
+    assert len(get(url).json['groups']) == 1
@@ -476,3 +476,23 @@ def test_can_get_position_from_laposte_id(get, url):
     resp = get('/position/laposte:123456789')
     assert resp.status_code == 200
     assert resp.json['laposte'] == '123456789'
+
+
+@authorize
+def test_get_position_collection_aggregated_by_grid(get):
+    PositionFactory(center=(1.01, 1.01))
+    PositionFactory(center=(1.02, 1.02))
+    PositionFactory(center=(1.9, 1.9))
+    PositionFactory(center=(10, 10))
+    resp = get('/position?north=2&south=1&west=1&east=2&aggregate=1&cells=2')
+    assert resp.status_code == 200
+    assert resp.json['total'] == 3
+    assert resp.json['grid'] == 0.5
+    counts = sorted(c['count'] for c in resp.json['collection'])
+    assert counts == [1, 2]
+
+
+@authorize
+def test_aggregate_mode_needs_bbox(get):
+    resp = get('/position?aggregate=1')
+    assert resp.status_code == 400
@@ -0,0 +1,75 @@
+from ..factories import PositionFactory
+from .utils import authorize
+
+
+def test_cannot_reverse_without_auth(get):
+    resp = get('/reverse?lon=1&lat=2')
+    assert resp.status_code == 401
+
+
+@authorize
+def test_reverse_returns_nearest_position(get):
+    PositionFactory(center=(1, 1))
+    near = PositionFactory(center=(2.1, 48.1))
+    resp = get('/reverse?lon=2.1001&lat=48.1001')
+    assert resp.status_code == 200
+    assert resp.json['total'] == 1
+    result = resp.json['collection'][0]
+    assert result['id'] == near.id
+    assert result['housenumber']['id'] == near.housenumber.id
+    assert (result['housenumber']['parent']['municipality']['insee'] ==
+            near.housenumber.parent.municipality.insee)
+    assert 0 < result['distance'] < 20
+
+
+@authorize
+def test_reverse_accepts_limit_and_kind(get):
+    PositionFactory(center=(2.1, 48.1), kind='entrance')
+    PositionFactory(center=(2.2, 48.2), kind='building')
+    PositionFactory(center=(2.3, 48.3), kind='entrance')
+    resp = get('/reverse?lon=2.1&lat=48.1&limit=5&kind=entrance')
+    assert resp.status_code == 200
+    assert resp.json['total'] == 2
+    assert all(r['kind'] == 'entrance' for r in resp.json['collection'])
+
+
+@authorize
+def test_reverse_with_invalid_point(get):
+    resp = get('/reverse?lon=abc&lat=48.1')
+    assert resp.status_code == 400
+
+
+@authorize
+def test_reverse_with_many_points(client):
+    first = PositionFactory(center=(2.1, 48.1))
+    second = PositionFactory(center=(3.1, 45.1))
+    resp = client.post('/reverse', [{'lon': 3.1, 'lat': 45.1},
+                                    {'lon': 2.1, 'lat': 48.1, 'limit': 2}])
+    assert resp.status_code == 200
+    assert resp.json['collection'][0][0]['id'] == second.id
+    assert len(resp.json['collection'][1]) == 2
+    assert resp.json['collection'][1][0]['id'] == first.id
+
+
+@authorize
+def test_reverse_with_many_points_filters_kinds(client):
+    PositionFactory(center=(2.1, 48.1), kind='entrance')
+    building = PositionFactory(center=(2.2, 48.2), kind='building')
+    resp = client.post('/reverse', [{'lon': 2.1, 'lat': 48.1,
+                                     'kind': 'building'},
+                                    {'lon': 2.1, 'lat': 48.1, 'limit': 2}])
+    assert resp.status_code == 200
+    assert [r['id'] for r in resp.json['collection'][0]] == [building.id]
+    assert len(resp.json['collection'][1]) == 2
+
+
+@authorize
+def test_reverse_rejects_limit_below_one(get):
+    resp = get('/reverse?lon=2.1&lat=48.1&limit=0')
+    assert resp.status_code == 400
+
+
+@authorize
+def test_reverse_with_many_points_rejects_limit_below_one(client):
+    resp = client.post('/reverse', [{'lon': 2.1, 'lat': 48.1, 'limit': -1}])
+    assert resp.status_code == 400
@@ -3,6 +3,8 @@ from flex.core import load, validate, validate_api_call
 from flex.http import Request, Response
 import pytest
 
+from ban.http.schema import Schema
+
 from .utils import authorize
 from .. import factories
 
@@ -109,3 +111,40 @@ def test_get_position_collection(get, schema):
     factories.PositionFactory()
     resp = get('/position')
     validate_call(resp, schema)
+
+
+def test_openapi_has_etag_and_honours_if_none_match(get):
+    resp = get('/openapi')
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+    resp = get('/openapi', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+
+
+def test_schema_is_loaded_from_artifact(tmpdir, config):
+    config.OPENAPI_PATH = str(tmpdir.join('openapi.json'))
+    schema = Schema()
+    schema.register_model(factories.MunicipalityFactory._meta.model)
+    schema.dump()
+    loaded = Schema()
+    loaded.register_model(factories.MunicipalityFactory._meta.model)
+    loaded.build = lambda: pytest.fail('Should not build schema')
+    assert 'Municipality' in loaded.load()['definitions']
+
+
+def test_schema_artifact_is_ignored_if_outdated(tmpdir, config):
+    config.OPENAPI_PATH = str(tmpdir.join('openapi.json'))
+    schema = Schema()
+    schema.dump()
+    loaded = Schema()
+    loaded.register_model(factories.MunicipalityFactory._meta.model)
+    assert 'Municipality' in loaded.load()['definitions']
+
+
+def test_schema_key_changes_with_field_constraints(monkeypatch):
+    model = factories.MunicipalityFactory._meta.model
+    schema = Schema()
+    schema.register_model(model)
+    key = schema.key
+    monkeypatch.setattr(model.insee, 'max_length', 6)
+    assert schema.key != key
@@ -0,0 +1,21 @@
+from ..factories import GroupFactory
+from .utils import authorize
+
+
+def test_cannot_search_without_auth(get):
+    resp = get('/search?q=rue')
+    assert resp.status_code == 401
+
+
+@authorize
+def test_search(get):
+    group = GroupFactory(name='Rue des Lilas')
+    resp = get('/search?q=rue des lila')
+    assert resp.status_code == 200
+    assert resp.json['collection'][0]['resource']['id'] == group.id
+
+
+@authorize
+def test_search_without_query(get):
+    resp = get('/search')
+    assert resp.status_code == 400
@@ -0,0 +1,58 @@
+from ban.core.stats import Statistic
+
+from ..factories import GroupFactory, HouseNumberFactory, PositionFactory
+from .utils import authorize
+
+
+@authorize
+def test_get_stats(get):
+    PositionFactory(kind='entrance')
+    resp = get('/stats')
+    assert resp.status_code == 200
+    assert resp.json['groups'] == 1
+    assert resp.json['housenumbers'] == 1
+    assert resp.json['positions']['total'] == 1
+    assert resp.json['positions']['kind'] == {'entrance': 1}
+
+
+@authorize
+def test_get_stats_by_municipality(get):
+    position = PositionFactory()
+    PositionFactory()
+    municipality = position.housenumber.parent.municipality
+    resp = get('/stats?municipality={}'.format(municipality.id))
+    assert resp.status_code == 200
+    assert resp.json['housenumbers'] == 1
+
+
+@authorize
+def test_get_stats_by_group(get):
+    group = GroupFactory()
+    HouseNumberFactory.create_batch(2, parent=group)
+    resp = get('/stats?group={}'.format(group.id))
+    assert resp.status_code == 200
+    assert resp.json['housenumbers'] == 2
+    assert 'groups' not in resp.json
+
+
+@authorize
+def test_get_stats_with_unknown_municipality(get):
+    resp = get('/stats?municipality=insee:00000')
+    assert resp.status_code == 404
+
+
+@authorize
+def test_collection_total_is_read_from_stats(get):
+    group = GroupFactory()
+    HouseNumberFactory.create_batch(3, parent=group)
+    HouseNumberFactory()
+    resp = get('/housenumber?parent={}&limit=1'.format(group.id))
+    assert resp.json['total'] == 3
+    # Statistics are trusted.
+    Statistic.update(count=10).where(Statistic.name == 'housenumbers',
+                                     Statistic.scope == 'group').execute()
+    resp = get('/housenumber?parent={}&limit=1'.format(group.id))
+    assert resp.json['total'] == 10
+    # Not for other filters.
+    resp = get('/housenumber?group={}&limit=1'.format(group.id))
+    assert resp.json['total'] == 3
@@ -0,0 +1,90 @@
+from ban.core.versioning import Refresh
+from ban.http import tiles
+
+from ..factories import PositionFactory
+from .utils import authorize
+
+
+def test_tile_for_returns_tile_containing_point():
+    assert tiles.tile_for(0, 0, 1) == (1, 1)
+    assert tiles.tile_for(-1.1111, 48.8888, 16) == (32565, 22537)
+
+
+def test_tile_bounds_contains_tile_for_point():
+    xmin, ymin, xmax, ymax = tiles.tile_bounds(1, 1, 1)
+    assert xmin == 0
+    assert ymax == 0
+    assert xmax == tiles.ORIGIN
+    assert ymin == -tiles.ORIGIN
+
+
+def test_grid_size_is_none_from_full_zoom():
+    assert tiles.grid_size(tiles.FULL_ZOOM) is None
+    assert tiles.grid_size(tiles.FULL_ZOOM - 1) > 0
+
+
+def test_cannot_get_tile_without_auth(get):
+    resp = get('/tiles/16/32565/22537')
+    assert resp.status_code == 401
+
+
+@authorize
+def test_get_tile(get):
+    PositionFactory(center=(-1.1111, 48.8888))
+    resp = get('/tiles/16/32565/22537')
+    assert resp.status_code == 200
+    assert resp.mimetype == tiles.MIMETYPE
+    assert resp.data
+
+
+@authorize
+def test_get_tile_with_invalid_zoom(get):
+    resp = get('/tiles/2/1/1')
+    assert resp.status_code == 400
+
+
+@authorize
+def test_tile_is_evicted_from_cache_by_position_diff(get, config):
+    config.TILES_REFRESH_INTERVAL = 0
+    tiles.cache.clear()
+    tiles.cache.refresh(force=True)
+    position = PositionFactory(center=(-1.1111, 48.8888))
+    assert get('/tiles/16/32565/22537').status_code == 200
+    assert (16, 32565, 22537) in tiles.cache._tiles
+    position.center = (-1.1112, 48.8887)
+    position.increment_version()
+    position.save()
+    tiles.cache.refresh(force=True)
+    assert (16, 32565, 22537) not in tiles.cache._tiles
+    assert get('/tiles/16/32565/22537').status_code == 200
+    assert (16, 32565, 22537) in tiles.cache._tiles
+
+
+@authorize
+def test_tile_is_evicted_from_cache_by_housenumber_diff(get, config):
+    config.TILES_REFRESH_INTERVAL = 0
+    tiles.cache.clear()
+    tiles.cache.refresh(force=True)
+    position = PositionFactory(center=(-1.1111, 48.8888))
+    assert get('/tiles/16/32565/22537').status_code == 200
+    assert (16, 32565, 22537) in tiles.cache._tiles
+    housenumber = position.housenumber
+    housenumber.number = '1000'
+    housenumber.increment_version()
+    housenumber.save()
+    tiles.cache.refresh(force=True)
+    assert (16, 32565, 22537) not in tiles.cache._tiles
+
+
+@authorize
+def test_tile_is_evicted_from_cache_by_imports(get, config):
+    config.TILES_REFRESH_INTERVAL = 0
+    tiles.cache.clear()
+    tiles.cache.refresh(force=True)
+    position = PositionFactory(center=(-1.1111, 48.8888))
+    assert get('/tiles/16/32565/22537').status_code == 200
+    assert (16, 32565, 22537) in tiles.cache._tiles
+    insee = position.housenumber.parent.municipality.insee
+    Refresh.record([insee])
+    tiles.cache.refresh(force=True)
+    assert (16, 32565, 22537) not in tiles.cache._tiles
@@ -0,0 +1,92 @@
+from ban.commands.helpers import nodiff
+from ban.core.autocomplete import AutocompleteIndex, make_keys
+from ban.core.versioning import Refresh
+
+from . import factories
+
+
+def test_make_keys():
+    assert make_keys('Rue des Lilas') == ['rue des lilas', 'des lilas',
+                                          'lilas']
+    assert make_keys('') == []
+
+
+def test_autocomplete_group_by_prefix():
+    group = factories.GroupFactory(name='Rue des Lilas')
+    factories.GroupFactory(name='Rue des Roses')
+    index = AutocompleteIndex()
+    index.build()
+    results = index.search('rue des li')
+    assert len(results) == 1
+    assert results[0]['id'] == group.id
+    assert results[0]['label'] == 'Rue des Lilas'
+    assert index.search('lil')[0]['id'] == group.id
+
+
+def test_autocomplete_housenumbers():
+    housenumber = factories.HouseNumberFactory(number='12', ordinal='bis',
+                                               parent__name='Rue des Lilas')
+    factories.HouseNumberFactory(number='3', ordinal=None,
+                                 parent=housenumber.parent)
+    index = AutocompleteIndex()
+    index.build()
+    results = index.search('12 rue des li')
+    assert len(results) == 1
+    assert results[0]['id'] == housenumber.id
+    assert results[0]['label'] == '12 bis Rue des Lilas'
+
+
+def test_autocomplete_filter_by_insee():
+    group = factories.GroupFactory(name='Rue des Lilas',
+                                   municipality__insee='12345')
+    factories.GroupFactory(name='Rue des Lilas', municipality__insee='54321')
+    index = AutocompleteIndex()
+    index.build()
+    results = index.search('rue des li', insee='12345')
+    assert [r['id'] for r in results] == [group.id]
+
+
+def test_autocomplete_is_refreshed_from_diffs():
+    group = factories.GroupFactory(name='Rue des Lilas')
+    index = AutocompleteIndex()
+    index.build()
+    group.name = 'Rue des Roses'
+    group.increment_version()
+    group.save()
+    housenumber = factories.HouseNumberFactory(number='7', parent=group)
+    index.refresh(force=True)
+    assert not index.search('rue des li')
+    assert index.search('rue des ro')[0]['id'] == group.id
+    assert index.search('7 rue des ro')[0]['id'] == housenumber.id
+
+
+def test_autocomplete_is_refreshed_by_imports():
+    municipality = factories.MunicipalityFactory(insee='33001')
+    factories.GroupFactory(name='Rue des Roses', municipality=municipality)
+    index = AutocompleteIndex()
+    index.build()
+
+    @nodiff
+    def load():
+        return factories.GroupFactory(name='Rue des Lilas',
+                                      municipality=municipality)
+
+    group = load()
+    index.refresh(force=True)
+    # No diff to tell.
+    assert not index.search('rue des li')
+    Refresh.record(['33001'])
+    index.refresh(force=True)
+    assert index.search('rue des li')[0]['id'] == group.id
+    assert index.search('rue des ro')
+
+
+def test_autocomplete_snapshot(tmpdir):
+    group = factories.GroupFactory(name='Rue des Lilas')
+    index = AutocompleteIndex()
+    index.build()
+    path = str(tmpdir.join('autocomplete.json'))
+    index.dump(path)
+    loaded = AutocompleteIndex()
+    loaded.load_snapshot(path)
+    assert loaded.search('rue des li')[0]['id'] == group.id
@@ -1,3 +1,5 @@
+from ban.core.versioning import Feed, Refresh
+
 from .factories import MunicipalityFactory
 
 
@@ -43,3 +45,17 @@ def test_delete_should_create_a_diff():
     assert len(diff.diff) == 1  # name, siren
     assert diff.diff['status']['old'] == 'active'
     assert diff.diff['status']['new'] == 'deleted'
+
+
+def test_feed_should_return_rows_committed_late():
+    feed = Feed(Refresh)
+    Refresh.record(['33001'])
+    assert feed.poll() == []
+    first = Refresh.create(insee='33002')
+    second = Refresh.create(insee='33003')
+    # Not committed yet when polled.
+    first.delete_instance()
+    assert feed.poll() == [second.pk]
+    Refresh.insert(pk=first.pk, insee='33002').execute()
+    assert feed.poll() == [first.pk]
+    assert feed.poll() == []
@@ -395,3 +395,57 @@ def test_cannot_create_position_with_same_housenumber_and_source():
     with pytest.raises(peewee.IntegrityError):
         PositionFactory(housenumber=hn1, source="XXX")
     assert models.Position.select().count() == 1
+
+
+def get_center(housenumber):
+    return models.HouseNumber.raw_select(models.HouseNumber.center).where(
+        models.HouseNumber.pk == housenumber.pk).scalar()
+
+
+def test_housenumber_center_follows_its_positions():
+    housenumber = HouseNumberFactory()
+    assert get_center(housenumber) is None
+    position = PositionFactory(housenumber=housenumber, center=(1, 2))
+    assert get_center(housenumber).coords == (1, 2)
+    # Saving a stale instance does not reset it.
+    housenumber.ordinal = 'ter'
+    housenumber.increment_version()
+    housenumber.save()
+    assert get_center(housenumber).coords == (1, 2)
+    position.mark_deleted()
+    assert get_center(housenumber) is None
+
+
+def test_housenumber_center_is_updated_when_position_moves():
+    position = PositionFactory(center=(1, 2))
+    old = position.housenumber
+    new = HouseNumberFactory()
+    position.housenumber = new
+    position.increment_version()
+    position.save()
+    assert get_center(old) is None
+    assert get_center(new).coords == (1, 2)
+
+
+def test_housenumber_center_is_updated_when_position_is_deleted():
+    position = PositionFactory(center=(1, 2))
+    position.delete_instance()
+    assert get_center(position.housenumber) is None
+
+
+def test_housenumber_centers_are_updated_once_when_deferred():
+    housenumber = HouseNumberFactory()
+    with models.HouseNumber.defer_centers():
+        PositionFactory(housenumber=housenumber, center=(1, 2))
+        assert get_center(housenumber) is None
+    assert get_center(housenumber).coords == (1, 2)
+
+
+def test_update_centers_without_valid_pk_updates_nothing():
+    housenumber = HouseNumberFactory()
+    models.HouseNumber.update(center=(1, 2)).where(
+        models.HouseNumber.pk == housenumber.pk).execute()
+    models.HouseNumber.update_centers(None)
+    assert get_center(housenumber).coords == (1, 2)
+    models.HouseNumber.update_centers()
+    assert get_center(housenumber) is None
@@ -1,6 +1,7 @@
 import peewee
 import pytest
 
+from ban.core import models
 from ban.core.versioning import Redirect
 
 from . import factories
@@ -136,3 +137,18 @@ def test_should_not_be_deleted_if_instance_remove_fails():
     with pytest.raises(peewee.IntegrityError):
         housenumber.delete_instance()
     assert Redirect.select().count() == 1
+
+
+def test_coerce_many_returns_instances_in_input_order():
+    municipality1 = factories.MunicipalityFactory(insee='12345')
+    municipality2 = factories.MunicipalityFactory(insee='54321')
+    municipality1.insee = '11111'
+    municipality1.increment_version()
+    municipality1.save()
+    ids = ['insee:54321', 'insee:12345', municipality2.id, 'insee:00000']
+    results = models.Municipality.coerce_many(ids)
+    assert results[0] == (municipality2, None)
+    assert results[1] == (municipality1, None)
+    assert results[2] == (municipality2, None)
+    assert results[3][0] is None
+    assert isinstance(results[3][1], models.Municipality.DoesNotExist)
@@ -0,0 +1,56 @@
+from ban.core import search
+
+from . import factories
+
+
+def test_parse_query_with_number_and_ordinal():
+    assert search.parse('12 Bis, rue des Lilas') == ('12', 'bis',
+                                                     'rue des lilas')
+
+
+def test_parse_query_without_number():
+    assert search.parse('Rue des Lilas') == (None, None, 'rue des lilas')
+
+
+def test_group_normalized_is_computed_on_save():
+    group = factories.GroupFactory(name="Rue de l'Église",
+                                   alias=['Chemin Vert'])
+    assert group.normalized == 'rue de l eglise chemin vert'
+
+
+def test_search_groups_is_fuzzy():
+    group = factories.GroupFactory(name="Rue de l'Église")
+    factories.GroupFactory(name="Avenue du Général Leclerc")
+    results = search.search('rue de leglise')
+    assert results[0]['type'] == 'group'
+    assert results[0]['resource']['id'] == group.id
+
+
+def test_search_housenumbers_with_positions():
+    housenumber = factories.HouseNumberFactory(
+        number='12', ordinal='bis', parent__name="Rue de l'Église")
+    position = factories.PositionFactory(housenumber=housenumber)
+    factories.HouseNumberFactory(number='12', ordinal=None,
+                                 parent=housenumber.parent)
+    results = search.search('12 bis rue de l eglise')
+    assert results[0]['type'] == 'housenumber'
+    assert results[0]['resource']['id'] == housenumber.id
+    assert results[0]['resource']['positions'][0]['id'] == position.id
+    assert results[1]['type'] == 'group'
+
+
+def test_search_municipalities():
+    municipality = factories.MunicipalityFactory(name='Saint-Ouen')
+    results = search.search('saint ouen')
+    assert results[0]['type'] == 'municipality'
+    assert results[0]['resource']['id'] == municipality.id
+
+
+def test_search_can_be_restricted_to_municipality():
+    group = factories.GroupFactory(name="Rue de l'Église",
+                                   municipality__insee='12345')
+    factories.GroupFactory(name="Rue de l'Église",
+                           municipality__insee='54321')
+    results = search.search("rue de l'eglise", insee='12345')
+    assert len(results) == 1
+    assert results[0]['resource']['id'] == group.id
@@ -0,0 +1,97 @@
+from ban.core import context, stats
+
+from .factories import (GroupFactory, HouseNumberFactory, MunicipalityFactory,
+                        PositionFactory)
+
+
+def test_counts_are_updated_on_create():
+    municipality = MunicipalityFactory()
+    group = GroupFactory(municipality=municipality)
+    housenumber = HouseNumberFactory(parent=group)
+    PositionFactory(housenumber=housenumber, kind='entrance',
+                    positioning='gps')
+    PositionFactory(housenumber=housenumber, kind='building',
+                    positioning='gps')
+    assert stats.summary(stats.MUNICIPALITY, municipality.pk) == {
+        'groups': 1,
+        'housenumbers': 1,
+        'positions': {'total': 2,
+                      'kind': {'entrance': 1, 'building': 1},
+                      'positioning': {'gps': 2}},
+    }
+    assert stats.count('housenumbers', stats.GROUP, group.pk) == 1
+    assert stats.count('positions') == 2
+
+
+def test_counts_are_updated_on_delete():
+    position = PositionFactory()
+    housenumber = position.housenumber
+    assert stats.count('positions') == 1
+    position.mark_deleted()
+    assert stats.count('positions') == 0
+    housenumber.mark_deleted()
+    assert stats.count('housenumbers') == 0
+
+
+def test_counts_follow_moved_resources():
+    group = GroupFactory()
+    other = GroupFactory()
+    position = PositionFactory(housenumber__parent=group, kind='entrance')
+    housenumber = position.housenumber
+    housenumber.parent = other
+    housenumber.increment_version()
+    housenumber.save()
+    assert stats.count('housenumbers', stats.GROUP, group.pk) == 0
+    assert stats.count('positions', stats.GROUP, group.pk) == 0
+    assert stats.count('housenumbers', stats.GROUP, other.pk) == 1
+    assert stats.count('positions:kind:entrance', stats.GROUP,
+                       other.pk) == 1
+    municipality = MunicipalityFactory()
+    other.municipality = municipality
+    other.increment_version()
+    other.save()
+    assert stats.summary(stats.MUNICIPALITY,
+                         group.municipality.pk)['housenumbers'] == 0
+    assert stats.count('positions', stats.MUNICIPALITY,
+                       municipality.pk) == 1
+    position.kind = 'building'
+    position.increment_version()
+    position.save()
+    assert stats.count('positions:kind:entrance') == 0
+    assert stats.count('positions:kind:building') == 1
+
+
+def test_rebuild():
+    PositionFactory.create_batch(3, kind='entrance')
+    stats.Statistic.delete().execute()
+    assert stats.count('positions') == 0
+    stats.rebuild()
+    assert stats.count('positions') == 3
+    assert stats.count('housenumbers') == 3
+    assert stats.count('groups') == 3
+    assert stats.count('positions:kind:entrance') == 3
+
+
+def test_counts_are_not_tracked_without_diffs():
+    context.set('nodiff', True)
+    try:
+        PositionFactory(kind='entrance')
+    finally:
+        context.set('nodiff', None)
+    assert stats.count('positions') == 0
+    stats.rebuild()
+    assert stats.count('positions') == 1
+
+
+def test_rebuild_only_given_municipalities():
+    first = PositionFactory(kind='entrance')
+    second = PositionFactory(kind='entrance')
+    stats.Statistic.delete().execute()
+    municipality = first.housenumber.parent.municipality
+    stats.rebuild([municipality.pk])
+    assert stats.count('positions') == 1
+    assert stats.count('positions', stats.MUNICIPALITY, municipality.pk) == 1
+    assert stats.count('positions', stats.GROUP,
+                       second.housenumber.parent.pk) == 0
+    stats.rebuild([])
+    assert stats.count('positions') == 1
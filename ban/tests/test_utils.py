@@ -1,4 +1,4 @@
-from ban.utils import parse_mask
+from ban.utils import normalize, parse_mask
 
 
 def test_parse_mask():
@@ -18,3 +18,9 @@ def test_parse_mask():
             }
         }
     }
+
+
+def test_normalize():
+    assert normalize("Rue de l'Église  Saint-Ouen") == (
+        'rue de l eglise saint ouen')
+    assert normalize(None) == ''
@@ -1,6 +1,9 @@
+import re
 from datetime import datetime, timezone
 from uuid import UUID
 
+from unidecode import unidecode
+
 
 def is_uuid4(uuid_string):
     """
@@ -57,3 +60,9 @@ def parse_mask(source):
                 parent[field] = {}
             parent = parent[field]
     return dest
+
+
+def normalize(text):
+    """Lowercase ascii version of text, with only alphanumeric words."""
+    text = unidecode(text or '').lower()
+    return ' '.join(re.sub(r'[^a-z0-9]', ' ', text).split())
@@ -11,6 +11,9 @@ from ban.commands.db import models
 from ban.commands.reporter import Reporter
 from ban.core import context
 from ban.http.api import app as application
+from ban.http.auth import tokens
+from ban.http.bundle import cache as bundles
+from ban.http.limits import rate_limiter
 from ban.tests.factories import SessionFactory, TokenFactory, UserFactory
 
 
@@ -18,6 +21,8 @@ def pytest_configure(config):
     assert db.test.database.startswith('test_')
     for model in models:
         model._meta.database = db.test
+    # Eg. the metrics listener, registered by the app.
+    db.test.listeners.extend(db.default.listeners)
     db.test.connect()
     createdb(fail_silently=True)
     verbose = config.getoption('verbose')
@@ -33,6 +38,9 @@ def pytest_unconfigure(config):
 
 def pytest_runtest_setup(item):
     truncatedb(force=True)
+    tokens.invalidate()
+    rate_limiter.clear()
+    bundles.clear()
     context.set('session', None)
 
 